@@ -130,6 +130,7 @@ const styles = {
 function App() {
   const [input, setInput] = useState("")
   const [answer, setAnswer] = useState("")
+  const [sources, setSources] = useState([])
   const [isLoading, setIsLoading] = useState(false)
   const [selectedFile, setSelectedFile] = useState(null)
   const [isUploading, setIsUploading] = useState(false)
@@ -143,6 +144,17 @@ function App() {
     setSelectedFile(e.target.files[0])
   }
 
+  // 每秒查一次入库任务，直到 done / failed
+  const waitForJob = async (jobId) => {
+    while (true) {
+      const res = await fetch(`${API_BASE_URL}/upload/${jobId}`)
+      if (!res.ok) return { status: 'failed', error: '任务不存在' }
+      const job = await res.json()
+      if (job.status === 'done' || job.status === 'failed') return job
+      await new Promise(resolve => setTimeout(resolve, 1000))
+    }
+  }
+
   const handleUpload = async () => {
     if (!selectedFile) {
       alert("请先选择一个 PDF 文件！")
@@ -159,13 +171,20 @@ function App() {
         method: "POST",
         body: formData,
       })
-      if (response.ok) {
+      if (!response.ok) {
+        alert("❌ 上传失败")
+        return
+      }
+      // 后端是后台处理的，先拿到 job_id，再轮询进度
+      const { job_id } = await response.json()
+      const job = await waitForJob(job_id)
+      if (job.status === 'done') {
         alert("✅ 上传成功！知识库已更新。")
         setSelectedFile(null)
         // 重置 file input
         document.getElementById('fileInput').value = '';
       } else {
-        alert("❌ 上传失败")
+        alert(`❌ 处理失败: ${job.error}`)
       }
     } catch (error) {
       console.error("上传错误:", error)
@@ -178,6 +197,7 @@ function App() {
   const sendQuestion = async () => {
     if (!input.trim()) return;
     setAnswer("")
+    setSources([])
     setIsLoading(true)
     try {
       const response = await fetch(`${API_BASE_URL}/chat/stream`, {
@@ -186,23 +206,55 @@ function App() {
         body: JSON.stringify({ query: input, session_id: SESSION_ID })
       })
 
-      if (!response.body) return new Error('不支持流式传输')
+      if (!response.ok) {
+        // 没传文件 (400)、排队排满了 (429) 之类的，回的是普通 JSON，不是 SSE
+        let detail = `HTTP ${response.status}`
+        try {
+          detail = (await response.json()).detail || detail
+        } catch {
+          // 不是 JSON 就用状态码
+        }
+        const retryAfter = response.headers.get('Retry-After')
+        setAnswer(retryAfter ? `[Error: ${detail}，请 ${retryAfter} 秒后重试]` : `[Error: ${detail}]`)
+        return
+      }
+      if (!response.body) throw new Error('不支持流式传输')
       const reader = response.body.getReader();
       const decoder = new TextDecoder()
+      // 后端是标准 SSE：每帧 "data: {json}\n\n"，结束时有一个 event: done
+      let buffer = ''
+      const handleEvent = (rawEvent) => {
+        let eventName = 'message'
+        let data = ''
+        for (const line of rawEvent.split('\n')) {
+          if (line.startsWith(':')) continue // 保活注释，忽略
+          if (line.startsWith('event:')) eventName = line.slice(6).trim()
+          if (line.startsWith('data:')) data += line.slice(5).trim()
+        }
+        if (!data) return
+        const payload = JSON.parse(data)
+        if (eventName === 'message') {
+          setAnswer(prev => prev + payload.text)
+        } else if (eventName === 'done') {
+          setSources(payload.sources || [])
+        } else if (eventName === 'error') {
+          setAnswer(prev => prev + `\n\n[Error: ${payload.message}]`)
+        }
+      }
       while (true) {
         const { done, value } = await reader.read();
-        if (done) {
-          const lastChunk = decoder.decode();
-          if (lastChunk) {
-            setAnswer(prev => prev + lastChunk);
-          }
-          break;
+        buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+        // 一次 read 可能收到半帧，也可能收到好几帧，按空行切
+        let boundary
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+          handleEvent(buffer.slice(0, boundary))
+          buffer = buffer.slice(boundary + 2)
         }
-        const textChunk = decoder.decode(value, { stream: true });
-        setAnswer(prev => prev + textChunk);
+        if (done) break;
       }
     } catch (error) {
       console.error("请求出错:", error)
+      setAnswer(prev => prev + `\n\n[Error: ${error.message}]`)
     } finally {
       setIsLoading(false)
     }
@@ -270,6 +322,15 @@ function App() {
           >
             {answer}
           </ReactMarkdown>
+          {/* 参考来源：流结束时随 done 事件一起到 */}
+          {sources.length > 0 && (
+            <details style={{ marginTop: '20px', color: '#666', fontSize: '0.9rem' }}>
+              <summary>查看参考原文 ({sources.length})</summary>
+              {sources.map((source, i) => (
+                <p key={i} style={{ margin: '8px 0' }}>[片段 {i + 1}] {source}</p>
+              ))}
+            </details>
+          )}
         </div>
 
         {/* 输入框区域 - 更现代的样式 */}
@@ -29,28 +29,25 @@
 #     当面对海量文本时，如何设计一个“流水线”，让 AI 分批次、有策略地把里面的“金子”（关键信息、结构化数据）淘出来，而不是一股脑塞进去等着报错。
 
 
-import os
 from pathlib import Path
 from dotenv import load_dotenv
-# 1. 引入 LangChain 的 OpenAI 连接器
-from langchain_openai import ChatOpenAI
+# 1. LLM 从注册表拿：同样的 (provider, model, temperature) 全进程只有一个客户端，共用连接池
+from rag_llm import get_llm
 # 1. 导入切分工具
 # RecursiveCharacterTextSplitter 是最常用的“智能切刀”
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser # 用来把结果转成字符串
 
+from rag_mapreduce import MapReduceExtractor
+from rag_structured import PRODUCT_SCHEMA
+
 # --- A. 加载环境变量 (和你之前的作业一样) ---
 current_dir = Path(__file__).parent
 env_path = current_dir / ".env"
 load_dotenv(dotenv_path=env_path)
 
-llm = ChatOpenAI(
-    api_key=os.getenv('ALIYUN_API_KEY'),
-    base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-    model="qwen-turbo",
-    temperature=0.7,
-)
+llm = get_llm("qwen-turbo", temperature=0.7, provider="openai")
 
 # if __name__ == "__main__":
     # print("🤖 正在呼叫通义千问...")
@@ -98,14 +95,17 @@ map_template = """
 """
 
 map_prompt = PromptTemplate.from_template(map_template)
-# --- 4. 手动执行 Map 过程 (为了看清过程) ---
-# 建立一条小流水线： Prompt -> LLM -> 字符串解析
-
-map_chain = map_prompt | llm | StrOutputParser()
-
-input_data = [{'text': doc.page_content} for doc in docs]
-
-map_results = map_chain.batch(input_data)
+# --- 4. 执行 Map 过程 ---
+# 小流水线还是 Prompt -> LLM -> 字符串解析，交给 MapReduceExtractor 来跑：
+#   - 一模一样的块只问一次 (long_text * 5 切出来大半是重复的)
+#   - 结果按 (Prompt, 块指纹) 落盘缓存，第二次运行基本全走缓存
+#   - 限并发 (RAG_MAP_CONCURRENCY) + 失败指数退避重试
+extractor = MapReduceExtractor(map_prompt, llm)
+
+map_results = extractor.map([doc.page_content for doc in docs])
+stats = extractor.stats
+print(f"\n⚡ Map: {stats['chunks']} 块 -> 去重后 {stats['unique_chunks']} 块，"
+      f"命中缓存 {stats['cache_hits']}，实际调用 LLM {stats['llm_calls']} 次，失败 {stats['failed']}")
 
 # --- 5. 展示结果 ---
 print("\n👀 对比一下效果：")
@@ -119,9 +119,9 @@ for i,res in enumerate(map_results):
 
 print("\n🚀 开始 Reduce 阶段 (合并去重 + 转 JSON)...")
 
-# 1. 物理合并：把那几个重复的答案拼成一个长字符串
-# 效果： "产品: Model 2...\n产品: Model 2...\n..."
-combined_text = "\n".join(map_results)
+# 1. 物理合并：reduce 时把答案拼成一个长字符串
+# 拼之前先扔掉“无”和失败的块，一模一样的答案只留一份 -> Reduce 的 Prompt 小很多
+# 真实财报拼完还是太长：按 token 预算 (RAG_REDUCE_TOKEN_BUDGET) 分组并发合并，一层层收拢成一份
 # 2. 定义 Reduce 指令 (这一步最关键)
 reduce_template = """
 这里有一组从长文档中提取的信息片段（其中包含很多重复内容）：
@@ -146,17 +146,22 @@ reduce_template = """
 reduce_prompt = PromptTemplate.from_template(reduce_template)
 # 3. 组装 Reduce 流水线
 # 注意：这里我们把 temperature 设为 0，让 AI 严谨一点，别写错 JSON 格式
-reduce_llm = ChatOpenAI(
-    api_key=os.getenv("ALIYUN_API_KEY"),
-    base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-    model="qwen-turbo",
-    temperature=0  # 👈 严谨模式
-)
+# (和上面的 llm 共用同一个 HTTP 连接池，不会再握一次手)
+reduce_llm = get_llm("qwen-turbo", temperature=0, provider="openai")  # 👈 严谨模式
 
 reduce_chain = reduce_prompt | reduce_llm | StrOutputParser()
 
 # 4. 执行！
-final_json = reduce_chain.invoke({"text": combined_text})
+# 最后一次 Reduce 边生成边解析：就算模型还是包了 ```json 也能解析，} 一出来就断开，
+# 字段不对 (多了 / 类型错) 当场报错，不用等它说完
+final_json = extractor.reduce(
+    map_results, reduce_chain, schema=PRODUCT_SCHEMA,
+    on_partial=lambda partial: print(f"⏳ 生成中: {partial}", end="\r"),
+)
+print()
+print(f"🧹 Reduce 输入: 丢掉 {extractor.stats['dropped']} 条 (“无” / 重复 / 失败)，"
+      f"剩 {extractor.stats['reduce_inputs']} 条，共 {extractor.stats['reduce_chars']} 字；"
+      f"树形合并 {extractor.stats['reduce_levels']} 层，Reduce 调用 {extractor.stats['reduce_calls']} 次")
 
 print("\n📊 最终 JSON 结果：")
 print(final_json)
@@ -62,12 +62,14 @@ note = """
 
 
 
-import os
+import argparse
 from pathlib import Path
 from dotenv import load_dotenv
-from langchain_openai import ChatOpenAI
 from langchain_core.prompts import PromptTemplate
-from langchain_core.output_parsers import JsonOutputParser 
+
+from rag_llm import get_llm
+from rag_batch import BATCH_CONCURRENCY, BATCH_RPM, read_inputs, run_batch
+from rag_structured import COPY_SCHEMA, stream_json
 
 
 
@@ -77,12 +79,8 @@ env_path = current_dir / ".env"
 load_dotenv(dotenv_path=env_path)
 
 
-llm = ChatOpenAI(
-    api_key = os.getenv("ALIYUN_API_KEY"),
-    base_url = 'https://dashscope.aliyuncs.com/compatible-mode/v1',
-    model = 'qwen-turbo',
-    temperature= 0.7# 写文案要有创意，所以温度调高一点点
-)
+# 写文案要有创意，所以温度调高一点点；注册表里的 openai 客户端默认开了 stream_usage (批量跑要记账)
+llm = get_llm('qwen-turbo', temperature=0.7, provider='openai')
 
 
 
@@ -108,7 +106,7 @@ prompt_text = """
 
 输出：
 {{ 
-    "replay":"着风扇太静音了！🔇，办公室午睡神器，这封简直是把润物细无声刻在'DNA'里面了....(此处省略文案)",
+    "reply":"着风扇太静音了！🔇，办公室午睡神器，这封简直是把润物细无声刻在'DNA'里面了....(此处省略文案)",
     "tag":["#好物推荐","#静音风扇","#办公室神器"]
 }}
 
@@ -123,20 +121,67 @@ prompt_text = """
 
 prompt = PromptTemplate.from_template(prompt_text)
 
-chain = prompt | llm | JsonOutputParser()
+# 不再接 JsonOutputParser (要等整段生成完才解析)：交给 stream_json 边生成边解析，
+# 包了 ```json 也认、字段不对当场中止、} 一出来就断开不再等
+chain = prompt | llm
+
+
+def generate_copy(inputs, on_partial=None, drain=False):
+    """-> {"reply": ..., "tag": [...]}；格式不对抛 StructuredOutputError
+    drain=True：} 出来后照样把流读完，拿到模型返回的 token 用量 (批量记账用)"""
+    result, _ = stream_json(chain, inputs, COPY_SCHEMA, on_partial, drain=drain)
+    return result
+
+
+def copy_inputs(row):
+    return {key: row[key] for key in ("platform", "copy_type", "topic")}
+
+
+def show_progress(partial):
+    print(f"⏳ 已生成 {len(partial.get('reply') or '')} 字", end="\r")
+
+
+def main_batch(args):
+    """
+    批量模式：python 2-14.py inputs.jsonl --out results.jsonl --concurrency 8 --rpm 120
+    输入每行要有 platform / copy_type / topic (CSV 就是这三列)，可选 id；中途崩了原样再跑一遍就是续跑
+    """
+    stats = run_batch(
+        read_inputs(args.inputs),
+        lambda row: generate_copy(copy_inputs(row), drain=True),
+        args.out,
+        concurrency=args.concurrency,
+        rpm=args.rpm,
+        # 估算 token 时按真正发出去的整段提示词算 (模板本身就几百字)
+        prompt_text=lambda row: prompt.format(**copy_inputs(row)),
+    )
+    print(f"📊 成功 {stats['ok']}，失败 {stats['error']}，跳过 (之前已完成) {stats['skipped']}；"
+          f"耗时 {stats['elapsed_s']} s，{stats['rows_per_min']} 条/分钟，"
+          f"P50 {stats['latency_p50_ms']:.0f} ms / P95 {stats['latency_p95_ms']:.0f} ms，共 {stats['total_tokens']} tokens")
+
 
 if __name__ == '__main__':
-    result = chain.invoke({
+    parser = argparse.ArgumentParser(description="AI 文案生成器")
+    parser.add_argument("inputs", nargs="?", help="批量任务文件 (.jsonl / .csv)，不传就跑下面两条示例")
+    parser.add_argument("--out", default="copy_results.jsonl", help="结果 JSONL (同时也是断点)")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY)
+    parser.add_argument("--rpm", type=float, default=BATCH_RPM, help="每分钟最多请求数 (按配额来)")
+    args = parser.parse_args()
+    if args.inputs:
+        main_batch(args)
+        raise SystemExit
+
+    result = generate_copy({
         "platform":"小红书",
         "copy_type":"种草笔记",
         "topic":"特斯拉model 2只要2.5万美元，太香了"
-    })
+    }, show_progress)
     print(result)
 
 
-    result1 = chain.invoke({
+    result1 = generate_copy({
         "platform":"知乎",
         "copy_type":"行业分析",
         "topic":"特斯拉推出廉价车型对国产新能源汽车的打击"
-    })
+    }, show_progress)
     print(result1)
\ No newline at end of file
@@ -2,16 +2,16 @@
 
 import streamlit as st
 import os
-import tempfile
 from dotenv import load_dotenv
 # 导入我们的“解题工具”
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 # 加载器和向量库仍在 community 中
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_community.vectorstores import Chroma
+from rag_pdf import load_pdf_pages  # 多进程并行解析，产出和 PyPDFLoader 一样的“一页一个 Document”
+from rag_shared_index import SHARED_INDEXES, document_key, session_holder  # 按内容指纹跨会话共享知识库
+from rag_sessions import estimate_session_bytes
+from rag_store import create_session_store
 from langchain_community.embeddings import DashScopeEmbeddings
-from langchain_community.chat_models import ChatTongyi
 
 from langchain_classic.chains import create_retrieval_chain
 from langchain_classic.chains.combine_documents import create_stuff_documents_chain
@@ -25,14 +25,7 @@ load_dotenv()
 
 
 
-# 新增一个独立的翻译函数 (不走 RAG，直接问大模型)
-# -------------------------------------------------------------
-def translate_to_english(text, api_key):
-    # 使用轻量级模型快速翻译
-    llm_trans = ChatTongyi(model="qwen-turbo", dashscope_api_key=os.getenv('ALIYUN_API_KEY'))
-    # 简单的翻译指令
-    res = llm_trans.invoke(f"Translate the following Chinese text to English. Only output the translation, do not add any explanation: {text}")
-    return res.content
+from rag_llm import get_llm
 
 
 
@@ -43,56 +36,54 @@ st.set_page_config(page_title="ChatPDF Pro", layout="wide")
 
 # --- 2. 页面基础设置 ---
 # --- 3. 核心处理函数 (使用缓存加速) ---
-# @st.cache_resource 保证同一个文件上传后，不会因为你每次提问都重新去切分、建库
-@st.cache_resource
-def process_pdf_and_build_rag(uploaded_file):
+# 同一个文件上传后，不会因为你每次提问都重新去切分、建库；
+# 以前靠 @st.cache_resource，但它的 Key 是 UploadedFile 对象，换个会话 / 重新上传就失效了。
+# 现在按“文件内容指纹”放进跨会话共享的仓库 (有内存预算，会自动淘汰，也能手动释放)
+def process_pdf_and_build_rag(key, uploaded_file):
     """
-    接收上传的文件对象 -> 保存临时文件 -> 读取 -> 切分 -> 建库 -> 返回检索链
+    接收上传的文件对象 -> 读取 -> 切分 -> 建库 -> 返回 (检索链, 估算内存)
     """
-    # A. 处理临时文件 (PyPDFLoader 需要物理路径)
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-        tmp_file.write(uploaded_file.getvalue())
-        tmp_file_path = tmp_file.name
-        try:
-            # B. 加载
-            loader = PyPDFLoader(tmp_file_path)
-            docs = loader.load()
-
-            # C. 切分
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=1000,
-                chunk_overlap=250
-            )
-            splits = text_splitter.split_documents(docs)
-
-            # D. 建库 (自动使用环境变量里的 Key)
-            embeddings = DashScopeEmbeddings(model="text-embedding-v1",dashscope_api_key=os.getenv('ALIYUN_API_KEY'))
-            vectorstore = Chroma.from_documents(documents=splits, embedding=embeddings)
-            retriever = vectorstore.as_retriever(search_kwargs={"k": 6})
-            # E. 构建链
-            system_template = """
-            你是一个专业的分析师。
-            请基于以下检索到的上下文来回答问题。如果你在文中找不到答案，就说不知道。
-            
-            <context>
-            {context}
-            </context>
-            """
-            
-            prompt = ChatPromptTemplate.from_messages([
-                ("system", system_template),
-                ("human", "{input}"),
-            ])
-            llm = ChatTongyi(model="qwen-turbo",dashscope_api_key=os.getenv('ALIYUN_API_KEY')) # 自动读取环境变量 Key
-            
-            question_answer_chain = create_stuff_documents_chain(llm, prompt)
-            rag_chain = create_retrieval_chain(retriever, question_answer_chain)
-            
-            return rag_chain
-
-        finally:
-            # 清理临时文件，保持服务器卫生
-            os.remove(tmp_file_path)
+    # A. 直接在 Streamlit 已经收好的内存缓冲区上解析 (getbuffer() 不拷贝)；
+    #    指纹 document_key 已经在这块缓冲区上算过了 (就是 key)，不用再读一遍、再算一遍
+    #    (以前在 with 块里就把临时文件删了，解析器可能还没读完)
+    with uploaded_file.getbuffer() as view:
+        # B. 加载
+        docs = load_pdf_pages(view, name=uploaded_file.name)
+
+        # C. 切分
+        text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=1000,
+            chunk_overlap=250
+        )
+        splits = text_splitter.split_documents(docs)
+
+        # D. 建库 (自动使用环境变量里的 Key)；每份文档一个独立的 collection
+        embeddings = DashScopeEmbeddings(model="text-embedding-v1",dashscope_api_key=os.getenv('ALIYUN_API_KEY'))
+        texts = [doc.page_content for doc in splits]
+        vectorstore = create_session_store(key, texts, [doc.metadata for doc in splits], embeddings,
+                                           doc_id=uploaded_file.name)
+        retriever = vectorstore.as_retriever(search_kwargs={"k": 6})
+        size_bytes = estimate_session_bytes(len(texts), sum(len(t) for t in texts), 1536)
+        # E. 构建链
+        system_template = """
+        你是一个专业的分析师。
+        请基于以下检索到的上下文来回答问题。如果你在文中找不到答案，就说不知道。
+        
+        <context>
+        {context}
+        </context>
+        """
+        
+        prompt = ChatPromptTemplate.from_messages([
+            ("system", system_template),
+            ("human", "{input}"),
+        ])
+        llm = get_llm("qwen-turbo") # 全进程共用一个客户端，不再每建一次库 new 一个
+        
+        question_answer_chain = create_stuff_documents_chain(llm, prompt)
+        rag_chain = create_retrieval_chain(retriever, question_answer_chain)
+        
+        return rag_chain, size_bytes
 
 # --- 4. 界面 UI 设计 ---
 
@@ -106,9 +97,17 @@ st.markdown("**说明：**\n1. 上传后系统会自动解析\n2. 解析完成
 if uploaded_file:
     # 1. 只有上传了文件，才启动 RAG 系统
     try:
+        key = document_key(uploaded_file)
+        if st.button("🗑️ 释放这份文档的知识库"):
+            SHARED_INDEXES.evict(key, holder=session_holder(st.session_state))
+            st.info("已释放，下次提问会重新构建。")
+            st.stop()
         with st.spinner("正在分析文档，建立知识库... (文档越大越慢，请耐心等待)"):
-            rag_chain = process_pdf_and_build_rag(uploaded_file)
-        st.success(f"✅ 文档《{uploaded_file.name}》解析完成！")
+            # 同样内容的文件，别的会话已经建好了就直接用
+            rag_chain, built = SHARED_INDEXES.get_or_build(
+                key, lambda: process_pdf_and_build_rag(key, uploaded_file), holder=session_holder(st.session_state)
+            )
+        st.success(f"✅ 文档《{uploaded_file.name}》解析完成！" if built else f"✅ 文档《{uploaded_file.name}》已就绪 (复用已经建好的知识库)")
         
         # 2. 聊天界面
         st.markdown("### 💬 第二步：开始提问")
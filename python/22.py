@@ -21,7 +21,6 @@
 
 import streamlit as st
 import os
-import tempfile
 from dotenv import load_dotenv
 
 # --- 1. 基础配置 ---
@@ -34,57 +33,70 @@ if not os.getenv("ALIYUN_API_KEY"):
     st.stop()
 
 # --- 2. 导入组件 ---
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_community.vectorstores import Chroma
+from rag_pdf import load_pdf_pages  # 多进程并行解析，产出和 PyPDFLoader 一样的“一页一个 Document”
+from rag_shared_index import SHARED_INDEXES, document_key, session_holder  # 按内容指纹跨会话共享知识库
+from rag_sessions import estimate_session_bytes
+from rag_store import create_session_store
 from langchain_community.embeddings import DashScopeEmbeddings
-from langchain_community.chat_models import ChatTongyi
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 # 核心链组件
-from langchain_classic.chains import create_retrieval_chain
 from langchain_classic.chains.combine_documents import create_stuff_documents_chain
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.messages import HumanMessage, AIMessage
-
-# 【Day 22 核心组件】历史感知检索器
-from langchain_classic.chains import create_history_aware_retriever
-
-# --- 3. 辅助函数：翻译机 ---
-def translate_to_english(text):
-    """把中文问题转成英文关键词，提高检索准确率"""
-    llm_trans = ChatTongyi(model="qwen-turbo",dashscope_api_key=os.getenv('ALIYUN_API_KEY'))
-    # 简单的翻译指令
-    res = llm_trans.invoke(f"Translate the following Chinese text to English. Only output the translation, do not add any explanation: {text}")
-    return res.content
+# 带 token 预算的对话记忆：最近 N 轮原文 + 滚动摘要
+from rag_history import CompactingHistory
+from langchain_core.output_parsers import StrOutputParser
+
+# --- 3. 辅助函数：问题改写服务 (翻译机) ---
+# 共用一个 LLM 客户端 + 落盘的翻译缓存 + 英文问题直接跳过；翻译和“结合历史改写”并发跑
+# combined 模式 (默认)：有历史时 改写+翻译 合成一次调用；第一轮不改写，只翻译
+from rag_rewrite import REWRITE_MODE, get_query_rewriter
+from rag_llm import get_llm
+
+TRANSLATE_SOURCES = {"ascii": "本来就是英文，跳过", "cache": "命中缓存", "llm": "调用模型"}
+
+
+def merge_documents(rankings, k):
+    """两路检索结果轮流取 (去重)，凑够 k 个"""
+    merged = []
+    seen = set()
+    for rank in range(max(len(r) for r in rankings)):
+        for ranking in rankings:
+            if rank < len(ranking) and ranking[rank].page_content not in seen:
+                seen.add(ranking[rank].page_content)
+                merged.append(ranking[rank])
+    return merged[:k]
 
 # --- 4. 核心处理函数 (带记忆构建) ---
-@st.cache_resource
-def process_pdf_and_build_rag(uploaded_file):
+# 不再用 @st.cache_resource (Key 是 UploadedFile 对象，换个会话 / 重新上传就失效)：
+# 建好的知识库按“文件内容指纹”放进跨会话共享的仓库 (有内存预算，会自动淘汰，也能手动释放)
+def process_pdf_and_build_rag(key, uploaded_file):
     """
-    加载 PDF -> 切分 -> 建库 -> 返回一个【带记忆能力】的 RAG 链
+    加载 PDF -> 切分 -> 建库 -> 返回 (【带记忆能力】的 RAG 组件, 估算内存)
+    key: 文件内容指纹，同时也是 Chroma collection 的名字来源 (不同文档不会混在一个库里)
     """
-    # A. 临时文件处理
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-        tmp_file.write(uploaded_file.getvalue())
-        tmp_file_path = tmp_file.name
-
-    try:
+    # A. 直接在 Streamlit 已经收好的内存缓冲区上解析 (getbuffer() 不拷贝，页数多时照样多进程解析)；
+    #    指纹 document_key 已经在这块缓冲区上算过了 (就是 key)，不用再读一遍、再算一遍
+    with uploaded_file.getbuffer() as view:
         # B. 加载 & 切分
-        loader = PyPDFLoader(tmp_file_path)
-        docs = loader.load()
+        docs = load_pdf_pages(view, name=uploaded_file.name)
         
         text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=250)
         splits = text_splitter.split_documents(docs)
 
         # C. 建库
         embeddings = DashScopeEmbeddings(model="text-embedding-v1",dashscope_api_key=os.getenv('ALIYUN_API_KEY'))
-        vectorstore = Chroma.from_documents(documents=splits, embedding=embeddings)
+        texts = [doc.page_content for doc in splits]
+        vectorstore = create_session_store(key, texts, [doc.metadata for doc in splits], embeddings,
+                                           doc_id=uploaded_file.name)
         retriever = vectorstore.as_retriever(search_kwargs={"k": 6})
+        size_bytes = estimate_session_bytes(len(texts), sum(len(t) for t in texts), 1536)
 
-        llm = ChatTongyi(model="qwen-turbo",dashscope_api_key=os.getenv('ALIYUN_API_KEY')) # 或者 qwen-plus
+        llm = get_llm("qwen-turbo") # 或者 qwen-plus；全进程共用一个客户端 (和改写服务共用连接池)
 
-        # --- D. 【关键升级】构建“历史感知”检索器 ---
+        # --- D. 【关键升级】“历史感知”改写 ---
         # 它的作用：如果用户问“它增长了吗？”，结合历史把它改成“特斯拉的营收增长了吗？”
+        # (以前是 create_history_aware_retriever，改写和翻译只能串行；现在单独拿出来，和翻译并发跑)
         
         contextualize_q_system_prompt = """
         Given a chat history and the latest user question which might reference context in the chat history, 
@@ -98,10 +110,7 @@ def process_pdf_and_build_rag(uploaded_file):
             ("human", "{input}"),
         ])
         
-        # 这个 retriever 会先思考改写问题，再去搜索
-        history_aware_retriever = create_history_aware_retriever(
-            llm, retriever, contextualize_q_prompt
-        )
+        contextualize_chain = contextualize_q_prompt | llm | StrOutputParser()
 
         # --- E. 构建回答链 ---
         
@@ -127,14 +136,9 @@ def process_pdf_and_build_rag(uploaded_file):
         
         question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
         
-        # 将“聪明检索器”和“回答链”串起来
-        rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
-        
-        return rag_chain
+        # 检索器、改写链、回答链分开返回：提问时 改写+翻译 并发 -> 两路检索 -> 回答
+        return (retriever, contextualize_chain, question_answer_chain), size_bytes
 
-    finally:
-        if os.path.exists(tmp_file_path):
-            os.remove(tmp_file_path)
 
 # --- 5. 界面 UI ---
 
@@ -148,11 +152,19 @@ with st.sidebar:
 
 # 主逻辑
 if uploaded_file:
-    # 1. 启动
+    # 1. 启动 (同样内容的文件，别的会话已经建好了就直接用)
+    key = document_key(uploaded_file)
+    with st.sidebar:
+        if st.button("🗑️ 释放这份文档的知识库"):
+            SHARED_INDEXES.evict(key, holder=session_holder(st.session_state))
+            st.info("已释放，下次提问会重新构建。")
+            st.stop()
     try:
         with st.spinner("正在构建知识库..."):
-            rag_chain = process_pdf_and_build_rag(uploaded_file)
-        st.success("✅ 大脑已就绪！")
+            (retriever, contextualize_chain, question_answer_chain), built = SHARED_INDEXES.get_or_build(
+                key, lambda: process_pdf_and_build_rag(key, uploaded_file), holder=session_holder(st.session_state)
+            )
+        st.success("✅ 大脑已就绪！" if built else "✅ 大脑已就绪！(复用已经建好的知识库)")
     except Exception as e:
         st.error(f"出错啦: {e}")
         st.stop()
@@ -161,9 +173,9 @@ if uploaded_file:
     # 界面显示用
     if "messages" not in st.session_state:
         st.session_state.messages = []
-    # LangChain 记忆专用 (存对象)
+    # LangChain 记忆专用 (存对象)：最近几轮原文 + 更早的滚动摘要，有 token 预算，越聊越长也不会撑爆 Prompt
     if "chat_history" not in st.session_state:
-        st.session_state.chat_history = []
+        st.session_state.chat_history = CompactingHistory()
 
     # 3. 显示历史
     for msg in st.session_state.messages:
@@ -181,20 +193,51 @@ if uploaded_file:
         with st.chat_message("assistant"):
             with st.status("🧠 AI 正在思考...", expanded=True) as status:
                 
-                # Step 1: 翻译 (为了搜得准)
-                status.write("🔄 1. 正在优化搜索关键词 (中->英)...")
-                english_query = translate_to_english(user_input)
-                status.write(f"🇺🇸 检索词: *{english_query}*")
+                # Step 1: 改写 (为了搜得准)：结合历史改写 + 中->英翻译
+                status.write("🔄 1. 正在优化搜索关键词 (结合上下文 + 中->英)...")
+                chat_history = st.session_state.chat_history.messages()
+                if REWRITE_MODE == "combined":
+                    # 一次调用直接拿到英文的独立检索词；第一轮没有历史，只翻译
+                    rewrite = get_query_rewriter().contextualize_and_translate(user_input, chat_history)
+                else:
+                    # parallel：改写和翻译两次调用并发跑 (第一轮没有历史，不用改写)
+                    contextualize = None
+                    if chat_history:
+                        contextualize = lambda q: contextualize_chain.invoke({"input": q, "chat_history": chat_history})
+                    rewrite = get_query_rewriter().rewrite(user_input, contextualize)
+                status.write(f"🇺🇸 检索词: *{rewrite.english}*")
+                if rewrite.standalone != user_input:
+                    status.write(f"🧩 独立问题: *{rewrite.standalone}*")
+                if rewrite.translate_source == "combined":
+                    status.write(f"⏱️ 本轮改写多花了 {rewrite.total_ms:.0f}ms (上下文改写 + 翻译合成一次调用)")
+                else:
+                    status.write(
+                        f"⏱️ 本轮改写多花了 {rewrite.total_ms:.0f}ms "
+                        f"(翻译 {rewrite.translate_ms:.0f}ms，{TRANSLATE_SOURCES[rewrite.translate_source]}；"
+                        f"上下文改写 {rewrite.contextualize_ms:.0f}ms)"
+                    )
                 
+                memory = st.session_state.chat_history.stats()
+                if memory["turns"]:
+                    status.write(
+                        f"🧠 记忆: 最近 {memory['verbatim_turns']} 轮原文 + {memory['folded_turns']} 轮摘要，"
+                        f"约 {memory['prompt_tokens']} tokens"
+                    )
+
                 # Step 2: 检索 + 生成 (带记忆)
                 status.write("🔍 2. 结合上下文检索文档...")
                 
                 # --- 关键调用 ---
-                # 同时传入 input (当前问题) 和 chat_history (过去的历史)
-                response = rag_chain.invoke({
-                    "input": english_query, 
-                    "chat_history": st.session_state.chat_history
+                # 英文检索词 (搜英文财报) 和 独立问题 (代词已经补全) 两路一起搜，合并去重
+                queries = list(dict.fromkeys([rewrite.english, rewrite.standalone]))
+                context = merge_documents(retriever.batch(queries), k=6)
+                # 回答时传入 input (用户原话)、chat_history (过去的历史) 和 检索到的 context
+                answer = question_answer_chain.invoke({
+                    "input": user_input,
+                    "chat_history": chat_history,
+                    "context": context,
                 })
+                response = {"answer": answer, "context": context}
                 
                 status.update(label="✅ 分析完成", state="complete", expanded=False)
             
@@ -213,10 +256,8 @@ if uploaded_file:
         
         # 存入 LangChain 记忆 (注意：存的是英文 query 还是中文 query？)
         # 策略：为了让 AI 理解用户的中文追问，这里存【中文原话】会更自然，因为我们在内部用 LLM 做改写
-        st.session_state.chat_history.extend([
-            HumanMessage(content=user_input), # 存中文，因为改写器能看懂中文
-            AIMessage(content=answer)
-        ])
+        # 超出窗口的旧轮次会在后台折叠进摘要 (增量更新，不从头总结)
+        st.session_state.chat_history.add_turn(user_input, answer) # 存中文，因为改写器能看懂中文
 
 else:
     st.info("👈 请先上传 PDF 文件")
\ No newline at end of file
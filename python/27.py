@@ -8,11 +8,15 @@
 
 
 
+import asyncio
+import hashlib
 import os
-import shutil
-import tempfile
 import time # <--- 新增这行
-from fastapi import FastAPI,UploadFile,File,Form,HTTPException
+import weakref
+from contextlib import aclosing, asynccontextmanager
+from functools import partial
+from fastapi import FastAPI,UploadFile,File,Form,HTTPException,Request
+from fastapi.concurrency import iterate_in_threadpool, run_in_threadpool
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
@@ -20,15 +24,49 @@ from dotenv import load_dotenv
 
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import DashScopeEmbeddings
-from langchain_community.chat_models import ChatTongyi
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_classic.chains import create_retrieval_chain
 from langchain_classic.chains.combine_documents import create_stuff_documents_chain
 from langchain_core.prompts import ChatPromptTemplate
 
+# 入库缓存：同一份 PDF 再次上传时，直接复用切好的块和向量
+from rag_cache import chunk_hash
+# 入库流水线：解析 -> 切分 -> Embedding (纯计算，可以丢到线程池/进程池)
+from rag_ingest import CHUNK_SIZE, EMBEDDING_DIM, get_embeddings, ingest_pdf, report
+# 后台入库任务：/upload 马上返回 job_id，前端轮询 /upload/{job_id} 看进度
+from rag_jobs import ingest_jobs_from_env
+# 答案缓存：同一份文档的同一个问题，不再重复检索 + 生成
+from rag_answer_cache import answer_cache_from_env, normalize_query, replay_stream
+# 向量库持久化：每个 session 一个落盘的 collection，重启后按需懒加载
+# 混合检索：BM25 关键词 + 向量语义，RRF 融合 (专有名词不再漏召回，k 也能调小)
+from rag_hybrid import RETRIEVER_MODE, BM25Index, HybridRetriever
+# LLM 工厂：RAG_LLM_BACKEND=fake 时用本地假模型 (压测用)
+from rag_llm import get_llm, warm_up_in_background
+# SSE 编码：token 攒批成 data 帧，结束发 done 事件 (来源 + 耗时)，空闲时发保活注释
+from rag_sse import sse_stream
+# 增量更新：一个 session 多份文档，按 doc_id 追加 / 替换 / 删除，没变的块不重新 Embedding
+from rag_store import (
+    DocumentWriter,
+    delete_document,
+    find_session_store,
+    get_session_store,
+    keep_only,
+    list_session_documents,
+    lookup_chunk_vectors,
+    open_session_store,
+    release_session_store,
+    session_chunk_hashes,
+    session_chunks,
+    tag_chunks,
+    upsert_document,
+)
+# 准入控制：入库 / 聊天 / 流式 分池限并发，按 session 轮流放行，排满了直接 429
+from rag_admission import AdmissionRejected, admission_pools_from_env
+# 请求合并：同一份文档的同一个问题同时来了几十个，只跑一次检索 + 生成，流式的大家共享同一个 token 流
+from rag_singleflight import SingleFlight, StreamFlights
+# Session 仓库：有内存预算，LRU + 闲置过期，被踢掉的 session 能从磁盘恢复
+from rag_sessions import estimate_session_bytes, session_store_from_env
+# 上传：边收边算指纹，小文件留内存、大文件才落盘
+from rag_upload import spool_upload
 
 
 
@@ -46,11 +84,48 @@ app.add_middleware(
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=['*'],
-    allow_headers=['*']
+    allow_headers=['*'],
+    # 429 带的 Retry-After 不在跨域默认能读的响应头里，要显式放出来前端才拿得到
+    expose_headers=['Retry-After'],
 )
 
+
+@app.on_event("startup")
+def warm_up_llm():
+    # 后台先把到模型接口的连接建好 (TCP + TLS)，第一个提问的用户不用等握手
+    warm_up_in_background()
+
 # --- 2. 核心架构：全局仓库 (Global Storage) ---
-RAG_CHAINS = { }  # 用于存储每个用户的 RAG Chain 实例   
+# 用于存储每个用户的 RAG Chain 实例 (不再是无限增长的 dict，见 rag_sessions.py)
+# 被踢出去的 session，下次提问时通过 load_session_from_disk 重新捞回来
+# 请求 / 入库任务用着某个 session 的库时先 RAG_CHAINS.lease 借着，被踢出去也等用完了再关库；
+# 同一个 session 的写操作 (整库替换 / 增量更新 / 删除) 用 RAG_CHAINS.write_lock 排队，防止两个任务互相覆盖
+RAG_CHAINS = session_store_from_env(
+    loader=lambda session_id: load_session_from_disk(session_id),
+    on_evict=release_session_store,
+)
+
+# 准入池 (RAG_ADMIT_{INGEST,CHAT,STREAM}_CONCURRENCY / _QUEUE，见 rag_admission.py)
+# 入库再重也只占 ingest 池的名额，聊天和流式各有各的，互不抢
+ADMISSION = admission_pools_from_env()
+
+# 入库任务池 (RAG_INGEST_WORKERS / RAG_INGEST_POOL=thread|process)
+# 排队的任务也各占一个调度线程等放行，所以线程数 = ingest 池的并发 + 队列长度
+INGEST_JOBS = ingest_jobs_from_env(threads=ADMISSION["ingest"].concurrency + ADMISSION["ingest"].max_queue)
+
+# 答案缓存 (RAG_ANSWER_CACHE_SIZE / _TTL / _SIMILARITY)
+# 按“文档内容”分区：几百个 session 传的是同一份财报，就共用同一份答案
+ANSWER_CACHE = answer_cache_from_env(embed_fn=lambda query: get_embeddings().embed_query(query))
+# 同一时刻的同一个问题只跑一次 (RAG_SINGLE_FLIGHT=0 关掉)
+SINGLE_FLIGHT_ENABLED = os.getenv("RAG_SINGLE_FLIGHT", "1") != "0"
+CHAT_FLIGHTS = SingleFlight()
+STREAM_FLIGHTS = StreamFlights()
+SESSION_SCOPES = {}  # session_id -> 文档指纹；服务重启后丢了也没关系，退回按 session 分区
+# collection 名 -> 当前链里的 BM25 索引 (弱引用：链被踢出内存，索引跟着回收)，增量更新时原地改它
+SESSION_INDEXES = weakref.WeakValueDictionary()
+
+# 流式模式：async (默认，chain.astream，不占线程) / sync (老写法，chain.stream，每个流占一个线程)
+STREAM_MODE = os.getenv("RAG_STREAM_MODE", "async")
 
 class ChatRequest(BaseModel):
     session_id: str = "default_user"
@@ -59,23 +134,43 @@ class ChatRequest(BaseModel):
 
 
 # --- 4. 核心逻辑函数 (只负责造大脑，不负责网络) ---
-def build_rag_chain_from_file(local_pdf_path):
-    print(f"⚙️ 开始处理文件: {local_pdf_path} ...")
-    # A. 加载
-    pdf = PyPDFLoader(local_pdf_path)
-    docs = pdf.load()
-    print("⚙️ 正在调用 tempfile11...")
-    # 切分
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000,chunk_overlap=200)
-    splits = text_splitter.split_documents(docs)
-    print(f"📄 文档已切分为 {len(splits)} 段。")
-
-    print("⚙️ 正在调用 tempfile22...")
-    # 建库
-    embeddings = DashScopeEmbeddings(model="text-embedding-v1", dashscope_api_key=os.getenv("ALIYUN_API_KEY"))
-    vectorstore = Chroma.from_documents(documents=splits,embedding=embeddings)
-    retriever = vectorstore.as_retriever(search_kwargs={"k":5})
-    print("⚙️ 正在调用 tempfile33...")
+def write_document(vectorstore, doc_id, result, writer):
+    """
+    入库任务收尾时写库 (调用前已拿到 RAG_CHAINS.write_lock(session_id))：
+    线程模式下 writer (ingest_pdf 的 sink) 已经边算边把新块写进去了，这里只补没写的：
+    进程池模式整本算完才返回的向量、跳过 Embedding 的块 (向量从库里取回来；万一这期间被别的任务删掉了，就现算)，
+    再删掉这份文档新版本里没有的块。返回 (delta, changes, 复用向量的块数)
+    """
+    texts, metadatas, vectors = result
+    if vectors is None:
+        vectors = [None] * len(texts)
+    ids, _ = tag_chunks(doc_id, texts, metadatas)
+    hashes = [chunk_hash(t) for t in texts]
+    skipped = [n for n, v in enumerate(vectors) if v is None and ids[n] not in writer.written]
+    reused = lookup_chunk_vectors(vectorstore, {hashes[n] for n in skipped})
+    lost = [n for n in skipped if hashes[n] not in reused]
+    if lost:
+        for n, vector in zip(lost, get_embeddings().embed_documents([texts[n] for n in lost])):
+            reused[hashes[n]] = vector
+    vectors = [v if v is not None else reused.get(h) for v, h in zip(vectors, hashes)]
+    delta, changes = upsert_document(vectorstore, doc_id, texts, metadatas, vectors, written=writer.created)
+    return delta, changes, len(skipped) - len(lost)
+
+
+def build_retriever(vectorstore, ids=None, texts=None, metadatas=None):
+    """检索器：默认 BM25 + 向量混合召回；RAG_RETRIEVER=vector 退回老的纯向量检索"""
+    if RETRIEVER_MODE != "hybrid":
+        return vectorstore.as_retriever(search_kwargs={"k":5})
+    if texts is None:
+        ids, texts, metadatas = session_chunks(vectorstore)
+    index = BM25Index.from_texts(texts, metadatas, keys=ids)
+    SESSION_INDEXES[vectorstore._collection.name] = index
+    return HybridRetriever(vectorstore=vectorstore, index=index)
+
+
+def build_chain_from_vectorstore(vectorstore, ids=None, texts=None, metadatas=None):
+    """有了向量库之后的部分：检索器 + Prompt + LLM (上传时和从磁盘恢复时共用)"""
+    retriever = build_retriever(vectorstore, ids, texts, metadatas)
 
     # D. 构建链 (简单的问答链，暂不加复杂记忆，保证先跑通)
     # 找到 system_prompt，替换成下面这段：
@@ -97,7 +192,7 @@ def build_rag_chain_from_file(local_pdf_path):
     prompt = ChatPromptTemplate.from_messages([("system",system_prompt),("human","{input}"),])
     print("⚙️ 正在调用 tempfile44...")
 
-    llm = ChatTongyi(model="qwen-turbo",dashscope_api_key=os.getenv("ALIYUN_API_KEY"))
+    llm = get_llm("qwen-turbo")
     print("⚙️ 正在调用 tempfile55...")
     question_answer_chain = create_stuff_documents_chain(llm,prompt)
     rag_chain = create_retrieval_chain(retriever,question_answer_chain)
@@ -106,6 +201,161 @@ def build_rag_chain_from_file(local_pdf_path):
     return rag_chain
 
 
+def load_session_from_disk(session_id):
+    """
+    内存里没有这个 session (服务刚重启，或者被 LRU 踢掉了)，但磁盘上有 -> 从磁盘打开，重建链
+    返回 (rag_chain, 估算内存)；磁盘上也没有就返回 None
+    """
+    vectorstore = open_session_store(session_id, get_embeddings())
+    if vectorstore is None:
+        return None
+
+    num_chunks = vectorstore._collection.count()
+    if num_chunks == 0:
+        # 文档都被删光了，当成没上传过
+        return None
+    print(f"💾 从磁盘恢复 session {session_id} 的知识库...")
+    size_bytes = estimate_session_bytes(num_chunks, num_chunks * CHUNK_SIZE, EMBEDDING_DIM)
+    return build_chain_from_vectorstore(vectorstore), size_bytes
+
+
+def document_scope(chunk_hashes):
+    """答案缓存的分区 Key：同样的一组块 = 同样的知识库 (和上传顺序、分几次上传都无关)"""
+    digest = hashlib.sha256("\n".join(sorted(set(chunk_hashes))).encode("utf-8")).hexdigest()
+    return f"doc:{digest}"
+
+
+def answer_scope(session_id):
+    return SESSION_SCOPES.get(session_id, f"session:{session_id}")
+
+
+def flight_key(session_id, query):
+    """合并请求的 Key：和答案缓存一样按文档分区，问题做同样的规范化"""
+    return answer_scope(session_id), normalize_query(query)
+
+
+def too_busy(e):
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+
+def admit(pool, session_id):
+    """拿一张准入票 (还没放行，只是排上队)；队列满了直接 429，带 Retry-After"""
+    try:
+        return ADMISSION[pool].enqueue(session_id)
+    except AdmissionRejected as e:
+        raise too_busy(e)
+
+
+@asynccontextmanager
+async def admitted(pool, session_id):
+    """排队等放行 (排太久也是 429)，退出时归还名额"""
+    ticket = admit(pool, session_id)
+    try:
+        await ticket.wait_async(ticket.pool.max_wait)
+    except AdmissionRejected as e:
+        raise too_busy(e)
+    try:
+        yield ticket
+    finally:
+        ticket.release()
+
+
+async def release_when_done(release, tokens):
+    """流式生成跑完 (或者被取消) 才归还 (stream 池的名额 / session 的借用)"""
+    try:
+        async with aclosing(tokens) as stream:
+            async for token in stream:
+                yield token
+    finally:
+        release()
+
+
+def format_sources(context):
+    return [doc.page_content[:50] + "..." for doc in context]
+
+
+def get_rag_chain(session_id):
+    """取出某个 session 的大脑；没上传过 (内存、磁盘都没有) 返回 None"""
+    return RAG_CHAINS.get(session_id)
+
+
+def refresh_session(session_id, vectorstore, changes):
+    """
+    增量更新之后收尾 (调用前已拿到 RAG_CHAINS.write_lock(session_id))：
+    向量这一路查的就是这个 collection，新块立刻可见；内存里已经有这个 session 的链，
+    就只把变了的块在 BM25 索引里增删 (不重建索引、不重建链)，再更新内存估算 + 答案缓存分区。
+    链不在内存里 (第一份文档 / 被踢出去了) 才从库里整个建一次。
+    """
+    num_chunks = vectorstore._collection.count()
+    if num_chunks == 0:
+        RAG_CHAINS.pop(session_id)
+        SESSION_SCOPES.pop(session_id, None)
+        ANSWER_CACHE.invalidate(f"session:{session_id}")
+        return
+    chain = RAG_CHAINS.get(session_id) if session_id in RAG_CHAINS else None
+    index = SESSION_INDEXES.get(vectorstore._collection.name)
+    if chain is not None and RETRIEVER_MODE == "hybrid" and index is not None:
+        index.apply_changes(changes)
+    elif chain is None:
+        chain = build_chain_from_vectorstore(vectorstore)
+    RAG_CHAINS.put(session_id, chain, estimate_session_bytes(num_chunks, num_chunks * CHUNK_SIZE, EMBEDDING_DIM))
+    # 知识库变了：答案缓存切到新的分区，旧的按 session 分区的答案作废
+    SESSION_SCOPES[session_id] = document_scope(session_chunk_hashes(vectorstore))
+    ANSWER_CACHE.invalidate(f"session:{session_id}")
+
+
+async def submit_document_job(session_id, doc_id, file):
+    """追加 / 替换一份文档：只有库里没有的块才去 Embedding，只有变了的块才写库"""
+    ticket = admit("ingest", session_id)
+    # 任务结束 (cleanup_ingest) 之前一直借着这个 session，中途被踢出内存也不关库
+    RAG_CHAINS.acquire(session_id)
+    try:
+        upload = await run_in_threadpool(spool_upload, file.file)
+        vectorstore = get_session_store(session_id, get_embeddings())
+        # 整个 session 里已有的块指纹 (一起传给后台任务；进程池里的 work 碰不到 Chroma)
+        known_hashes = await run_in_threadpool(session_chunk_hashes, vectorstore)
+    except BaseException:
+        RAG_CHAINS.release(session_id)
+        ticket.cancel()
+        raise
+
+    # 线程模式：每算完一批向量就写进库 (新块马上能被向量检索搜到)；进程池模式碰不到 Chroma，只能整本算完再写
+    writer = DocumentWriter(vectorstore, doc_id)
+    committed = []
+
+    def finish(result, progress):
+        texts = result[0]
+        report(progress, "index", 0, len(texts))
+        with RAG_CHAINS.write_lock(session_id):
+            delta, changes, reused = write_document(vectorstore, doc_id, result, writer)
+            committed.append(True)
+            # BM25 索引、内存估算、答案缓存分区这些账在这里一次记
+            refresh_session(session_id, vectorstore, changes)
+        report(progress, "index", len(texts), len(texts))
+        print(f"🧩 session {session_id} 的文档 {doc_id}: 新增 {delta['added']} 块，删除 {delta['removed']} 块，"
+              f"保留 {delta['kept']} 块，复用向量 {reused} 个")
+        return {"doc_id": doc_id, **delta, "reused_vectors": reused}
+
+    work = partial(ingest_pdf, upload.source, file_sha256=upload.sha256, name=file.filename,
+                   known_hashes=known_hashes, sink=None if INGEST_JOBS.use_processes else writer)
+    return INGEST_JOBS.submit(session_id, file.filename, work, finish,
+                              partial(cleanup_ingest, session_id, upload, writer, committed), ticket)
+
+
+def cleanup_ingest(session_id, upload, writer, committed):
+    """
+    入库任务结束 (不管成没成功)：释放上传的文件；没走到写库那一步就失败了，把边算边写进去的块撤掉；
+    最后把 session 还回去
+    """
+    try:
+        upload.close()
+        if not committed and writer.created:
+            with RAG_CHAINS.write_lock(session_id):
+                writer.rollback()
+            print(f"↩️ session {session_id} 的入库任务没完成，已撤掉写了一半的块")
+    finally:
+        RAG_CHAINS.release(session_id)
+
 
 
 
@@ -114,83 +364,308 @@ def build_rag_chain_from_file(local_pdf_path):
 @app.post("/upload")
 
 async def upload_pdf(session_id: str = Form('default_user'), file: UploadFile = File(...)):
-    # 1. 保存上传的文件到临时目录
-    # (FastAPI 接收的是内存流，PyPDFLoader 需要物理路径，所以要存一下)
-    with tempfile.NamedTemporaryFile(delete=False,suffix='.pdf') as tmp_file:
-        shutil.copyfileobj(file.file,tmp_file)
-        tmp_path = tmp_file.name
+    # 0. 先排上 ingest 池的队 (满了 / 这个 session 排了太多，直接 429)；后台任务拿到放行才开始干活
+    ticket = admit("ingest", session_id)
+
+    # 1. 把上传流读一遍：同时算好指纹；小文件留在内存，大文件才落盘 (多进程解析要路径)
+    #    读文件是阻塞 IO，放到线程池里，别卡住事件循环
+    #    (从这里到任务结束一直借着这个 session，中途被踢出内存也不关库)
+    RAG_CHAINS.acquire(session_id)
     try:
-        print("⚙️ 正在调用 tempfile...")
-        
-        # 2. 调用上面的逻辑函数，生成 AI 大脑
-        rag_chain = build_rag_chain_from_file(tmp_path)
-        # 3. 把造好的大脑存进全局字典
-        RAG_CHAINS[session_id] = rag_chain
-        return {
-            "message": "PDF 处理成功！大脑已激活，可以开始提问了。",
-            "filename":file.filename,
-            "session_id":session_id
-        }
-    
-    except Exception as e :
-        print(f"出错: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        # 4. 清理垃圾 (删除那个临时存的 PDF)
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
+        upload = await run_in_threadpool(spool_upload, file.file)
+        vectorstore = await run_in_threadpool(get_session_store, session_id, get_embeddings())
+    except BaseException:
+        RAG_CHAINS.release(session_id)
+        ticket.cancel()
+        raise
+
+    # 2. 真正的重活 (解析/切分/Embedding) 交给后台任务池，不再卡住事件循环
+    #    线程模式下每算完一批向量就写进 session 的库 (writer)，写完就能被搜到；
+    #    work 跑在别的进程里时碰不到 Chroma，只做纯计算，整本算完在 finish 里一起写
+    #    旧文档在新文档写完之前一直能查；finish 里再把旧块删掉、建链、存仓库
+    writer = DocumentWriter(vectorstore, file.filename)
+    committed = []
+
+    def finish(result, progress):
+        texts, metadatas, _ = result
+        report(progress, "index", 0, len(texts))
+        with RAG_CHAINS.write_lock(session_id):
+            write_document(vectorstore, file.filename, result, writer)
+            # 整库替换：这份文档以外的块全部删掉
+            ids, tagged = tag_chunks(file.filename, texts, metadatas)
+            keep_only(vectorstore, ids)
+            committed.append(True)
+            # 入库时顺手把 BM25 倒排索引也建好 (块文本现成的，不用再从库里读；key 和库里的块 id 一致)
+            rag_chain = build_chain_from_vectorstore(vectorstore, ids, texts, tagged)
+            size_bytes = estimate_session_bytes(len(texts), sum(len(t) for t in texts), EMBEDDING_DIM)
+            # 把造好的大脑存进全局仓库 (超预算会自动踢掉最久没用的 session)
+            RAG_CHAINS.put(session_id, rag_chain, size_bytes)
+            # 文档换了：答案缓存切到新文档的分区，旧的按 session 分区的答案作废
+            SESSION_SCOPES[session_id] = document_scope(chunk_hash(t) for t in texts)
+            ANSWER_CACHE.invalidate(f"session:{session_id}")
+        report(progress, "index", len(texts), len(texts))
+
+    # 3. 清理垃圾 (释放内存 / 删除落盘的临时 PDF；没做完就撤掉写了一半的块)
+    work = partial(ingest_pdf, upload.source, file_sha256=upload.sha256, name=file.filename,
+                   sink=None if INGEST_JOBS.use_processes else writer)
+    job_id = INGEST_JOBS.submit(session_id, file.filename, work, finish,
+                                partial(cleanup_ingest, session_id, upload, writer, committed), ticket)
+    return {
+        "message": "PDF 已收到，正在后台处理，请用 job_id 查询进度。",
+        "job_id": job_id,
+        "filename":file.filename,
+        "session_id":session_id
+    }
+
+
+# --- 多文档 session：增量 追加 / 替换 / 删除 (/upload 仍然是整库替换) ---
+@app.get("/documents")
+def list_documents(session_id: str = 'default_user'):
+    # 只读：没上传过的 session 不建目录、不建 collection
+    with RAG_CHAINS.lease(session_id):
+        vectorstore = find_session_store(session_id, get_embeddings())
+        documents = list_session_documents(vectorstore) if vectorstore is not None else []
+    return {"session_id": session_id, "documents": documents}
+
+
+@app.post("/documents")
+async def add_document(session_id: str = Form('default_user'), doc_id: str = Form(None), file: UploadFile = File(...)):
+    # 追加一份文档 (doc_id 默认用文件名；同名文档已存在就是替换)
+    doc_id = doc_id or file.filename
+    job_id = await submit_document_job(session_id, doc_id, file)
+    return {"message": "文档已收到，正在后台增量入库。", "job_id": job_id, "doc_id": doc_id, "session_id": session_id}
+
+
+@app.put("/documents/{doc_id}")
+async def replace_document(doc_id: str, session_id: str = Form('default_user'), file: UploadFile = File(...)):
+    # 替换一份已有的文档：没变的块原地保留，只重新 Embedding 变了的块
+    with RAG_CHAINS.lease(session_id):
+        vectorstore = find_session_store(session_id, get_embeddings())
+        documents = await run_in_threadpool(list_session_documents, vectorstore) if vectorstore is not None else []
+    if not any(d["doc_id"] == doc_id for d in documents):
+        raise HTTPException(status_code=404, detail="找不到这个文档")
+    job_id = await submit_document_job(session_id, doc_id, file)
+    return {"message": "文档已收到，正在后台增量替换。", "job_id": job_id, "doc_id": doc_id, "session_id": session_id}
+
+
+@app.delete("/documents/{doc_id}")
+def remove_document(doc_id: str, session_id: str = 'default_user'):
+    with RAG_CHAINS.lease(session_id):
+        return delete_session_document(doc_id, session_id)
+
+
+def delete_session_document(doc_id, session_id):
+    vectorstore = find_session_store(session_id, get_embeddings())
+    if vectorstore is None:
+        raise HTTPException(status_code=404, detail="找不到这个文档")
+    with RAG_CHAINS.write_lock(session_id):
+        removed = delete_document(vectorstore, doc_id)
+        if not removed:
+            raise HTTPException(status_code=404, detail="找不到这个文档")
+        refresh_session(session_id, vectorstore, {"removed": removed})
+    return {"doc_id": doc_id, "session_id": session_id, "removed": len(removed)}
+
+
+@app.get("/upload/{job_id}")
+def upload_status(job_id: str):
+    # 查询入库进度：status = queued / running / done / failed，stages 里是每个阶段的 done/total
+    job = INGEST_JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="找不到这个任务")
+    return job
 
 
 
 @app.post("/chat")
-def chat(request:ChatRequest):
-    # 先查这个户口有没有上传过
-    if request.session_id not in RAG_CHAINS:
+async def chat(request:ChatRequest):
+    # 回答期间一直借着这个 session：中途被 LRU 踢出去，底层的库也等答完再释放
+    with RAG_CHAINS.lease(request.session_id):
+        return await answer_chat(request)
+
+
+async def answer_chat(request):
+    # 先查这个户口有没有上传过 (内存没有会去磁盘找)
+    # (改成 async + 线程池：排队等 chat 池放行时不占线程，不会把线程池堵死)
+    brain = await run_in_threadpool(get_rag_chain, request.session_id)
+    if brain is None:
         raise HTTPException(status_code = 400, detail="请先上传文件")
-    
-    # 取出大脑
-    brain = RAG_CHAINS[request.session_id]
 
     print(f"💬 用户 {request.session_id} 问: {request.query}")
 
-    # 3. 思考 (Invoke)
+    # 先查答案缓存：同一份文档问过同样的问题，直接返回
+    scope = answer_scope(request.session_id)
+    cached = await run_in_threadpool(ANSWER_CACHE.get, scope, request.query)
+    if cached is not None:
+        print("⚡ 命中答案缓存")
+        return {"answer": cached["answer"], "sources": cached["sources"], "cached": True}
 
-    response = brain.invoke({"input":request.query})
+    # 3. 思考 (Invoke)
+    def answer():
+        response = brain.invoke({"input":request.query})
+        # 这里我们也把参考来源返回去，显得专业
+        sources = format_sources(response["context"])
+        ANSWER_CACHE.put(scope, request.query, response["answer"], sources,
+                         context_text="".join(doc.page_content for doc in response["context"]))
+        return response["answer"], sources
+
+    # 别人正在问同一个问题：不再自己检索 + 生成，等它的结果 (搭车的不占 chat 池的名额)
+    # 谁是 leader 由 join 在锁里一次定下来，只有 leader 去排队拿 chat 池的名额；
+    # leader 被拒 (429) 或者出错，跟着它的人收到同样的结果
+    key = flight_key(request.session_id, request.query)
+    if SINGLE_FLIGHT_ENABLED:
+        future, leader = CHAT_FLIGHTS.join(key)
+        if leader:
+            try:
+                async with admitted("chat", request.session_id):
+                    answer_text, sources = await run_in_threadpool(answer)
+            except BaseException as e:
+                CHAT_FLIGHTS.finish(key, future, error=e)
+                raise
+            CHAT_FLIGHTS.finish(key, future, (answer_text, sources))
+        else:
+            print("🤝 合并到正在进行的同一个问题")
+            # shield：搭车的人自己断开时，别把 leader 的 future 一起取消了
+            answer_text, sources = await asyncio.shield(asyncio.wrap_future(future))
+    else:
+        async with admitted("chat", request.session_id):
+            answer_text, sources = await run_in_threadpool(answer)
 
     # 3. 假装回答
     return {
-        "answer": response["answer"],
-        # 这里我们也把参考来源返回去，显得专业
-        "sources":[doc.page_content[:50] + "..." for doc in response["context"]]
+        "answer": answer_text,
+        "sources": sources,
+        "cached": False,
     }
 
 
 # --- 新增：流式提问接口 (Day 25 核心) ---
 @app.post('/chat/stream')
-async def chat_stream(request:ChatRequest):
-    # 1. 检查 Session
-    if request.session_id not in RAG_CHAINS:
+async def chat_stream(request:ChatRequest, http_request: Request):
+    # 借着这个 session 直到返回响应；真开始生成的那一路另外再借一次，生成完才还 (见 start_generation)
+    with RAG_CHAINS.lease(request.session_id):
+        return await stream_chat(request, http_request)
+
+
+async def stream_chat(request, http_request):
+    # 1. 检查 Session (可能要从磁盘恢复，放到线程池里，别卡住事件循环)
+    chain = await run_in_threadpool(get_rag_chain, request.session_id)
+    if chain is None:
         raise HTTPException(status_code=400, detail="请先上传 PDF 文件！")
     
-    chain = RAG_CHAINS[request.session_id]
-    
     print(f"🌊 用户 {request.session_id} 正在进行流式提问: {request.query}")
+
+    # 命中答案缓存：把完整答案切成小块“回放”，前端照样是流式体验
+    scope = answer_scope(request.session_id)
+    cached = await run_in_threadpool(ANSWER_CACHE.get, scope, request.query)
+    if cached is not None:
+        print("⚡ 命中答案缓存，回放")
+        meta = {"sources": cached["sources"], "cached": True}
+        return StreamingResponse(
+            sse_stream(iterate_in_threadpool(replay_stream(cached["answer"])), meta),
+            media_type="text/event-stream",
+        )
+
+    # 生成器跑完之前把参考来源写进来，SSE 编码器最后随 done 事件发给前端
+    meta = {"sources": [], "cached": False}
+
+    def save_answer(meta, answer_parts, context):
+        meta["sources"] = format_sources(context)
+        # 完整生成完才写缓存 (中途断开的半截答案不能存)
+        ANSWER_CACHE.put(scope, request.query, "".join(answer_parts), format_sources(context),
+                         context_text="".join(doc.page_content for doc in context))
+
     # 2. 定义生成器函数
-    def generate_response():
+    # 【老写法】同步生成器：Starlette 会把它丢到线程池里迭代，一个流占一个线程，
+    #  默认线程池只有 40 个，200 人同时看就排队了
+    def generate_response(meta):
+        answer_parts = []
+        context = []
         # chain.stream() 会自动一个字一个字地吐数据
         for chunk in chain.stream({"input":request.query}):
+            if "context" in chunk:
+                context = chunk["context"]
             # LangChain 的 stream 返回的很碎，我们需要提取出 answer 部分
             if "answer" in chunk:
                 content = chunk["answer"]
                 if content:
                     # 🐌 【新增】人工延迟：每输出一个块，暂停 0.05 秒
                     # 你可以调整这个数字：0.02 很流畅，0.1 就很有“老电影打字机”的感觉
+                    answer_parts.append(content)
                     yield content
-    # 3. 把生成器交给 FastAPI 的传送带
+        save_answer(meta, answer_parts, context)
+
+    # 【新写法】异步生成器：chain.astream 全程在事件循环上跑，不占线程，
+    #  客户端断开就立刻停掉生成 (aclosing 会把底层的 LLM 请求一起关掉)，不再为没人看的 token 付钱
+    #  (合并请求时，断开检测由每个订阅者自己做，所有人都走了才停，见 rag_singleflight)
+    async def agenerate_response(meta, is_disconnected=None):
+        answer_parts = []
+        context = []
+        async with aclosing(chain.astream({"input":request.query})) as stream:
+            async for chunk in stream:
+                if is_disconnected is not None and await is_disconnected():
+                    print(f"🔌 用户 {request.session_id} 已断开，停止生成")
+                    return
+                if "context" in chunk:
+                    context = chunk["context"]
+                if "answer" in chunk:
+                    content = chunk["answer"]
+                    if content:
+                        answer_parts.append(content)
+                        yield content
+        await run_in_threadpool(save_answer, meta, answer_parts, context)
+
+    # 同样的问题正在生成的话直接搭车 (不占名额)；否则先等 stream 池放行 (排满了 / 等太久 -> 429)，
+    # 在返回响应之前等，这样拒绝时还能回一个正经的 429，而不是流到一半报错
+    key = flight_key(request.session_id, request.query)
+    ticket = None
+    if not (SINGLE_FLIGHT_ENABLED and key in STREAM_FLIGHTS):
+        ticket = admit("stream", request.session_id)
+        try:
+            await ticket.wait_async(ticket.pool.max_wait)
+        except AdmissionRejected as e:
+            raise too_busy(e)
+        if SINGLE_FLIGHT_ENABLED and key in STREAM_FLIGHTS:
+            # 排队的时候别人已经开始生成同一个问题了：名额还回去，搭车
+            ticket.release()
+            ticket = None
+
+    def start_generation(meta, is_disconnected=None):
+        if STREAM_MODE == "async":
+            tokens = agenerate_response(meta, is_disconnected)
+        else:
+            tokens = iterate_in_threadpool(generate_response(meta))
+        # 生成跑在响应返回之后 (合并请求时甚至比发起的人活得久)，session 要借到生成完
+        RAG_CHAINS.acquire(request.session_id)
+        tokens = release_when_done(partial(RAG_CHAINS.release, request.session_id), tokens)
+        return release_when_done(ticket.release, tokens) if ticket is not None else tokens
+
+    # 3. 把生成器交给 FastAPI 的传送带 (先过一道 SSE 编码：攒批 + data 帧 + done 事件)
+    # 同样的问题正在生成：直接订阅那一路 token 流 (已经生成的部分先补上)，不再多调一次 LLM
+    # (STREAM_FLIGHTS 只在事件循环里用：上面最后一次 “在不在表里” 的判断到这里之间没有 await，
+    #  判断时是搭车的，订阅时一定还是搭车，不会变成没拿名额的 leader)
+    if SINGLE_FLIGHT_ENABLED:
+        tokens, shared = STREAM_FLIGHTS.subscribe(
+            key, start_generation, meta, http_request.is_disconnected,
+        )
+        meta["shared"] = shared
+        if shared:
+            print("🤝 合并到正在生成的同一个问题")
+    else:
+        tokens = start_generation(meta, http_request.is_disconnected)
     return StreamingResponse(
-        generate_response(),
+        sse_stream(tokens, meta),
         media_type="text/event-stream" # 告诉浏览器：我是流，别急着断开
     )
 
 
 
+# --- 运行状态：Session 仓库、入库任务、答案缓存 ---
+@app.get("/stats")
+def stats():
+    return {
+        "sessions": RAG_CHAINS.stats(),
+        "ingest_jobs": INGEST_JOBS.stats(),
+        "answer_cache": ANSWER_CACHE.stats(),
+        "single_flight": {"chat": CHAT_FLIGHTS.stats(), "stream": STREAM_FLIGHTS.stats()},
+        "admission": {name: pool.stats() for name, pool in ADMISSION.items()},
+    }
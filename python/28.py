@@ -7,23 +7,34 @@
 import os
 import shutil
 import tempfile
+import statistics
+import threading
+import time
+from collections import OrderedDict
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.responses import StreamingResponse
+from fastapi.concurrency import iterate_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
 # --- LangChain 组件 ---
 from langchain_community.document_loaders import PyPDFLoader
-from langchain_community.embeddings import DashScopeEmbeddings
-from langchain_community.chat_models import ChatTongyi
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_classic.chains import create_retrieval_chain
 from langchain_classic.chains.combine_documents import create_stuff_documents_chain
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_community.chat_models import ChatTongyi
 
 # --- 【NEW】引入 Pinecone 组件 ---
 from langchain_pinecone import PineconeVectorStore
+from pinecone import Pinecone
+# 本地替身：离线压测 / 小租户不走网络
+from rag_local_index import LocalVectorIndex, LocalVectorStore
+from rag_ingest import get_embeddings
+from rag_llm import get_llm, warm_up_in_background
+# SSE 编码：token 攒批成 data 帧，结束发 done 事件
+from rag_sse import sse_stream
 
 # 加载环境变量
 load_dotenv()
@@ -46,6 +57,136 @@ app.add_middleware(
 
 PINECONE_INDEX_NAME = 'day28-rag'
 
+# 向量库后端：pinecone (默认，云端) / local (本地 memmap 索引，见 rag_local_index.py)
+VECTOR_BACKEND = os.getenv("RAG_VECTOR_BACKEND", "pinecone")
+
+# --- 全局“热”客户端：进程启动时建一次，所有请求共用 ---
+# 以前每次 /chat/stream 都要 new 一个 Embedding、连一次 Pinecone、new 一个 LLM、拼两遍链，
+# 这些全是首字延迟 (TTFT) 之前的纯开销。现在它们只建一次，底层 HTTP 连接池也跟着复用。
+# (RAG_EMBEDDING_BACKEND=fake 时用本地假 Embedding，配合 local 后端可以完全离线跑)
+EMBEDDINGS = get_embeddings()
+LLM = get_llm("qwen-turbo")
+if VECTOR_BACKEND == "local":
+    PINECONE_INDEX = None
+    LOCAL_INDEX = LocalVectorIndex()
+else:
+    PINECONE_INDEX = Pinecone(api_key=os.getenv("PINECONE_API_KEY")).Index(PINECONE_INDEX_NAME)
+    LOCAL_INDEX = None
+
+
+def make_vectorstore(namespace):
+    """按配置选后端；两种后端的用法完全一样 (namespace 隔离 + add_documents + as_retriever)"""
+    if VECTOR_BACKEND == "local":
+        return LocalVectorStore(index=LOCAL_INDEX, embedding=EMBEDDINGS, namespace=namespace)
+    return PineconeVectorStore(index=PINECONE_INDEX, embedding=EMBEDDINGS, namespace=namespace)
+
+system_prompt = """
+你是一个智能助手。请基于 Context 回答。
+如果 Context 里没有答案，请使用你的通用知识回答。
+使用 Markdown 格式。
+
+<context>
+{context}
+</context>
+"""
+PROMPT = ChatPromptTemplate.from_messages([
+    ("system", system_prompt),
+    ("human", "{input}"),
+])
+# 回答链和 namespace 无关，所有人共用一条
+QUESTION_ANSWER_CHAIN = create_stuff_documents_chain(LLM, PROMPT)
+
+# --- 每个 namespace 一条 RAG 链的缓存 (LRU，最多 RAG_NAMESPACE_CHAINS_MAX 条) ---
+NAMESPACE_CHAINS_MAX = int(os.getenv("RAG_NAMESPACE_CHAINS_MAX", "256"))
+NAMESPACE_CHAINS = OrderedDict()
+NAMESPACE_LOCK = threading.Lock()
+# 统计：每个请求拿到链花了多少时间 (命中 ≈ 0，没命中 = 建一次链)，
+# 和 “老写法每个请求都从头建一遍” 的基线 (legacy_setup_ms) 对比，算出省下来的首字延迟
+CHAIN_STATS = {"hits": 0, "misses": 0, "evictions": 0, "setup_ms_total": 0.0, "cold_setup_ms_total": 0.0,
+               "ttft_ms_total": 0.0, "ttft_count": 0, "legacy_setup_ms": None}
+
+
+def get_namespace_chain(namespace):
+    """取某个 namespace 的 RAG 链；第一次用才建，之后直接复用"""
+    start = time.perf_counter()
+    with NAMESPACE_LOCK:
+        chain = NAMESPACE_CHAINS.get(namespace)
+        if chain is not None:
+            NAMESPACE_CHAINS.move_to_end(namespace)
+            CHAIN_STATS["hits"] += 1
+            CHAIN_STATS["setup_ms_total"] += (time.perf_counter() - start) * 1000
+            return chain
+
+    # 直接用全局的 Index 对象，不再每次 from_existing_index (那样会新建 Pinecone 客户端 + 连接池)
+    vectorstore = make_vectorstore(namespace)
+    chain = create_retrieval_chain(vectorstore.as_retriever(), QUESTION_ANSWER_CHAIN)
+    cost_ms = (time.perf_counter() - start) * 1000
+
+    with NAMESPACE_LOCK:
+        NAMESPACE_CHAINS[namespace] = chain
+        NAMESPACE_CHAINS.move_to_end(namespace)
+        while len(NAMESPACE_CHAINS) > NAMESPACE_CHAINS_MAX:
+            NAMESPACE_CHAINS.popitem(last=False)
+            CHAIN_STATS["evictions"] += 1
+        CHAIN_STATS["misses"] += 1
+        CHAIN_STATS["setup_ms_total"] += cost_ms
+        CHAIN_STATS["cold_setup_ms_total"] += cost_ms
+    return chain
+
+
+def measure_legacy_setup(samples=3):
+    """
+    基线：照老写法把 “每个请求都要做一遍” 的准备工作跑几次，取中位数 (毫秒)
+    新建 Embedding 客户端 + 重新连 Pinecone 索引 (from_existing_index，会查一次索引地址) + 新建 LLM + 拼两遍链
+    (不含 LLM 第一次请求的 TLS 握手，所以是个偏保守的下限)
+    """
+    costs = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        embeddings = get_embeddings()
+        if VECTOR_BACKEND == "local":
+            vectorstore = LocalVectorStore(index=LOCAL_INDEX, embedding=embeddings, namespace="__baseline__")
+        else:
+            vectorstore = PineconeVectorStore.from_existing_index(
+                index_name=PINECONE_INDEX_NAME, embedding=embeddings, namespace="__baseline__")
+        llm = ChatTongyi(model="qwen-turbo", dashscope_api_key=os.getenv("ALIYUN_API_KEY"))
+        create_stuff_documents_chain(llm, PROMPT)
+        create_retrieval_chain(vectorstore.as_retriever(), create_stuff_documents_chain(llm, PROMPT))
+        costs.append((time.perf_counter() - start) * 1000)
+    with NAMESPACE_LOCK:
+        CHAIN_STATS["legacy_setup_ms"] = statistics.median(costs)
+    return CHAIN_STATS["legacy_setup_ms"]
+
+
+def invalidate_namespace(namespace):
+    """namespace 的数据变了 (/upload)，把缓存的链扔掉，下次提问重新建"""
+    with NAMESPACE_LOCK:
+        NAMESPACE_CHAINS.pop(namespace, None)
+
+
+@app.on_event("startup")
+def warm_up():
+    # 启动时先打一次 Pinecone 和模型接口，把 TLS 握手和连接池提前建好，第一个用户不用替大家“暖机”
+    warm_up_in_background()
+    # 基线测量放后台：Pinecone 模式下要联网，别拖慢启动
+    threading.Thread(target=_measure_baseline_quietly, daemon=True, name="legacy-setup-baseline").start()
+    if PINECONE_INDEX is None:
+        print("💻 使用本地向量索引，无需预热")
+        return
+    try:
+        stats = PINECONE_INDEX.describe_index_stats()
+        print(f"🔥 Pinecone 连接已预热，共 {stats.get('total_vector_count', '?')} 条向量")
+    except Exception as e:
+        print(f"⚠️ Pinecone 预热失败 (不影响启动): {e}")
+
+
+def _measure_baseline_quietly():
+    try:
+        print(f"📏 老写法每个请求的准备耗时 (基线): {measure_legacy_setup():.1f}ms")
+    except Exception as e:
+        print(f"⚠️ 基线测量失败 (/stats 里不报省下的时间): {e}")
+
+
 class ChatRequest(BaseModel):
     query: str
     session_id: str = "default_user"
@@ -72,19 +213,14 @@ async def upload_pdf(
         text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
         splits = text_splitter.split_documents(docs)
         
-        # 4. 初始化 Embedding 模型
-        embeddings = DashScopeEmbeddings(model="text-embedding-v1",dashscope_api_key=os.getenv('ALIYUN_API_KEY'))
-        
         print("☁️ 正在把数据推送到 Pinecone 云端 (这可能需要几秒钟)...")
 
-        # 5. 【NEW】存入 Pinecone
+        # 5. 【NEW】存入 Pinecone (复用全局的 Embedding 和 Index 连接；RAG_VECTOR_BACKEND=local 时存本地)
         # 重点：namespace=session_id 实现了用户数据隔离！
-        PineconeVectorStore.from_documents(
-            documents=splits,
-            embedding=embeddings,
-            index_name=PINECONE_INDEX_NAME,
-            namespace=session_id,   # <--- 关键！数据被贴上了“属于session_id”的标签
-        )
+        vectorstore = make_vectorstore(session_id)   # <--- 关键！数据被贴上了“属于session_id”的标签
+        vectorstore.add_documents(splits)
+        # 这个 namespace 的数据变了，缓存的链作废
+        invalidate_namespace(session_id)
         print(f"✅ 存储成功！Namespace: {session_id}")
         return {
             "message": "PDF 已存入云端数据库，永久保存！",
@@ -106,47 +242,29 @@ async def chat_stream(request:ChatRequest):
     print(f"🔍 用户 {request.session_id} 提问: {request.query}")
 
     try:
-        # 1. 准备 Embedding
-        embeddings = DashScopeEmbeddings(model="text-embedding-v1",dashscope_api_key=os.getenv('ALIYUN_API_KEY'))
-        # 2. 【NEW】连接到现有的 Pinecone 索引
-        # 注意：这里我们只连接，不写入。
-        # 必须指定 namespace，否则查不到刚才存的数据！
-        vectorstore = PineconeVectorStore.from_existing_index(
-            index_name=PINECONE_INDEX_NAME,
-            embedding=embeddings,
-            namespace=request.session_id,  # <--- 关键！只去这个用户的抽屉里找
-
-        )
-        # 3. 转换成检索器
-        retriever = vectorstore.as_retriever()
-
-        # 4. 准备大脑 (LLM)
-        llm = ChatTongyi(model='qwen-turbo',dashscope_api_key=os.getenv("ALIYUN_API_KEY"))
-
-        system_prompt = """
-        你是一个智能助手。请基于 Context 回答。
-        如果 Context 里没有答案，请使用你的通用知识回答。
-        使用 Markdown 格式。
-        
-        <context>
-        {context}
-        </context>
-        """
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", system_prompt),
-            ("human", "{input}"),
-        ])
-
-        question_answer_chain = create_stuff_documents_chain(llm, prompt)
-        rag_chain = create_retrieval_chain(retriever, create_stuff_documents_chain(llm, prompt))
+        # 1~5. 从缓存里取这个 namespace 的链 (第一次才真正去建)
+        # 必须按 namespace 区分，否则查不到刚才存的数据！
+        rag_chain = get_namespace_chain(request.session_id)
+        request_start = time.perf_counter()
 
         # 6. 生成器函数 (流式输出)
+        meta = {"sources": []}
+
         def generate_response():
             try:
+                first_token = True
                 for chunk in rag_chain.stream({"input": request.query}):
+                    if "context" in chunk:
+                        meta["sources"] = [doc.page_content[:50] + "..." for doc in chunk["context"]]
                     if "answer" in chunk:
                         content = chunk["answer"]
                         if content:
+                            if first_token:
+                                # 记录首字延迟 (TTFT)
+                                first_token = False
+                                with NAMESPACE_LOCK:
+                                    CHAIN_STATS["ttft_ms_total"] += (time.perf_counter() - request_start) * 1000
+                                    CHAIN_STATS["ttft_count"] += 1
                             # 稍微人工延迟一点点，提升体验
                             yield content
             except Exception as e:
@@ -155,10 +273,36 @@ async def chat_stream(request:ChatRequest):
 
         # 3. 返回流
         return StreamingResponse(
-            generate_response(), 
+            sse_stream(iterate_in_threadpool(generate_response()), meta),
             media_type="text/event-stream"
         )
     except Exception as e:
         # 【修复点】如果连不上 Pinecone，直接抛出 HTTP 500 错误，而不是 yield
         print(f"❌ 检索失败: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# --- 运行状态：链缓存命中率 & 省下来的首字延迟 ---
+@app.get("/stats")
+def stats():
+    with NAMESPACE_LOCK:
+        hits, misses = CHAIN_STATS["hits"], CHAIN_STATS["misses"]
+        requests = hits + misses
+        avg_cold_ms = CHAIN_STATS["cold_setup_ms_total"] / misses if misses else 0.0
+        avg_setup_ms = CHAIN_STATS["setup_ms_total"] / requests if requests else 0.0
+        avg_ttft_ms = CHAIN_STATS["ttft_ms_total"] / CHAIN_STATS["ttft_count"] if CHAIN_STATS["ttft_count"] else 0.0
+        legacy_ms = CHAIN_STATS["legacy_setup_ms"]
+        return {
+            "cached_namespaces": len(NAMESPACE_CHAINS),
+            "max_cached_namespaces": NAMESPACE_CHAINS_MAX,
+            "chain_cache_hits": hits,
+            "chain_cache_misses": misses,
+            "chain_cache_evictions": CHAIN_STATS["evictions"],
+            "avg_cold_setup_ms": round(avg_cold_ms, 1),
+            "avg_setup_ms": round(avg_setup_ms, 1),
+            "legacy_setup_ms": None if legacy_ms is None else round(legacy_ms, 1),
+            "avg_ttft_ms": round(avg_ttft_ms, 1),
+            # 老写法每个请求都要付一次 legacy_setup_ms，现在实际只付了 setup_ms_total，差值就是省下来的首字延迟
+            "ttft_saved_ms_total": None if legacy_ms is None
+            else round(requests * legacy_ms - CHAIN_STATS["setup_ms_total"], 1),
+        }
@@ -0,0 +1,73 @@
+# 压测：每次新建 LLM 客户端 vs rag_llm 注册表里的单例 (共用 keep-alive 连接池)
+# 用法 (在 python 目录下，需要联网 + ALIYUN_API_KEY):
+#   python bench_llm.py --calls 20                 # 默认 handshake：请求 /models，不花 token，只看连接开销
+#   python bench_llm.py --calls 20 --mode invoke   # 真调模型 (每次只生成 1 个 token)
+# fresh  = 每次调用都 new 一个客户端 (= 新连接池 = 重新 TCP + TLS 握手)，老脚本的写法
+# pooled = get_llm() 单例，先 warm_up() 把连接建好，之后每次都复用
+
+import argparse
+import os
+import statistics
+import time
+
+import httpx
+from dotenv import load_dotenv
+
+from bench_stream import percentile
+
+load_dotenv()
+
+import rag_llm  # noqa: E402  (要先加载 .env 里的 Key)
+
+
+def fresh_call(mode, model):
+    if mode == "handshake":
+        with httpx.Client(timeout=rag_llm.LLM_TIMEOUT) as client:
+            client.get(f"{rag_llm.OPENAI_COMPATIBLE_URL}/models")
+        return
+    from langchain_openai import ChatOpenAI
+    llm = ChatOpenAI(
+        api_key=os.getenv("ALIYUN_API_KEY"),
+        base_url=rag_llm.OPENAI_COMPATIBLE_URL,
+        model=model,
+        max_tokens=1,
+    )
+    llm.invoke("hi")
+
+
+def pooled_call(mode, model):
+    if mode == "handshake":
+        rag_llm.shared_http_clients()[0].get(f"{rag_llm.OPENAI_COMPATIBLE_URL}/models")
+        return
+    rag_llm.get_llm(model, temperature=0.0, provider="openai").bind(max_tokens=1).invoke("hi")
+
+
+def measure(fn, calls, mode, model):
+    latencies = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        fn(mode, model)
+        latencies.append(time.perf_counter() - start)
+    return {
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LLM 客户端连接复用压测 (fresh vs pooled)")
+    parser.add_argument("--calls", type=int, default=20)
+    parser.add_argument("--mode", choices=["handshake", "invoke"], default="handshake")
+    parser.add_argument("--model", default="qwen-turbo")
+    args = parser.parse_args()
+
+    print(f"🚀 {args.mode} 模式，每种 {args.calls} 次串行调用")
+    print(f"🔥 预热连接池: {rag_llm.warm_up('openai'):.0f}ms")
+    for name, fn in (("fresh", fresh_call), ("pooled", pooled_call)):
+        r = measure(fn, args.calls, args.mode, args.model)
+        print(f"[{name:>6}] p50 {r['p50_ms']:.0f}ms | p95 {r['p95_ms']:.0f}ms | 平均 {r['mean_ms']:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+# 压测：/chat/stream 同步生成器 vs 异步 astream，能同时扛多少路流
+# 用法 (在 python 目录下):
+#   python bench_stream.py --pdf 财报.pdf --concurrency 200
+# 会分别用 RAG_STREAM_MODE=sync 和 async 启动 27.py，假 LLM + 假 Embedding (不花钱、不联网)，
+# 然后同时发起 N 路流式提问，统计首字延迟 (TTFT) 和整体耗时。
+# 比的是两种生成方式能扛多少路，所以默认把 stream 池的准入限制放到 >= 并发数 (不然大半请求直接 429)；
+# 想看准入控制本身的效果就加 --admission (用服务默认的限制)，被拒的请求单独计数，不算进延迟
+
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+
+import httpx
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+async def wait_until_ready(client, base_url):
+    for _ in range(100):
+        try:
+            await client.get(f"{base_url}/stats")
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError("服务没有启动起来")
+
+
+async def upload(client, base_url, pdf_path, session_id):
+    with open(pdf_path, "rb") as f:
+        res = await client.post(f"{base_url}/upload", data={"session_id": session_id}, files={"file": (os.path.basename(pdf_path), f, "application/pdf")})
+    job_id = res.json()["job_id"]
+    while True:
+        job = (await client.get(f"{base_url}/upload/{job_id}")).json()
+        if job["status"] in ("done", "failed"):
+            if job["status"] == "failed":
+                raise RuntimeError(job["error"])
+            return
+        await asyncio.sleep(0.2)
+
+
+async def one_stream(client, base_url, session_id, i):
+    start = time.perf_counter()
+    ttft = None
+    # 每路问题都不一样，避免命中答案缓存
+    body = {"session_id": session_id, "query": f"第 {i} 个问题：毛利率是多少"}
+    async with client.stream("POST", f"{base_url}/chat/stream", json=body) as res:
+        if res.status_code != 200:
+            # 429 (准入拒绝) 之类：响应体很短、“首字”飞快，算进去延迟就假了
+            await res.aread()
+            return res.status_code, None, None
+        async for chunk in res.aiter_bytes():
+            if ttft is None and chunk:
+                ttft = time.perf_counter() - start
+    return res.status_code, ttft or 0.0, time.perf_counter() - start
+
+
+async def run_load(base_url, pdf_path, concurrency):
+    limits = httpx.Limits(max_connections=concurrency + 10, max_keepalive_connections=concurrency + 10)
+    async with httpx.AsyncClient(timeout=300, limits=limits) as client:
+        await wait_until_ready(client, base_url)
+        await upload(client, base_url, pdf_path, "bench")
+        start = time.perf_counter()
+        results = await asyncio.gather(*(one_stream(client, base_url, "bench", i) for i in range(concurrency)))
+        wall = time.perf_counter() - start
+    statuses = Counter(r[0] for r in results)
+    ok = [r for r in results if r[0] == 200]
+    if not ok:
+        raise RuntimeError(f"没有一路流成功: {dict(statuses)}")
+    ttfts = [r[1] for r in ok]
+    totals = [r[2] for r in ok]
+    return {
+        "wall_s": wall,
+        "ok": len(ok),
+        "rejected": {code: n for code, n in statuses.items() if code != 200},
+        "ttft_p50_ms": statistics.median(ttfts) * 1000,
+        "ttft_p95_ms": percentile(ttfts, 95) * 1000,
+        "total_p50_ms": statistics.median(totals) * 1000,
+        "total_p95_ms": percentile(totals, 95) * 1000,
+        "streams_per_s": len(ok) / wall,
+    }
+
+
+def bench_mode(mode, args):
+    env = {
+        **os.environ,
+        "RAG_STREAM_MODE": mode,
+        "RAG_LLM_BACKEND": "fake",
+        "RAG_EMBEDDING_BACKEND": "fake",
+        "RAG_FAKE_LLM_DELAY": str(args.token_delay),
+    }
+    if not args.admission:
+        # 所有流都在同一个 session 里：单 session 排队上限也得放开
+        env.update({
+            "RAG_ADMIT_STREAM_CONCURRENCY": str(args.concurrency),
+            "RAG_ADMIT_STREAM_QUEUE": str(args.concurrency),
+            "RAG_ADMIT_SESSION_QUEUE": str(args.concurrency),
+        })
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "27:app", "--port", str(args.port), "--log-level", "warning"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        return asyncio.run(run_load(f"http://127.0.0.1:{args.port}", args.pdf, args.concurrency))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="/chat/stream 并发压测 (sync vs async)")
+    parser.add_argument("--pdf", required=True, help="用来建库的 PDF")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--token-delay", type=float, default=0.1, help="假模型每个字的生成间隔 (秒)")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--modes", default="sync,async")
+    parser.add_argument("--admission", action="store_true", help="保留服务默认的准入限制 (默认放开到 >= 并发数)")
+    args = parser.parse_args()
+
+    print(f"🚀 并发 {args.concurrency} 路流，每个字 {args.token_delay * 1000:.0f}ms")
+    for mode in args.modes.split(","):
+        r = bench_mode(mode, args)
+        print(
+            f"[{mode:>5}] 总耗时 {r['wall_s']:.2f}s | {r['streams_per_s']:.1f} 路/秒 | "
+            f"TTFT p50 {r['ttft_p50_ms']:.0f}ms p95 {r['ttft_p95_ms']:.0f}ms | "
+            f"完成 p50 {r['total_p50_ms']:.0f}ms p95 {r['total_p95_ms']:.0f}ms | "
+            f"成功 {r['ok']} 路，被拒 {r['rejected'] or 0}"
+        )
+
+
+if __name__ == "__main__":
+    main()
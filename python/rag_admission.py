@@ -0,0 +1,266 @@
+# 准入控制 (分池限并发 + 按 session 公平排队 + 排满了快速 429)
+# 痛点: 27.py 的 /upload、/chat、/chat/stream 来多少收多少：
+#       一个租户一口气传十份 PDF，解析和 Embedding 配额全被它占满，别人的聊天跟着变慢、超时；
+#       压力大的时候请求在各处无限排队，客户端也不知道该过多久再来。
+# 思路:
+#   1. 入库 / 聊天 / 流式 三个池子各管各的并发 (互不抢)，入库再重也挤不掉聊天的名额
+#   2. 池子满了就排队，队列按 session 分开，放行时在 session 之间轮流 (round-robin)：
+#      A 排了十个、B 排了一个，B 不用等 A 的十个全跑完
+#   3. 总队列满了、或者某个 session 自己排得太多，立刻拒绝 (429 + Retry-After)，不让请求挂着；
+#      Retry-After 按 “最近平均处理耗时 × 前面排了多少 / 并发数” 估算
+#   4. 排队太久 (max_wait) 也按 429 处理
+#   5. 每个池子记录 到达时的队列深度、排队耗时 的直方图，/stats 里能看到
+# 同步 (线程里 ticket.wait()) 和异步 (await ticket.wait_async()) 两种等法都支持，共用一把锁
+
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+WAIT_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256)
+ADMIT_SESSION_QUEUE = int(os.getenv("RAG_ADMIT_SESSION_QUEUE", "4"))
+ADMIT_MAX_WAIT_S = float(os.getenv("RAG_ADMIT_MAX_WAIT_S", "30"))
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, pool, reason, retry_after):
+        super().__init__(f"{pool} 繁忙 ({reason})，请 {retry_after} 秒后重试")
+        self.pool = pool
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Histogram:
+    """固定分桶的直方图：每个桶是 “<= 上界” 的次数 (不累加)，最后一个桶是 +Inf"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        for n, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[n] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.total += value
+
+    def snapshot(self):
+        labels = [f"<={bound}" for bound in self.buckets] + ["+Inf"]
+        return {
+            "buckets": dict(zip(labels, self.counts)),
+            "count": self.count,
+            "mean": round(self.total / self.count, 2) if self.count else 0.0,
+        }
+
+
+class Ticket:
+    """一次准入：enqueue 拿到 -> wait / wait_async 等放行 -> release 归还名额"""
+
+    def __init__(self, pool, session_id):
+        self.pool = pool
+        self.session_id = session_id
+        self.enqueued_at = time.perf_counter()
+        self.granted_at = None
+        self.released = False
+        self._event = threading.Event()
+        self._loop = None
+        self._future = None
+
+    @property
+    def granted(self):
+        return self.granted_at is not None
+
+    def wait(self, timeout=None):
+        if not self._event.wait(timeout):
+            self.pool._abandon(self)
+            raise self.pool._rejection("排队超时")
+        return self
+
+    async def wait_async(self, timeout=None):
+        with self.pool._lock:
+            if self.granted:
+                return self
+            self._loop = asyncio.get_running_loop()
+            self._future = self._loop.create_future()
+        try:
+            await asyncio.wait_for(self._future, timeout)
+        except asyncio.TimeoutError:
+            self.pool._abandon(self)
+            raise self.pool._rejection("排队超时") from None
+        except asyncio.CancelledError:
+            self.pool._abandon(self)
+            raise
+        return self
+
+    def release(self):
+        self.pool._release(self)
+
+    def cancel(self):
+        """不用了 (比如后面出错了)：还在排队就出队，已经放行了就归还名额"""
+        self.pool._abandon(self)
+
+    def __enter__(self):
+        return self.wait(self.pool.max_wait)
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+    async def __aenter__(self):
+        return await self.wait_async(self.pool.max_wait)
+
+    async def __aexit__(self, *exc):
+        self.release()
+        return False
+
+
+class AdmissionPool:
+    """
+    用法：
+        ticket = pool.enqueue(session_id)   # 队列满了直接抛 AdmissionRejected (-> 429)
+        async with ticket:                  # 等放行 (session 之间轮流)，退出时归还名额
+            ...
+    """
+
+    def __init__(self, name, concurrency, max_queue, max_queue_per_session=ADMIT_SESSION_QUEUE,
+                 max_wait=ADMIT_MAX_WAIT_S):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.max_queue = max_queue
+        self.max_queue_per_session = max_queue_per_session
+        self.max_wait = max_wait if max_wait and max_wait > 0 else None
+        self._lock = threading.Lock()
+        self._queues = OrderedDict()   # session_id -> deque[Ticket]，顺序就是轮转顺序
+        self._queued = 0
+        self._active = 0
+        self._service_s = 1.0          # 最近平均占用时长 (EWMA)，估算 Retry-After 用
+        self.admitted = 0
+        self.rejected = 0
+        self.abandoned = 0
+        self.max_depth = 0
+        self.depth_hist = Histogram(DEPTH_BUCKETS)
+        self.wait_hist = Histogram(WAIT_BUCKETS_MS)
+
+    def enqueue(self, session_id):
+        ticket = Ticket(self, session_id)
+        with self._lock:
+            self.depth_hist.observe(self._queued)
+            if self._active < self.concurrency and not self._queued:
+                self._grant(ticket)
+                return ticket
+            if self._queued >= self.max_queue:
+                self.rejected += 1
+                raise self._rejection_locked("队列已满")
+            waiting = self._queues.get(session_id)
+            if waiting is not None and len(waiting) >= self.max_queue_per_session:
+                self.rejected += 1
+                raise self._rejection_locked("这个 session 排队的请求太多")
+            self._queues.setdefault(session_id, deque()).append(ticket)
+            self._queued += 1
+            self.max_depth = max(self.max_depth, self._queued)
+        return ticket
+
+    def stats(self):
+        with self._lock:
+            return {
+                "concurrency": self.concurrency,
+                "active": self._active,
+                "queued": self._queued,
+                "queued_sessions": len(self._queues),
+                "max_queue": self.max_queue,
+                "max_depth": self.max_depth,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "abandoned": self.abandoned,
+                "avg_service_ms": round(self._service_s * 1000, 1),
+                "queue_depth": self.depth_hist.snapshot(),
+                "wait_ms": self.wait_hist.snapshot(),
+            }
+
+    # --- 内部实现 (带 _locked 后缀的要先拿到锁) ---
+    def _grant(self, ticket):
+        ticket.granted_at = time.perf_counter()
+        self._active += 1
+        self.admitted += 1
+        self.wait_hist.observe((ticket.granted_at - ticket.enqueued_at) * 1000)
+        ticket._event.set()
+        if ticket._future is not None:
+            ticket._loop.call_soon_threadsafe(_resolve, ticket._future)
+
+    def _grant_next_locked(self):
+        """有空位就放行：取轮转队首的 session 的第一个请求，这个 session 还有人排队就挪到队尾"""
+        while self._active < self.concurrency and self._queues:
+            session_id, waiting = next(iter(self._queues.items()))
+            ticket = waiting.popleft()
+            self._queued -= 1
+            if waiting:
+                self._queues.move_to_end(session_id)
+            else:
+                del self._queues[session_id]
+            self._grant(ticket)
+
+    def _release(self, ticket):
+        with self._lock:
+            if ticket.released or not ticket.granted:
+                return
+            ticket.released = True
+            self._active -= 1
+            held = time.perf_counter() - ticket.granted_at
+            self._service_s = 0.8 * self._service_s + 0.2 * held
+            self._grant_next_locked()
+
+    def _abandon(self, ticket):
+        """等不下去了 (超时 / 客户端断开)：还在排队就出队，刚好被放行了就把名额还回去"""
+        with self._lock:
+            self.abandoned += 1
+            if not ticket.granted:
+                waiting = self._queues.get(ticket.session_id)
+                if waiting is not None and ticket in waiting:
+                    waiting.remove(ticket)
+                    self._queued -= 1
+                    if not waiting:
+                        del self._queues[ticket.session_id]
+                return
+        self._release(ticket)
+
+    def _rejection(self, reason):
+        with self._lock:
+            return self._rejection_locked(reason)
+
+    def _rejection_locked(self, reason):
+        retry_after = math.ceil(self._service_s * (self._queued + 1) / self.concurrency)
+        return AdmissionRejected(self.name, reason, min(60, max(1, retry_after)))
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def admission_pools_from_env():
+    """
+    三个池子各自的 并发数 / 总队列长度：
+        RAG_ADMIT_INGEST_CONCURRENCY (2)  / RAG_ADMIT_INGEST_QUEUE (16)
+        RAG_ADMIT_CHAT_CONCURRENCY (16)   / RAG_ADMIT_CHAT_QUEUE (64)
+        RAG_ADMIT_STREAM_CONCURRENCY (64) / RAG_ADMIT_STREAM_QUEUE (128)
+    另外 RAG_ADMIT_SESSION_QUEUE (4)：单个 session 最多排几个；RAG_ADMIT_MAX_WAIT_S (30)：最多排多久
+    """
+    defaults = {"ingest": (2, 16), "chat": (16, 64), "stream": (64, 128)}
+    pools = {}
+    for name, (concurrency, queue) in defaults.items():
+        prefix = f"RAG_ADMIT_{name.upper()}"
+        pools[name] = AdmissionPool(
+            name,
+            concurrency=int(os.getenv(f"{prefix}_CONCURRENCY", str(concurrency))),
+            max_queue=int(os.getenv(f"{prefix}_QUEUE", str(queue))),
+        )
+    return pools
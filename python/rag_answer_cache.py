@@ -0,0 +1,169 @@
+# 答案缓存 (Answer Cache，可选语义命中)
+# 痛点: 大家围着同一份财报反复问那十几个问题 (“毛利率是多少”“营收多少”)，
+#       每问一次都要 检索 + 一次完整的 ChatTongyi 生成。
+# 思路:
+#   1. 按“文档/会话”分区 (scope) 缓存答案，别的文档的答案绝不能串过来
+#   2. 先按“规范化后的问题原文”精确命中 (去空格、全角转半角、去掉结尾的问号句号)
+#   3. 可选：问题向量和缓存里的问题余弦相似度 >= 阈值，也算命中 (“毛利率多少” ≈ “毛利率是多少？”)
+#   4. 有 TTL、有条数上限 (LRU)；统计命中率和省下来的 token，方便调阈值
+
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+
+_TRAILING_PUNCT = re.compile(r"[\s?？!！。.,，~～]+$")
+_SPACES = re.compile(r"\s+")
+_CJK = re.compile(r"[一-鿿]")
+
+
+def normalize_query(query):
+    """“ 毛利率是多少？？” 和 “毛利率是多少” 应该是同一个问题"""
+    text = unicodedata.normalize("NFKC", query).strip().lower()
+    text = _SPACES.sub(" ", text)
+    return _TRAILING_PUNCT.sub("", text)
+
+
+def estimate_tokens(text):
+    """粗略估算 token 数：中文大约 1 字 1 token，其他字符大约 4 个 1 token"""
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk) // 4
+
+
+class AnswerCache:
+    def __init__(self, max_entries=2000, ttl=3600, similarity_threshold=None, embed_fn=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.embed_fn = embed_fn            # embed_fn(query) -> 向量；只有开了语义命中才会用
+        self._entries = OrderedDict()       # (scope, 规范化问题) -> entry
+        self._scopes = {}                   # scope -> set(规范化问题)，语义查找时只看本 scope
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+
+    @property
+    def semantic(self):
+        return bool(self.similarity_threshold) and self.embed_fn is not None
+
+    def get(self, scope, query):
+        """命中返回 {"answer", "sources", ...}，没命中返回 None"""
+        normalized = normalize_query(query)
+        with self._lock:
+            entry = self._lookup(scope, normalized)
+            if entry is not None:
+                self.exact_hits += 1
+                self.saved_tokens += entry["tokens"]
+                return entry
+            if not self.semantic or not self._scopes.get(scope):
+                self.misses += 1
+                return None
+
+        # 语义查找：算问题向量要调接口，放在锁外面
+        vector = np.asarray(self.embed_fn(query), dtype=np.float32)
+        with self._lock:
+            best, best_score = None, -1.0
+            for candidate in list(self._scopes.get(scope, ())):
+                entry = self._lookup(scope, candidate, touch=False)
+                if entry is None or entry["vector"] is None:
+                    continue
+                norms = float(np.linalg.norm(vector) * np.linalg.norm(entry["vector"])) or 1.0
+                score = float(vector @ entry["vector"]) / norms
+                if score > best_score:
+                    best, best_score = entry, score
+            if best is not None and best_score >= self.similarity_threshold:
+                self._entries.move_to_end((scope, best["query"]))
+                self.semantic_hits += 1
+                self.saved_tokens += best["tokens"]
+                return {**best, "similarity": round(best_score, 4)}
+            self.misses += 1
+            return None
+
+    def put(self, scope, query, answer, sources, context_text=""):
+        normalized = normalize_query(query)
+        vector = None
+        if self.semantic:
+            vector = np.asarray(self.embed_fn(query), dtype=np.float32)
+        entry = {
+            "query": normalized,
+            "answer": answer,
+            "sources": sources,
+            "vector": vector,
+            # 命中一次省下的 = 检索出来的上下文 + 问题 (输入) + 答案 (输出)
+            "tokens": estimate_tokens(context_text) + estimate_tokens(query) + estimate_tokens(answer),
+            "created_at": time.monotonic(),
+        }
+        with self._lock:
+            self._entries[(scope, normalized)] = entry
+            self._entries.move_to_end((scope, normalized))
+            self._scopes.setdefault(scope, set()).add(normalized)
+            while len(self._entries) > self.max_entries:
+                (old_scope, old_query), _ = self._entries.popitem(last=False)
+                self._forget(old_scope, old_query)
+
+    def invalidate(self, scope):
+        """文档变了 (重新上传)，这个 scope 下的答案全部作废"""
+        with self._lock:
+            for normalized in self._scopes.pop(scope, set()):
+                self._entries.pop((scope, normalized), None)
+
+    def stats(self):
+        with self._lock:
+            hits = self.exact_hits + self.semantic_hits
+            lookups = hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "saved_tokens": self.saved_tokens,
+                "similarity_threshold": self.similarity_threshold,
+            }
+
+    # --- 内部工具，调用前已拿到锁 ---
+    def _lookup(self, scope, normalized, touch=True):
+        entry = self._entries.get((scope, normalized))
+        if entry is None:
+            return None
+        if self.ttl and time.monotonic() - entry["created_at"] > self.ttl:
+            del self._entries[(scope, normalized)]
+            self._forget(scope, normalized)
+            return None
+        if touch:
+            self._entries.move_to_end((scope, normalized))
+        return entry
+
+    def _forget(self, scope, normalized):
+        queries = self._scopes.get(scope)
+        if queries is not None:
+            queries.discard(normalized)
+            if not queries:
+                del self._scopes[scope]
+
+
+def replay_stream(answer, chunk_size=16):
+    """把缓存里的完整答案重新切成小块，走流式接口“回放”给前端"""
+    for start in range(0, len(answer), chunk_size):
+        yield answer[start:start + chunk_size]
+
+
+def answer_cache_from_env(embed_fn=None):
+    """
+    RAG_ANSWER_CACHE_SIZE (默认 2000 条)，RAG_ANSWER_CACHE_TTL 秒 (默认 3600)，
+    RAG_ANSWER_CACHE_SIMILARITY (比如 0.95；不设置就只做精确命中，不额外调 Embedding)
+    """
+    threshold = os.getenv("RAG_ANSWER_CACHE_SIMILARITY")
+    return AnswerCache(
+        max_entries=int(os.getenv("RAG_ANSWER_CACHE_SIZE", "2000")),
+        ttl=float(os.getenv("RAG_ANSWER_CACHE_TTL", "3600")),
+        similarity_threshold=float(threshold) if threshold else None,
+        embed_fn=embed_fn,
+    )
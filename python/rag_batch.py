@@ -0,0 +1,185 @@
+# 批量生成 (有界并发 + 每分钟请求数限速 + 断点续跑)
+# 痛点: 2-14.py 一次只 invoke 一条，(平台, 类型, 主题) 一条一条串行跑；
+#       夜里几千条的营销任务要跑一整晚，中途崩一次就得从头再来，也不知道每条花了多久、多少 token。
+# 思路:
+#   1. 输入是 JSONL 或 CSV，一行一个任务 (有 id 列就用 id，没有就用行号)
+#   2. 线程池有界并发 (--concurrency) + 令牌桶限速 (--rpm)：吞吐量跟着配额走，又不会被限流打爆
+#   3. 谁先跑完谁先写：结果追加到 JSONL，一行一条，写完就 flush
+#   4. 输出文件本身就是断点：重跑时先读一遍，成功过的 id 直接跳过；失败的下次重试
+#   5. 每行记录 耗时 和 token 用量 (模型没返回用量就按填好模板的提示词字数估算)，结束时汇总吞吐和 P50 / P95 延迟
+
+import csv
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from langchain_core.callbacks import get_usage_metadata_callback
+
+from rag_answer_cache import estimate_tokens
+
+
+BATCH_CONCURRENCY = int(os.getenv("RAG_BATCH_CONCURRENCY", "8"))
+BATCH_RPM = float(os.getenv("RAG_BATCH_RPM", "60"))
+
+
+def read_inputs(path):
+    """逐行读 JSONL / CSV -> (id, dict)；文件再大也不一次性读进内存"""
+    if path.endswith(".csv"):
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            for n, row in enumerate(csv.DictReader(f), 1):
+                yield str(row.get("id") or n), row
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            if line.strip():
+                row = json.loads(line)
+                yield str(row.get("id") or n), row
+
+
+def load_checkpoint(out_path):
+    """已经成功的 id (输出文件就是断点，最后一行写了一半也不怕)"""
+    done = set()
+    if not os.path.exists(out_path):
+        return done
+    with open(out_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("status") == "ok":
+                done.add(str(record["id"]))
+    return done
+
+
+class RateLimiter:
+    """令牌桶：每分钟最多 rpm 次，允许攒一点突发 (最多 burst 个)"""
+
+    def __init__(self, rpm, burst=1):
+        self.interval = 60.0 / rpm if rpm > 0 else 0.0
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) / self.interval)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) * self.interval
+            time.sleep(delay)
+
+
+def _usage(callback, prompt_text, result):
+    """
+    优先用模型返回的 usage_metadata；没有 (比如没开 stream_usage) 就按字数估一下
+    prompt_text 是真正发给模型的提示词 (模板填好之后)，只数输入那几个字段会把模板那一大段漏掉
+    """
+    usage = {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0}
+    for metadata in callback.usage_metadata.values():
+        for key in usage:
+            usage[key] += metadata.get(key, 0)
+    if usage["total_tokens"]:
+        return {**usage, "estimated": False}
+    input_tokens = estimate_tokens(prompt_text)
+    output_tokens = estimate_tokens(json.dumps(result, ensure_ascii=False)) if result is not None else 0
+    return {"input_tokens": input_tokens, "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens, "estimated": True}
+
+
+def _ends_with_newline(path):
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def run_batch(rows, fn, out_path, concurrency=BATCH_CONCURRENCY, rpm=BATCH_RPM, prompt_text=None):
+    """
+    rows: (id, dict) 的可迭代对象；fn(dict) -> 结果 (要能 JSON 序列化)
+    prompt_text(dict) -> 填好模板的提示词，模型没返回用量时拿它估算输入 token (不传就只数这一行输入)
+    fn 里流式调用模型的话要把流读完 (stream_json 的 drain=True)，用量在最后一个 chunk 里
+    结果一条一行追加进 out_path，返回汇总统计
+    """
+    done = load_checkpoint(out_path)
+    limiter = RateLimiter(rpm, burst=concurrency)
+    latencies = []
+    counts = {"ok": 0, "error": 0, "skipped": 0}
+    total_tokens = 0
+
+    def work(row_id, row):
+        limiter.acquire()
+        start = time.perf_counter()
+        result, error = None, None
+        with get_usage_metadata_callback() as callback:
+            try:
+                result = fn(row)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+        return {
+            "id": row_id,
+            "status": "error" if error else "ok",
+            "input": row,
+            "output": result,
+            "error": error,
+            "latency_ms": round((time.perf_counter() - start) * 1000, 1),
+            "tokens": _usage(callback, prompt_text(row) if prompt_text else json.dumps(row, ensure_ascii=False), result),
+        }
+
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    start = time.perf_counter()
+    with open(out_path, "a+", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=concurrency) as pool:
+        # 上次崩在半行上：先补个换行，别让新记录接在坏行后面
+        if out.tell() and not _ends_with_newline(out_path):
+            out.write("\n")
+        def drain(pending):
+            nonlocal total_tokens
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                record = future.result()
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+                counts[record["status"]] += 1
+                latencies.append(record["latency_ms"])
+                total_tokens += record["tokens"]["total_tokens"]
+                mark = "✅" if record["status"] == "ok" else "❌"
+                print(f"{mark} [{record['id']}] {record['latency_ms']:.0f} ms {record['error'] or ''}")
+            return pending
+
+        pending = set()
+        for row_id, row in rows:
+            if row_id in done:
+                counts["skipped"] += 1
+                continue
+            # 在途任务有上限：输入文件再大，内存里也只压着 2 倍并发数的任务
+            if len(pending) >= concurrency * 2:
+                pending = drain(pending)
+            pending.add(pool.submit(work, row_id, row))
+        while pending:
+            pending = drain(pending)
+
+    elapsed = time.perf_counter() - start
+    processed = counts["ok"] + counts["error"]
+    return {
+        **counts,
+        "elapsed_s": round(elapsed, 2),
+        "rows_per_min": round(processed / elapsed * 60, 1) if elapsed else 0.0,
+        "latency_p50_ms": _percentile(latencies, 0.5),
+        "latency_p95_ms": _percentile(latencies, 0.95),
+        "total_tokens": total_tokens,
+    }
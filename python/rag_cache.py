@@ -0,0 +1,162 @@
+# 入库缓存 (Ingestion Cache)
+# 痛点: 同一份季度财报被上传到几百个 session，每次都要重新 解析 -> 切分 -> Embedding -> 建库。
+# 思路: 同一份 PDF + 同样的切分参数 + 同一个 Embedding 模型 => 切出来的块和向量一定一样。
+#       所以用 SHA-256 给它们打个“指纹”，第一次算完存到磁盘，之后直接拿来建库，不再花钱调 Embedding。
+# 存储: 向量存成 float32 的 .npy (1500 块的财报约 9MB，读一次几十毫秒)，块文本和元数据存在旁边的小 JSON 里；
+#       目录总大小有上限，超了就按最近使用时间淘汰最旧的条目。
+
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+# 缓存目录 (可以用环境变量改到挂载盘上，多个进程共享)
+INGEST_CACHE_DIR = os.getenv("RAG_INGEST_CACHE_DIR", ".rag_cache/ingest")
+# 缓存目录最多占多少磁盘 (MB)，<= 0 表示不限
+INGEST_CACHE_MAX_MB = float(os.getenv("RAG_INGEST_CACHE_MAX_MB", "2048"))
+
+
+def sha256_bytes(data):
+    """计算文件内容的 SHA-256 指纹"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def sha256_file(path):
+    """磁盘上的文件用 mmap 算指纹：不用把整个文件读进内存 (页缓存里按需换入)"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return sha256_bytes(b"")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return sha256_bytes(mapped)
+
+
+def chunk_hash(text):
+    """块级指纹：同样的块文本 + 同一个模型 => 同样的向量，增量更新时靠它跳过重复 Embedding"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def make_ingest_key(file_sha256, chunk_size, chunk_overlap, embedding_model):
+    """
+    缓存 Key = 文件指纹 + 切分参数 + 模型名
+    任何一个变了 (比如换了 chunk_size)，切出来的块和向量都会变，必须当成新数据
+    """
+    raw = f"{file_sha256}|{chunk_size}|{chunk_overlap}|{embedding_model}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class IngestCache:
+    """
+    磁盘上的入库缓存：一个 Key 对应两个文件
+      {key}.npy  : 向量矩阵 (float32，一行一个块)
+      {key}.json : 块文本、元数据、行数和维度 (最后写，它在 = 这条缓存完整可用)
+    """
+
+    def __init__(self, cache_dir=INGEST_CACHE_DIR, max_bytes=INGEST_CACHE_MAX_MB * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key, ext=".json"):
+        return os.path.join(self.cache_dir, f"{key}{ext}")
+
+    def get(self, key):
+        """命中返回 {"texts", "metadatas", "vectors"}，没命中 (或文件坏了) 返回 None"""
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            matrix = np.load(self._path(key, ".npy"), mmap_mode="r")
+            shape = (len(entry["texts"]), entry["dim"])
+        except (OSError, ValueError, KeyError) as e:
+            # KeyError: 老版本的纯 JSON 条目，当作未命中，重算一次就换成新格式
+            print(f"⚠️ 入库缓存读取失败，当作未命中: {e!r}")
+            return None
+        if matrix.shape != shape:
+            return None
+        # 碰一下修改时间：淘汰时按它判断“最近用过”
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return {"texts": entry["texts"], "metadatas": entry["metadatas"], "vectors": matrix.tolist()}
+
+    def put(self, key, texts, metadatas, vectors):
+        """
+        写缓存：先写临时文件再 os.replace，保证别的进程永远读不到写了一半的文件
+        (先落 .npy 再落 .json，读的时候以 .json 为准)
+        """
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if matrix.ndim != 2 or len(matrix) != len(texts):
+            return
+        entry = {"texts": texts, "metadatas": metadatas, "dim": int(matrix.shape[1])}
+        self._write_atomic(self._path(key, ".npy"), lambda f: np.save(f, matrix), "wb")
+        self._write_atomic(self._path(key), lambda f: json.dump(entry, f, ensure_ascii=False), "w")
+        self.evict()
+
+    def _write_atomic(self, path, write, mode):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, mode, **({} if "b" in mode else {"encoding": "utf-8"})) as f:
+                write(f)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def evict(self):
+        """目录超过上限时，按最近使用时间从旧到新删，直到降回上限以内"""
+        if self.max_bytes <= 0:
+            return
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            key = name[:-len(".json")]
+            try:
+                used = os.path.getmtime(self._path(key))
+                size = os.path.getsize(self._path(key)) + os.path.getsize(self._path(key, ".npy"))
+            except OSError:
+                continue
+            entries.append((used, key, size))
+            total += size
+        for _, key, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for ext in (".json", ".npy"):
+                try:
+                    os.remove(self._path(key, ext))
+                except OSError:
+                    pass
+            total -= size
+            print(f"🧹 入库缓存超过上限，淘汰 {key[:12]}… ({size / 1024 / 1024:.1f}MB)")
+
+
+class PrecomputedEmbeddings(Embeddings):
+    """
+    “假装”在做 Embedding 的包装器：
+    - 建库时 (embed_documents)，文本如果已经有算好的向量，直接查表返回
+    - 提问时 (embed_query)，交给真正的模型去算
+    这样 Chroma.from_texts 照常用，但不会为缓存里的块再花一次钱
+    """
+
+    def __init__(self, texts, vectors, fallback):
+        self.lookup = dict(zip(texts, vectors))
+        self.fallback = fallback
+
+    def embed_documents(self, texts):
+        missing = [t for t in texts if t not in self.lookup]
+        if missing:
+            for text, vector in zip(missing, self.fallback.embed_documents(missing)):
+                self.lookup[text] = vector
+        return [self.lookup[t] for t in texts]
+
+    def embed_query(self, text):
+        return self.fallback.embed_query(text)
@@ -0,0 +1,174 @@
+# 批量 + 并发 Embedding (带限流自适应退避)
+# 痛点: Chroma.from_documents 里的 Embedding 是一批一批“串行”调用的，300 页的财报要跑好几分钟。
+# 思路:
+#   1. 把块切成固定大小的批次 (DashScope 一次最多 25 条)
+#   2. 多个批次并发去调接口，并发上限可配置
+#   3. 遇到 429 / Throttling：并发数减半 + 指数退避重试；连续成功再慢慢加回来 (AIMD，和 TCP 拥塞控制一个思路)
+#   4. 每完成一批就回调一次 on_batch，调用方可以边算边汇报进度 / 边写库
+# 另外提供一个本地的 FakeEmbeddings，不联网、不花钱，压测和本地调试用。
+
+import hashlib
+import math
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from langchain_core.embeddings import Embeddings
+
+
+EMBED_BATCH_SIZE = int(os.getenv("RAG_EMBED_BATCH_SIZE", "25"))
+EMBED_CONCURRENCY = int(os.getenv("RAG_EMBED_CONCURRENCY", "4"))
+EMBED_MAX_RETRIES = int(os.getenv("RAG_EMBED_MAX_RETRIES", "6"))
+
+
+class ThrottledError(Exception):
+    """被限流了 (HTTP 429 / Throttling)"""
+
+
+def is_throttled(error):
+    """判断一个异常是不是“被限流”：DashScope / OpenAI 兼容接口的报错长得不太一样，都认一下"""
+    if isinstance(error, ThrottledError):
+        return True
+    status = getattr(error, "status_code", None) or getattr(error, "status", None)
+    if status == 429:
+        return True
+    message = str(error).lower()
+    return "429" in message or "throttl" in message or "rate limit" in message
+
+
+class AdaptiveLimiter:
+    """
+    会自己调节的并发闸门：
+    - 被限流：上限减半 (最少 1)
+    - 连续成功 limit 次：上限 +1 (最多 max_concurrency)
+    """
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = self.max_concurrency
+        self.in_flight = 0
+        self.throttled = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                self.limit = max(1, self.limit // 2)
+                self._successes = 0
+            else:
+                self._successes += 1
+                if self._successes >= self.limit and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self._successes = 0
+            self._cond.notify_all()
+
+
+def embed_in_batches(embeddings, texts, batch_size=EMBED_BATCH_SIZE, concurrency=EMBED_CONCURRENCY,
+                     max_retries=EMBED_MAX_RETRIES, on_batch=None, keep=True):
+    """
+    并发地把 texts 全部 Embedding，返回和 texts 顺序一致的向量列表
+    on_batch(start, batch_texts, batch_vectors)：每完成一批回调一次 (完成顺序不一定是原始顺序)
+    keep=False：向量交给 on_batch 处理 (比如直接写库) 就不再留一份，返回 None，省掉整本向量的内存
+
+    texts 也可以是生成器：攒够一批就先提交，前面的批次在算 Embedding 的同时，
+    上游还在继续解析 / 切分后面的页 (解析、切分、Embedding 三段重叠起来跑)
+    """
+    limiter = AdaptiveLimiter(concurrency)
+    results = {}
+
+    def run(start, batch):
+        for attempt in range(max_retries + 1):
+            limiter.acquire()
+            try:
+                result = embeddings.embed_documents(batch)
+            except Exception as e:
+                throttled = is_throttled(e)
+                limiter.release(throttled=throttled)
+                if not throttled or attempt == max_retries:
+                    raise
+                # 指数退避 + 随机抖动，避免所有批次同一时刻一起重试
+                delay = min(30.0, 0.5 * (2 ** attempt)) * (0.5 + random.random())
+                print(f"🐢 Embedding 被限流，{delay:.1f}s 后重试 (并发降到 {limiter.limit})")
+                time.sleep(delay)
+                continue
+            limiter.release()
+            return start, batch, result
+
+    def collect(futures, wait_all):
+        # 把已经完成的批次收进来 (wait_all=True 时等全部完成)
+        pending = []
+        done = as_completed(futures) if wait_all else [f for f in futures if f.done()]
+        for future in done:
+            start, batch, result = future.result()
+            if keep:
+                results[start] = result
+            if on_batch is not None:
+                on_batch(start, batch, result)
+        if not wait_all:
+            pending = [f for f in futures if not f.done()]
+        return pending
+
+    total = 0
+    with ThreadPoolExecutor(max_workers=limiter.max_concurrency, thread_name_prefix="embed") as pool:
+        futures = []
+        batch = []
+        for text in texts:
+            batch.append(text)
+            if len(batch) == batch_size:
+                futures.append(pool.submit(run, total, batch))
+                total += len(batch)
+                batch = []
+                futures = collect(futures, wait_all=False)
+        if batch:
+            futures.append(pool.submit(run, total, batch))
+            total += len(batch)
+        collect(futures, wait_all=True)
+
+    if limiter.throttled:
+        print(f"📉 本次 Embedding 一共被限流 {limiter.throttled} 次")
+    if not keep:
+        return None
+    vectors = []
+    for start in sorted(results):
+        vectors.extend(results[start])
+    return vectors
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    本地假 Embedding：同样的文本永远得到同样的向量 (用 SHA-256 当随机种子)，不联网
+    - latency：每次调用模拟的网络耗时 (秒)
+    - throttle_rate：每次调用有多大概率“被限流”，用来测退避逻辑
+    """
+
+    def __init__(self, dim=1536, latency=0.0, throttle_rate=0.0):
+        self.dim = dim
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+
+    def _vector(self, text):
+        rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+        vector = [rng.gauss(0.0, 1.0) for _ in range(self.dim)]
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def embed_documents(self, texts):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.throttle_rate and random.random() < self.throttle_rate:
+            raise ThrottledError("429 Throttling.RateQuota (fake)")
+        return [self._vector(t) for t in texts]
+
+    def embed_query(self, text):
+        return self._vector(text)
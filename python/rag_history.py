@@ -0,0 +1,144 @@
+# 带 token 预算的对话记忆 (最近 N 轮原文 + 更早的滚动摘要)
+# 痛点: 22.py 的 st.session_state.chat_history 只增不减，原封不动塞进 改写 Prompt 和 回答 Prompt，
+#       聊得越久 Prompt 越长，延迟和费用跟着线性涨。
+#       2-15.py 的 ConversationSummaryMemory 又是每轮都把“整段历史”重新总结一遍，同样越聊越贵。
+# 思路:
+#   1. 最近 keep_turns 轮保留原文 (追问最依赖的就是最近几轮)
+#   2. 更老的轮次“折叠”进一段滚动摘要：每次只把 旧摘要 + 刚挤出窗口的那几轮 交给 LLM 合并，
+#      是增量更新，不从头重新总结
+#   3. 原文 + 摘要 超过 token 预算时，多折叠几轮 (至少留 1 轮原文)
+#   4. 折叠放到后台线程做：回答已经显示出来了，用户看答案、打字的时候摘要就在后台写好，
+#      下一轮取 messages() 时才 (很少需要) 等一下
+# 结果：不管聊多少轮，每轮 Prompt 里的历史大约都是 摘要上限 + keep_turns 轮原文，基本恒定。
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from rag_answer_cache import estimate_tokens
+from rag_llm import get_llm
+
+
+HISTORY_KEEP_TURNS = int(os.getenv("RAG_HISTORY_KEEP_TURNS", "3"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("RAG_HISTORY_TOKEN_BUDGET", "1500"))
+HISTORY_SUMMARY_TOKENS = int(os.getenv("RAG_HISTORY_SUMMARY_TOKENS", "300"))
+
+SUMMARY_PROMPT = """你在维护一段对话的滚动摘要。
+下面是【目前的摘要】和【刚移出窗口的几轮对话】。
+请把新对话里的关键信息 (提到的公司、指标、数字、时间、用户关心的点) 合并进摘要，
+删掉重复和不再重要的内容，输出更新后的摘要，不超过 {max_tokens} 字，只输出摘要本身。
+
+【目前的摘要】
+{summary}
+
+【刚移出窗口的几轮对话】
+{turns}
+"""
+
+_FOLD_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="history")
+
+
+def _turn_tokens(turn):
+    return estimate_tokens(turn[0]) + estimate_tokens(turn[1])
+
+
+class CompactingHistory:
+    """
+    用法 (存进 st.session_state)：
+        history = CompactingHistory()
+        history.messages()                 # -> 给 MessagesPlaceholder("chat_history") 用的消息列表
+        history.add_turn(question, answer) # 一轮结束后记一笔 (超出窗口的旧轮次后台折叠进摘要)
+    """
+
+    def __init__(self, llm=None, keep_turns=HISTORY_KEEP_TURNS, token_budget=HISTORY_TOKEN_BUDGET,
+                 summary_tokens=HISTORY_SUMMARY_TOKENS):
+        self.llm = llm
+        self.keep_turns = max(1, keep_turns)
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self.summary = ""
+        self.turns = []            # [(question, answer)]，最近几轮原文
+        self.total_turns = 0
+        self.folded_turns = 0
+        self.summary_calls = 0
+        self._pending = None       # 正在后台写的摘要
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.total_turns
+
+    def __bool__(self):
+        return self.total_turns > 0
+
+    def add_turn(self, question, answer):
+        self._wait()
+        with self._lock:
+            self.turns.append((question, answer))
+            self.total_turns += 1
+            folding = self._take_overflow()
+        if folding:
+            self._pending = _FOLD_POOL.submit(self._fold, folding)
+
+    def messages(self):
+        """摘要 (一条 SystemMessage) + 最近几轮原文"""
+        self._wait()
+        with self._lock:
+            messages = []
+            if self.summary:
+                messages.append(SystemMessage(content=f"之前对话的摘要：{self.summary}"))
+            for question, answer in self.turns:
+                messages.extend([HumanMessage(content=question), AIMessage(content=answer)])
+            return messages
+
+    def prompt_tokens(self):
+        with self._lock:
+            return estimate_tokens(self.summary) + sum(_turn_tokens(t) for t in self.turns)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "turns": self.total_turns,
+                "verbatim_turns": len(self.turns),
+                "folded_turns": self.folded_turns,
+                "summary_calls": self.summary_calls,
+                "summary_tokens": estimate_tokens(self.summary),
+                "prompt_tokens": estimate_tokens(self.summary) + sum(_turn_tokens(t) for t in self.turns),
+            }
+
+    # --- 内部实现 ---
+    def _take_overflow(self):
+        """挑出要折叠的旧轮次 (调用前已拿到锁)：先按轮数，再按 token 预算"""
+        folding = []
+        while len(self.turns) > self.keep_turns:
+            folding.append(self.turns.pop(0))
+        budget = self.token_budget - self.summary_tokens
+        while len(self.turns) > 1 and sum(_turn_tokens(t) for t in self.turns) > budget:
+            folding.append(self.turns.pop(0))
+        return folding
+
+    def _fold(self, folding):
+        """增量摘要：只看 旧摘要 + 这几轮，不重读整段历史"""
+        turns = "\n".join(f"用户：{q}\n助手：{a}" for q, a in folding)
+        prompt = SUMMARY_PROMPT.format(max_tokens=self.summary_tokens, summary=self.summary or "(暂无)", turns=turns)
+        try:
+            llm = self.llm or get_llm("qwen-turbo")
+            summary = llm.invoke(prompt).content.strip()
+        except Exception as e:
+            # 摘要失败不能把这几轮丢了：退回拼接原文 (超长就截掉最老的部分)
+            print(f"⚠️ 对话摘要失败，先直接拼接: {e}")
+            summary = f"{self.summary}\n{turns}".strip()
+        # 模型没守字数就硬截断，保证每轮 Prompt 大小有上限 (保留最新的部分)
+        if estimate_tokens(summary) > self.summary_tokens * 2:
+            summary = summary[-self.summary_tokens * 2:]
+        with self._lock:
+            self.summary = summary
+            self.folded_turns += len(folding)
+            self.summary_calls += 1
+
+    def _wait(self):
+        pending = self._pending
+        if pending is not None:
+            pending.result()
+            self._pending = None
@@ -0,0 +1,178 @@
+# 混合检索 (BM25 关键词 + 向量语义，RRF 融合)
+# 痛点: 纯向量检索对“专有名词 / 精确术语”很不敏感，问 "GAAP Gross Margin" 经常捞不到那一段，
+#       22.py 只好先多调一次 LLM 把问题翻译成英文来“凑”召回率。
+# 思路:
+#   1. 入库时顺手建一个内存倒排索引 (BM25)，和向量库放在一起，不花一分钱 API 费用
+#   2. 中文没有空格：装了 jieba 就用 jieba 分词，没装就把连续汉字切成“双字组” (二元组)，
+#      英文 / 数字按单词切，统一转小写
+#   3. 检索时两路各取 fetch_k 个，用 RRF (倒数排名融合) 合并：score = Σ 1 / (rrf_k + 排名)
+#      不用管两路分数的量纲，哪一路排得靠前都能上来
+#   4. 第一轮召回准了，最终塞给 LLM 的块数 k 就可以减下来 -> 上下文更短、生成更快、更省 token
+
+import heapq
+import math
+import os
+import re
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+from typing import Any, List
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from rag_cache import chunk_hash
+
+try:
+    import jieba  # 可选依赖：有就用更准的中文分词
+except ImportError:
+    jieba = None
+
+
+RETRIEVER_MODE = os.getenv("RAG_RETRIEVER", "hybrid")  # hybrid / vector
+TOP_K = int(os.getenv("RAG_TOP_K", "4"))               # 最终塞进上下文的块数 (纯向量时是 5)
+FETCH_K = int(os.getenv("RAG_FETCH_K", "12"))          # 每一路先各捞多少个候选
+RRF_K = int(os.getenv("RAG_RRF_K", "60"))              # RRF 的平滑常数，论文里的经验值是 60
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[.,][0-9]+)*%?|[\u3400-\u4dbf\u4e00-\u9fff]+")
+
+
+def _is_cjk(token):
+    return "\u3400" <= token[0] <= "\u9fff"
+
+
+def tokenize(text):
+    """中英混合分词：英文按单词、数字连同小数点和百分号、中文用 jieba 或者双字组"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = []
+    for token in _TOKEN_RE.findall(text):
+        if not _is_cjk(token):
+            tokens.append(token)
+        elif jieba is not None:
+            tokens.extend(t for t in jieba.lcut_for_search(token) if t.strip())
+        elif len(token) == 1:
+            tokens.append(token)
+        else:
+            tokens.extend(token[i:i + 2] for i in range(len(token) - 1))
+    return tokens
+
+
+class BM25Index:
+    """
+    内存倒排索引：term -> {块 key: 词频}
+    支持增量 add / remove (配合 session 里按文档增删)，检索只扫查询词命中的倒排链
+    增删和检索可能在不同线程里同时发生，所以都在一把锁里做
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(dict)
+        self.doc_len = {}
+        self.docs = {}
+        self.total_len = 0
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_texts(cls, texts, metadatas=None, keys=None):
+        index = cls()
+        metadatas = metadatas or [{} for _ in texts]
+        for n, (text, metadata) in enumerate(zip(texts, metadatas)):
+            index.add(keys[n] if keys else n, text, metadata)
+        return index
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, key, text, metadata=None):
+        counts = Counter(tokenize(text))
+        with self._lock:
+            if key in self.docs:
+                self.remove(key)
+            for term, tf in counts.items():
+                self.postings[term][key] = tf
+            length = sum(counts.values())
+            self.doc_len[key] = length
+            self.total_len += length
+            self.docs[key] = Document(page_content=text, metadata=dict(metadata or {}))
+
+    def remove(self, key):
+        with self._lock:
+            document = self.docs.pop(key, None)
+            if document is None:
+                return
+            for term in set(tokenize(document.page_content)):
+                posting = self.postings.get(term)
+                if posting is not None:
+                    posting.pop(key, None)
+                    if not posting:
+                        del self.postings[term]
+            self.total_len -= self.doc_len.pop(key)
+
+    def update_metadata(self, key, metadata):
+        """块内容没变、只有元数据变了 (比如页码)：不用重新分词"""
+        with self._lock:
+            document = self.docs.get(key)
+            if document is not None:
+                self.docs[key] = Document(page_content=document.page_content, metadata=dict(metadata or {}))
+
+    def apply_changes(self, changes):
+        """按 rag_store.upsert_document 返回的 changes 增量更新"""
+        for key in changes.get("removed", ()):
+            self.remove(key)
+        for key, text, metadata in changes.get("added", ()):
+            self.add(key, text, metadata)
+        for key, metadata in changes.get("updated", ()):
+            self.update_metadata(key, metadata)
+
+    def search(self, query, k=FETCH_K):
+        """返回 [(Document, 分数)]，分数从高到低"""
+        terms = set(tokenize(query))
+        with self._lock:
+            if not self.docs:
+                return []
+            total = len(self.docs)
+            avg_len = self.total_len / total or 1.0
+            scores = defaultdict(float)
+            for term in terms:
+                posting = self.postings.get(term)
+                if not posting:
+                    continue
+                idf = math.log(1 + (total - len(posting) + 0.5) / (len(posting) + 0.5))
+                for key, tf in posting.items():
+                    norm = self.k1 * (1 - self.b + self.b * self.doc_len[key] / avg_len)
+                    scores[key] += idf * tf * (self.k1 + 1) / (tf + norm)
+            top = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+            return [(self.docs[key], score) for key, score in top]
+
+
+def reciprocal_rank_fusion(rankings, k=TOP_K, rrf_k=RRF_K):
+    """
+    rankings: 多路检索结果，每一路是按相关度排好序的 Document 列表
+    同样内容的块 (按块指纹) 在不同路里出现会合并成一个，分数累加
+    """
+    scores = defaultdict(float)
+    documents = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking):
+            key = chunk_hash(document.page_content)
+            scores[key] += 1.0 / (rrf_k + rank + 1)
+            documents.setdefault(key, document)
+    top = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+    return [documents[key] for key, _ in top]
+
+
+class HybridRetriever(BaseRetriever):
+    """向量库 + BM25 两路召回，RRF 融合；用法和 vectorstore.as_retriever() 一样"""
+
+    vectorstore: Any
+    index: Any
+    k: int = TOP_K
+    fetch_k: int = FETCH_K
+    rrf_k: int = RRF_K
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        vector_hits = self.vectorstore.similarity_search(query, k=self.fetch_k)
+        keyword_hits = [document for document, _ in self.index.search(query, self.fetch_k)]
+        return reciprocal_rank_fusion([vector_hits, keyword_hits], k=self.k, rrf_k=self.rrf_k)
@@ -0,0 +1,151 @@
+# 入库流水线 (解析 -> 切分 -> Embedding，三段流式重叠)
+# 从 27.py 的 build_rag_chain_from_file 里拆出来的“纯计算”部分：
+# 只产出 块文本 / 元数据 / 向量，不碰 Chroma、不碰 LLM，
+# 所以它既能在线程里跑，也能丢到别的进程里跑 (返回值都能 pickle)。
+# 线程里跑的时候可以再给一个 sink：每算完一批向量就交给它写库，不用等整本算完。
+
+import os
+
+import numpy as np
+from langchain_community.embeddings import DashScopeEmbeddings
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from rag_cache import IngestCache, chunk_hash, make_ingest_key, sha256_bytes, sha256_file
+from rag_embed import EMBED_BATCH_SIZE, FakeEmbeddings, embed_in_batches
+from rag_pdf import iter_pdf_pages
+
+
+# 切分参数 & 模型名 (它们都是入库缓存 Key 的一部分)
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+EMBEDDING_MODEL = "text-embedding-v1"
+EMBEDDING_DIM = 1536  # text-embedding-v1 的向量维度，用来估算内存
+# dashscope = 真实接口；fake = 本地假 Embedding (压测 / 离线调试，不花钱)
+EMBEDDING_BACKEND = os.getenv("RAG_EMBEDDING_BACKEND", "dashscope")
+# 写进入库缓存 Key 的模型名：假向量绝不能和真模型的缓存混在一起
+EMBEDDING_CACHE_NAME = EMBEDDING_MODEL if EMBEDDING_BACKEND == "dashscope" else f"{EMBEDDING_BACKEND}-{EMBEDDING_DIM}"
+
+# 进度阶段 (前端轮询 /upload/{job_id} 时看到的就是这几个)
+STAGES = ("parse", "split", "embed", "index")
+
+_INGEST_CACHE = None
+
+
+def get_ingest_cache():
+    # 懒加载：进程池里的子进程也会各自建一个 (指向同一个磁盘目录)
+    global _INGEST_CACHE
+    if _INGEST_CACHE is None:
+        _INGEST_CACHE = IngestCache()
+    return _INGEST_CACHE
+
+
+def get_embeddings():
+    if EMBEDDING_BACKEND == "fake":
+        return FakeEmbeddings(dim=EMBEDDING_DIM)
+    return DashScopeEmbeddings(model=EMBEDDING_MODEL, dashscope_api_key=os.getenv("ALIYUN_API_KEY"))
+
+
+def content_metadata(metadata):
+    """只保留由 PDF 内容决定的元数据 (页码、总页数)，去掉文件名这种每次上传都可能不一样的"""
+    return {key: value for key, value in metadata.items() if key != "source"}
+
+
+def report(progress, stage, done, total):
+    """progress 是可选的回调：progress(stage, done, total)"""
+    if progress is not None:
+        progress(stage, done, total)
+
+
+def ingest_pdf(source, progress=None, file_sha256=None, name=None, known_hashes=None, sink=None):
+    """
+    PDF -> (texts, metadatas, vectors)
+    source: PDF 路径或者内存里的 bytes (见 rag_upload.spool_upload)
+    file_sha256: 上传时已经算好的指纹，传进来就不用再读一遍文件
+    known_hashes: 库里已经有向量的块指纹 (增量更新用)，这些块不再 Embedding，对应位置的向量返回 None
+    sink(texts, metadatas, positions, vectors)：每算完一批向量就交出去 (比如直接写进 session 的库，见 rag_store.DocumentWriter)，
+        positions 是这一批块在 texts 里的下标；传了 sink 就不再攒整本的向量，返回的 vectors 是 None
+        (sink 要和调用方在同一个进程里，进程池模式用不了，还是整本算完一起返回)
+    命中入库缓存时直接返回 (有 sink 就按批交给它)，跳过 解析/切分/Embedding
+    """
+    print(f"⚙️ 开始处理文件: {name or (source if isinstance(source, str) else f'<内存 {len(source)} 字节>')} ...")
+    cache = get_ingest_cache()
+    # 和 iter_pdf_pages 的默认名一致：写进每个块 metadata["source"] 的文件名
+    name = name or (str(source) if isinstance(source, (str, os.PathLike)) else "upload.pdf")
+
+    # 0. 先查入库缓存 (Key = PDF 指纹 + 切分参数 + 模型名)
+    if file_sha256 is None:
+        file_sha256 = sha256_bytes(source) if isinstance(source, (bytes, bytearray)) else sha256_file(source)
+    cache_key = make_ingest_key(file_sha256, CHUNK_SIZE, CHUNK_OVERLAP, EMBEDDING_CACHE_NAME)
+    cached = cache.get(cache_key)
+
+    if cached:
+        print("⚡ 命中入库缓存，跳过 解析/切分/Embedding！")
+        for stage in ("parse", "split"):
+            report(progress, stage, 1, 1)
+        # 缓存里只有和内容有关的元数据 (页码等)；文件名是这次上传的，同样的字节换个名字传上来不能沿用上一个人的
+        texts = cached["texts"]
+        metadatas = [{**metadata, "source": name} for metadata in cached["metadatas"]]
+        if sink is None:
+            report(progress, "embed", 1, 1)
+            return texts, metadatas, cached["vectors"]
+        for start in range(0, len(texts), EMBED_BATCH_SIZE):
+            positions = list(range(start, min(start + EMBED_BATCH_SIZE, len(texts))))
+            sink(texts, metadatas, positions, cached["vectors"][start:positions[-1] + 1])
+            report(progress, "embed", positions[-1] + 1, len(texts))
+        return texts, metadatas, None
+
+    # A+B+C 流水线：逐页解析 (多进程) -> 逐页切分 -> 攒够一批就送去 Embedding
+    # 三段是重叠着跑的：后面的页还在解析，前面的块已经在算向量了
+    # (原来就是按页切分的，逐页切出来的块和一次性 split_documents 完全一样)
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    texts = []
+    metadatas = []
+    to_embed = []  # 真正需要 Embedding 的块在 texts 里的下标
+    embedded = [0]
+    packed = {}    # 有 sink 时：给入库缓存留一份 float32 的向量 (比 Python 的 float 列表小 8 倍左右)
+    known_hashes = known_hashes or set()
+
+    def iter_chunks():
+        # 总页数要打开 PDF 才知道，先报 0 / 0 (= 已开始，总数未知)
+        report(progress, "parse", 0, 0)
+        for page in iter_pdf_pages(source, name=name):
+            total_pages = page.metadata["total_pages"]
+            for doc in text_splitter.split_documents([page]):
+                texts.append(doc.page_content)
+                metadatas.append(doc.metadata)
+                if known_hashes and chunk_hash(doc.page_content) in known_hashes:
+                    continue
+                to_embed.append(len(texts) - 1)
+                yield doc.page_content
+            report(progress, "parse", page.metadata["page"] + 1, total_pages)
+            report(progress, "split", page.metadata["page"] + 1, total_pages)
+        print(f"📄 文档已切分为 {len(texts)} 段。")
+
+    def on_batch(start, batch_texts, batch_vectors):
+        if sink is not None:
+            # 这一批马上写库，写完就能被检索到；不用等整本算完
+            sink(texts, metadatas, to_embed[start:start + len(batch_vectors)], batch_vectors)
+            packed[start] = np.asarray(batch_vectors, dtype=np.float32)
+        # 总块数要等整本解析完才知道，先报“已切出来的块数”
+        embedded[0] += len(batch_vectors)
+        report(progress, "embed", embedded[0], max(embedded[0], len(to_embed)))
+
+    # 分批并发调用，被限流会自动降并发 + 退避；每完成一批就更新一次进度
+    fresh = embed_in_batches(get_embeddings(), iter_chunks(), on_batch=on_batch, keep=sink is None)
+    report(progress, "embed", embedded[0], len(to_embed))
+
+    if len(to_embed) < len(texts):
+        print(f"♻️ {len(texts) - len(to_embed)} 个块库里已有向量，跳过 Embedding")
+    if sink is not None:
+        if packed and len(to_embed) == len(texts):
+            cache.put(cache_key, texts, [content_metadata(metadata) for metadata in metadatas],
+                      np.concatenate([packed[start] for start in sorted(packed)]))
+        return texts, metadatas, None
+
+    vectors = [None] * len(texts)
+    for index, vector in zip(to_embed, fresh):
+        vectors[index] = vector
+    if len(to_embed) == len(texts):
+        # 只有完整的结果才写入库缓存；source (文件名) 不进缓存，命中时换成当次上传的名字
+        cache.put(cache_key, texts, [content_metadata(metadata) for metadata in metadatas], vectors)
+    return texts, metadatas, vectors
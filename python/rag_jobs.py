@@ -0,0 +1,175 @@
+# 后台入库任务 (Background Ingestion Jobs)
+# 痛点: upload_pdf 是 async def，却直接调用同步的 build_rag_chain_from_file，
+#       一个大 PDF 就把 uvicorn 的事件循环卡死，所有人的 /chat/stream 一起停住。
+# 思路: /upload 只负责“收件 + 登记”，马上返回 job_id；
+#       真正的 解析/切分/Embedding 丢到线程池 (或进程池) 里慢慢跑，
+#       前端拿着 job_id 去 GET /upload/{job_id} 轮询每个阶段的进度。
+
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import Manager
+
+from rag_admission import AdmissionRejected
+from rag_ingest import STAGES
+
+
+class ProgressReporter:
+    """
+    进度回调：progress(stage, done, total)
+    shared 可以是普通 dict (线程模式)，也可以是 Manager().dict() (进程模式，子进程写、主进程读)
+    这个类本身能被 pickle，所以可以直接传给进程池里的函数
+    解析 / 切分 / Embedding 是重叠着跑的，所以每个阶段各记各的计数，互不覆盖：
+    key = (job_id, stage)，子进程写前三个阶段、主进程收尾时写 index，谁也不会抹掉谁的
+    """
+
+    def __init__(self, shared, job_id):
+        self.shared = shared
+        self.job_id = job_id
+
+    def __call__(self, stage, done, total):
+        # Manager 的 dict 代理只认“整体赋值”，所以每次写一份完整快照
+        self.shared[(self.job_id, stage)] = {"done": done, "total": total}
+
+    def read(self):
+        """{stage: {"done", "total"}}，只包含已经报过进度的阶段"""
+        snapshot = {}
+        for stage in STAGES:
+            progress = self.shared.get((self.job_id, stage))
+            if progress:
+                snapshot[stage] = dict(progress)
+        return snapshot
+
+    def clear(self):
+        for stage in STAGES:
+            self.shared.pop((self.job_id, stage), None)
+
+
+class IngestJobs:
+    """
+    用法：
+        job_id = jobs.submit(session_id, filename, work, finish, cleanup, ticket)
+        jobs.get(job_id)  # -> 状态 + 每个阶段的进度
+    work(progress) 是重活 (可以跑在进程池里)，finish(result, progress) 在线程里收尾 (建库、建链)
+    ticket (可选) 是 rag_admission 的准入票：拿到放行才开始跑 (之前一直是 queued)，跑完归还；
+    排队超过 max_wait 就标成 failed (error 里带“排队超时”)
+    """
+
+    def __init__(self, workers=2, use_processes=False, max_jobs=1000, threads=None):
+        self.use_processes = use_processes
+        self.max_jobs = max_jobs
+        # 线程池负责“调度 + 收尾”，进程池 (可选) 负责 CPU 重活
+        # 配了准入控制时线程要多开一些 (= 并发 + 队列长度)：排队的任务各占一个线程等放行，
+        # 真正同时干活的数量由准入池决定，放行顺序才能是按 session 轮流而不是线程池的先来先到
+        self._threads = ThreadPoolExecutor(max_workers=threads or workers, thread_name_prefix="ingest")
+        if use_processes:
+            self._processes = ProcessPoolExecutor(max_workers=workers)
+            self._manager = Manager()
+            self._progress = self._manager.dict()
+        else:
+            self._processes = None
+            self._progress = {}
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, session_id, filename, work, finish, cleanup=None, ticket=None):
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._jobs[job_id] = {
+                "job_id": job_id,
+                "session_id": session_id,
+                "filename": filename,
+                "status": "queued",
+                "stage": None,
+                "stages": {stage: {"done": 0, "total": 0} for stage in STAGES},
+                "error": None,
+                "result": None,
+                "created_at": time.time(),
+                "finished_at": None,
+            }
+            self._trim()
+        self._threads.submit(self._run, job_id, work, finish, cleanup, ticket)
+        return job_id
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            self._apply_progress(job)
+            return {**job, "stages": {k: dict(v) for k, v in job["stages"].items()}}
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+            return counts
+
+    def _run(self, job_id, work, finish, cleanup, ticket=None):
+        progress = ProgressReporter(self._progress, job_id)
+        try:
+            if ticket is not None:
+                try:
+                    # 排队也有上限 (RAG_ADMIT_MAX_WAIT_S)，等不到就判失败，别一直挂在 queued
+                    ticket.wait(ticket.pool.max_wait)
+                except AdmissionRejected as e:
+                    print(f"⏳ 入库任务 {job_id} 排队超时")
+                    self._update(job_id, status="failed", error=str(e))
+                    return
+            self._update(job_id, status="running")
+            if self._processes is not None:
+                result = self._processes.submit(work, progress).result()
+            else:
+                result = work(progress)
+            # finish 可以返回一个小 dict (比如增量更新了多少块)，查进度时一起带回去
+            outcome = finish(result, progress)
+            self._update(job_id, status="done", result=outcome)
+        except Exception as e:
+            print(f"❌ 入库任务 {job_id} 失败: {e}")
+            self._update(job_id, status="failed", error=str(e))
+        finally:
+            if ticket is not None:
+                ticket.release()
+            if cleanup is not None:
+                cleanup()
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            self._apply_progress(job)
+            job.update(fields)
+            if fields.get("status") in ("done", "failed"):
+                job["finished_at"] = time.time()
+                ProgressReporter(self._progress, job_id).clear()
+
+    def _apply_progress(self, job):
+        # 把每个阶段各自的计数合并进任务记录 (调用前已拿到锁)
+        # 不因为后面的阶段报了进度就把前面的阶段标成完成：它们是同时在跑的
+        snapshot = ProgressReporter(self._progress, job["job_id"]).read()
+        for stage, progress in snapshot.items():
+            job["stages"][stage] = progress
+            # “当前阶段” = 已经开始的最靠后的阶段
+            job["stage"] = stage
+
+    def _trim(self):
+        # 只保留最近 max_jobs 个任务记录，跑完的旧任务先删
+        while len(self._jobs) > self.max_jobs:
+            for job_id, job in self._jobs.items():
+                if job["status"] in ("done", "failed"):
+                    del self._jobs[job_id]
+                    break
+            else:
+                break
+
+
+def ingest_jobs_from_env(threads=None):
+    """从环境变量读配置：RAG_INGEST_WORKERS (默认 2)，RAG_INGEST_POOL=thread|process (默认 thread)"""
+    workers = int(os.getenv("RAG_INGEST_WORKERS", "2"))
+    use_processes = os.getenv("RAG_INGEST_POOL", "thread").lower() == "process"
+    return IngestJobs(workers=workers, use_processes=use_processes, threads=threads)
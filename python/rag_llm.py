@@ -0,0 +1,147 @@
+# 大模型客户端工厂 + 进程级注册表
+# 所有脚本都从这里拿 LLM，方便统一切换后端：
+#   RAG_LLM_BACKEND=tongyi (默认) -> ChatTongyi (DashScope SDK)
+#   RAG_LLM_BACKEND=openai        -> ChatOpenAI 走 DashScope 的 OpenAI 兼容接口
+#   RAG_LLM_BACKEND=fake          -> 本地假模型，一个字一个字地“吐”，压测 / 离线调试用，不花钱
+# 痛点: 每个脚本自己 new ChatOpenAI(...) / ChatTongyi(...)，有的还是每次调用 new 一个：
+#       每个新客户端 = 一个新的 HTTP 连接池 = 每次都重新 TCP + TLS 握手，白白多几十到几百毫秒。
+# 思路:
+#   1. get_llm(model, temperature, provider) 按 (provider, model, temperature) 返回进程级单例
+#   2. 所有 openai 兼容客户端共用一个 httpx 连接池 (同步 + 异步各一个)，keep-alive，上限可配；
+#      DashScope SDK 本身有一个全局 requests.Session，这里把它的连接池上限也调成同样的配置
+#   3. warm_up()：启动时先对接口域名发一个不花钱的请求，把连接 (含 TLS 握手) 提前建好放进池子里
+#   4. bench_llm.py 对比 “每次新建客户端” 和 “注册表单例” 的单次调用延迟
+
+import os
+import threading
+import time
+
+import httpx
+from langchain_community.chat_models import ChatTongyi
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+
+LLM_BACKEND = os.getenv("RAG_LLM_BACKEND", "tongyi")
+DASHSCOPE_BASE_URL = "https://dashscope.aliyuncs.com"
+OPENAI_COMPATIBLE_URL = f"{DASHSCOPE_BASE_URL}/compatible-mode/v1"
+# 连接池上限：最多同时多少条连接 / 空闲时最多留多少条 / 空闲连接留多久 (秒)
+LLM_MAX_CONNECTIONS = int(os.getenv("RAG_LLM_MAX_CONNECTIONS", "64"))
+LLM_MAX_KEEPALIVE = int(os.getenv("RAG_LLM_MAX_KEEPALIVE", "32"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("RAG_LLM_KEEPALIVE_EXPIRY", "60"))
+LLM_TIMEOUT = float(os.getenv("RAG_LLM_TIMEOUT", "60"))
+# 假模型每吐一个字停多久 (秒)，用来模拟真实的生成速度
+FAKE_LLM_DELAY = float(os.getenv("RAG_FAKE_LLM_DELAY", "0.02"))
+FAKE_LLM_ANSWER = "根据财报，本季度 GAAP 毛利率为 18%，营收约 250 亿美元。"
+
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+_HTTP = {}
+_HTTP_LOCK = threading.Lock()
+
+
+def pool_limits():
+    return httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_KEEPALIVE,
+        keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+    )
+
+
+def shared_http_clients():
+    """openai 兼容客户端共用的 (同步, 异步) httpx 连接池"""
+    with _HTTP_LOCK:
+        if "sync" not in _HTTP:
+            _HTTP["sync"] = httpx.Client(limits=pool_limits(), timeout=LLM_TIMEOUT)
+            _HTTP["async"] = httpx.AsyncClient(limits=pool_limits(), timeout=LLM_TIMEOUT)
+        return _HTTP["sync"], _HTTP["async"]
+
+
+def _tune_dashscope_pool():
+    """
+    DashScope SDK 自己维护一个全局 requests.Session (默认池子只有 10 条连接)；
+    换成同样上限的 adapter。用的是 SDK 的内部接口，版本对不上就保持默认
+    """
+    with _HTTP_LOCK:
+        if "dashscope" in _HTTP:
+            return _HTTP["dashscope"]
+        try:
+            from dashscope.api_entities import http_request
+            session = http_request._get_shared_sync_session()
+            adapter = http_request._KeepAliveHTTPAdapter(pool_connections=4, pool_maxsize=LLM_MAX_CONNECTIONS)
+        except (ImportError, AttributeError, TypeError):
+            session = None
+        else:
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        _HTTP["dashscope"] = session
+        return session
+
+
+def _create_llm(provider, model, temperature):
+    if provider == "fake":
+        return FakeListChatModel(responses=[FAKE_LLM_ANSWER], sleep=FAKE_LLM_DELAY)
+    if provider == "openai":
+        from langchain_openai import ChatOpenAI
+        http_client, http_async_client = shared_http_clients()
+        kwargs = {} if temperature is None else {"temperature": temperature}
+        return ChatOpenAI(
+            api_key=os.getenv("ALIYUN_API_KEY"),
+            base_url=OPENAI_COMPATIBLE_URL,
+            model=model,
+            http_client=http_client,
+            http_async_client=http_async_client,
+            stream_usage=True,
+            **kwargs,
+        )
+    _tune_dashscope_pool()
+    model_kwargs = {} if temperature is None else {"temperature": temperature}
+    return ChatTongyi(model=model, dashscope_api_key=os.getenv("ALIYUN_API_KEY"), model_kwargs=model_kwargs)
+
+
+def get_llm(model="qwen-turbo", temperature=None, provider=None):
+    """
+    按 (provider, model, temperature) 返回进程级单例 (线程安全)
+    provider 不传就用 RAG_LLM_BACKEND；temperature 不传就用模型默认值
+    """
+    provider = provider or LLM_BACKEND
+    if LLM_BACKEND == "fake":
+        provider = "fake"
+    key = (provider, model, temperature)
+    llm = _CLIENTS.get(key)
+    if llm is not None:
+        return llm
+    with _CLIENTS_LOCK:
+        llm = _CLIENTS.get(key)
+        if llm is None:
+            llm = _CLIENTS[key] = _create_llm(provider, model, temperature)
+        return llm
+
+
+def warm_up(provider=None):
+    """
+    提前把到模型接口的连接建好 (TCP + TLS) 放进池子：打一个不花钱的请求，回什么状态码都无所谓
+    返回耗时 (毫秒)；网络不通只打印一句，不影响启动
+    """
+    provider = provider or LLM_BACKEND
+    if provider == "fake":
+        return 0.0
+    start = time.perf_counter()
+    try:
+        if provider == "openai":
+            shared_http_clients()[0].get(f"{OPENAI_COMPATIBLE_URL}/models")
+        else:
+            session = _tune_dashscope_pool()
+            if session is not None:
+                session.head(DASHSCOPE_BASE_URL, timeout=LLM_TIMEOUT)
+    except Exception as e:
+        print(f"⚠️ 连接预热失败 (不影响使用): {e}")
+    return (time.perf_counter() - start) * 1000
+
+
+def warm_up_in_background(provider=None):
+    threading.Thread(target=warm_up, args=(provider,), daemon=True, name="llm-warmup").start()
+
+
+def registry_stats():
+    with _CLIENTS_LOCK:
+        return {"clients": [list(key) for key in _CLIENTS], "count": len(_CLIENTS)}
@@ -0,0 +1,253 @@
+# 本地向量索引 (Pinecone 的离线替身)
+# 痛点: 28.py 只能连线上的 Pinecone，没法离线压测、没法在笔记本上跑完整的 上传 -> 提问 流程，
+#       小租户也得为一次网络往返买单。
+# 思路: 按 namespace 分文件夹，每个 namespace 里：
+#       - vectors.f32 : 一行一个 float32 向量 (已归一化)，用 numpy.memmap 映射进内存，不用整个读进来
+#       - rows.jsonl  : 和向量一行对一行的“旁车文件”，存 id / 原文 / 元数据
+#       upsert 只往后追加：同一个 id 写多次，以最后一次为准；删除 = 追加一条墓碑
+#       加载时以 rows.jsonl 为准：崩溃留下的多余向量字节 / 写了一半的行都截掉，保证第 n 行永远对着第 n 个向量
+# LocalVectorStore 把它包成 LangChain 的 VectorStore，用法和 PineconeVectorStore 一样 (namespace + as_retriever)。
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from contextlib import nullcontext
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+
+LOCAL_INDEX_DIR = os.getenv("RAG_LOCAL_INDEX_DIR", ".rag_cache/local_index")
+
+
+class _Namespace:
+    """一个 namespace 在内存里的样子：向量矩阵 (memmap) + 每一行的信息 + 哪些行还活着"""
+
+    def __init__(self, path):
+        self.path = path
+        self.dim = None
+        self.rows = []          # 每行: {"id", "text", "metadata"} 或 {"id", "deleted": True}
+        self.latest = {}        # id -> 最新的行号
+        self.matrix = None      # np.memmap，形状 (行数, dim)
+        self.alive = None       # bool 数组，标记哪些行是有效数据
+        self.lock = threading.Lock()  # 每个 namespace 一把锁，互不阻塞
+        self._load()
+
+    def _vectors_path(self):
+        return os.path.join(self.path, "vectors.f32")
+
+    def _rows_path(self):
+        return os.path.join(self.path, "rows.jsonl")
+
+    def _load(self):
+        info_path = os.path.join(self.path, "info.json")
+        if os.path.exists(info_path):
+            with open(info_path, "r", encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"]
+        if os.path.exists(self._rows_path()):
+            with open(self._rows_path(), "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        self.rows.append(json.loads(line))
+                    except ValueError:
+                        break   # 崩在半行上：这一行和后面的都不算
+        self._repair()
+        self._reindex()
+
+    def _repair(self):
+        """
+        让两个文件重新对齐 (append 是先写向量再写行，崩溃后向量可能比行多)：
+        多出来的向量字节不截掉的话，下一次追加会接在它们后面，之后所有新向量都读错位置
+        """
+        if not self.dim:
+            return
+        row_bytes = self.dim * 4
+        vectors_path = self._vectors_path()
+        size = os.path.getsize(vectors_path) if os.path.exists(vectors_path) else 0
+        if size < len(self.rows) * row_bytes:
+            # 不该出现 (行总是后写)，防御一下：只保留有向量的行
+            self.rows = self.rows[:size // row_bytes]
+        expected = len(self.rows) * row_bytes
+        if size > expected:
+            print(f"🩹 {vectors_path} 有 {(size - expected) // row_bytes} 行崩溃残留的向量，已截掉")
+            with open(vectors_path, "r+b") as f:
+                f.truncate(expected)
+        # 行文件也重写成干净的 (去掉写了一半的尾行)
+        rows_path = self._rows_path()
+        if os.path.exists(rows_path):
+            with open(rows_path, "r", encoding="utf-8") as f:
+                lines = sum(1 for line in f if line.strip())
+            if lines != len(self.rows):
+                with open(rows_path, "w", encoding="utf-8") as f:
+                    for row in self.rows:
+                        f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    def _reindex(self):
+        self.latest = {row["id"]: i for i, row in enumerate(self.rows)}
+        alive = np.zeros(len(self.rows), dtype=bool)
+        for i in self.latest.values():
+            alive[i] = not self.rows[i].get("deleted", False)
+        self.alive = alive
+        if self.rows and self.dim:
+            self.matrix = np.memmap(self._vectors_path(), dtype=np.float32, mode="r", shape=(len(self.rows), self.dim))
+        else:
+            self.matrix = None
+
+    def append(self, rows, vectors):
+        os.makedirs(self.path, exist_ok=True)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            with open(os.path.join(self.path, "info.json"), "w", encoding="utf-8") as f:
+                json.dump({"dim": self.dim}, f)
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"向量维度不一致：索引是 {self.dim}，传进来的是 {vectors.shape[1]}")
+        # 先写向量再写旁车文件：就算中途崩了，多出来的向量行也不会被 rows.jsonl 引用到 (下次加载时截掉)
+        self.matrix = None  # 释放旧的 memmap，再追加
+        with open(self._vectors_path(), "ab") as f:
+            f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        with open(self._rows_path(), "a", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self.rows.extend(rows)
+        self._reindex()
+
+    def query(self, vector, k, filter=None):
+        # 锁里只拿快照，矩阵乘法在锁外算：append 会换新的 matrix / alive，旧快照照样能用
+        with self.lock:
+            matrix, alive, rows = self.matrix, self.alive, self.rows
+        if matrix is None or not alive.any():
+            return []
+        scores = matrix @ vector
+        scores = np.where(alive, scores, -np.inf)
+        order = np.argsort(-scores)
+        results = []
+        for i in order:
+            if not np.isfinite(scores[i]):
+                break
+            row = rows[i]
+            if filter and any(row["metadata"].get(key) != value for key, value in filter.items()):
+                continue
+            results.append((row, float(scores[i])))
+            if len(results) >= k:
+                break
+        return results
+
+
+class LocalVectorIndex:
+    """
+    磁盘上的多 namespace 向量索引，接口尽量贴近 Pinecone：
+        upsert(namespace, ids, vectors, texts, metadatas)
+        query(namespace, vector, top_k, filter)
+        delete(namespace, ids) / delete_namespace(namespace)
+    """
+
+    def __init__(self, root=LOCAL_INDEX_DIR):
+        self.root = root
+        self._namespaces = {}
+        self._lock = threading.Lock()
+
+    def _namespace_path(self, namespace):
+        digest = hashlib.sha256((namespace or "").encode("utf-8")).hexdigest()[:24]
+        return os.path.join(self.root, digest)
+
+    def _get(self, namespace):
+        # 全局锁只护着 namespace 表；namespace 第一次用到才从磁盘加载
+        with self._lock:
+            ns = self._namespaces.get(namespace)
+            if ns is None:
+                ns = _Namespace(self._namespace_path(namespace))
+                self._namespaces[namespace] = ns
+            return ns
+
+    def upsert(self, namespace, ids, vectors, texts, metadatas):
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        rows = [{"id": i, "text": t, "metadata": m or {}} for i, t, m in zip(ids, texts, metadatas)]
+        ns = self._get(namespace)
+        with ns.lock:
+            ns.append(rows, vectors)
+
+    def query(self, namespace, vector, top_k=4, filter=None):
+        """返回 [(row, cosine 相似度)]，按相似度从高到低 (不同 namespace 的查询互不阻塞)"""
+        vector = _normalize(np.asarray([vector], dtype=np.float32))[0]
+        return self._get(namespace).query(vector, top_k, filter)
+
+    def delete(self, namespace, ids):
+        ns = self._get(namespace)
+        with ns.lock:
+            if ns.dim is None:
+                return
+            rows = [{"id": i, "deleted": True} for i in ids]
+            ns.append(rows, np.zeros((len(rows), ns.dim), dtype=np.float32))
+
+    def delete_namespace(self, namespace):
+        with self._lock:
+            ns = self._namespaces.pop(namespace, None)
+        with ns.lock if ns is not None else nullcontext():
+            shutil.rmtree(self._namespace_path(namespace), ignore_errors=True)
+
+    def count(self, namespace):
+        ns = self._get(namespace)
+        with ns.lock:
+            return int(ns.alive.sum())
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class LocalVectorStore(VectorStore):
+    """LangChain 包装：用法和 PineconeVectorStore(index=..., embedding=..., namespace=...) 一样"""
+
+    def __init__(self, index, embedding, namespace=None):
+        self.index = index
+        self._embedding = embedding
+        self.namespace = namespace
+
+    @property
+    def embeddings(self):
+        return self._embedding
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        vectors = self._embedding.embed_documents(texts)
+        self.index.upsert(self.namespace, ids, vectors, texts, metadatas)
+        return ids
+
+    def delete(self, ids=None, delete_all=None, **kwargs):
+        if delete_all:
+            self.index.delete_namespace(self.namespace)
+        elif ids:
+            self.index.delete(self.namespace, ids)
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4, filter=None):
+        return [
+            (Document(page_content=row["text"], metadata=row["metadata"], id=row["id"]), score)
+            for row, score in self.index.query(self.namespace, embedding, top_k=k, filter=filter)
+        ]
+
+    def similarity_search_with_score(self, query, k=4, filter=None, **kwargs):
+        return self.similarity_search_by_vector_with_score(self._embedding.embed_query(query), k, filter)
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k, filter)]
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def _select_relevance_score_fn(self):
+        # cosine 相似度 [-1, 1] -> 相关性 [0, 1]
+        return lambda score: (score + 1.0) / 2.0
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, index=None, namespace=None, **kwargs):
+        store = cls(index or LocalVectorIndex(), embedding, namespace)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
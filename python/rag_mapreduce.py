@@ -0,0 +1,219 @@
+# 可复用的 Map-Reduce 提炼引擎 (去重 + 缓存 + 限并发重试)
+# 痛点: 2-12.py 直接 map_chain.batch(所有块)：
+#       - 输入是 long_text * 5，切出来的块大半一模一样，同样的内容被反复发给 LLM
+#       - 没有缓存，跑第二遍还是全量花钱
+#       - 并发数用默认值，没有重试，一个块被限流整批就挂
+#       - 回答“无”的块也一股脑拼进 Reduce 的 Prompt
+# 思路:
+#   1. Map 之前按块内容去重：LLM 调用次数只跟“不重复的内容”有关，跟原文长度无关
+#   2. Map 结果按 (Map Prompt + 模型, 块指纹) 缓存到磁盘，Prompt 改了自动失效
+#   3. Map 阶段用 batch(max_concurrency=N) 限并发，每个块 with_retry 指数退避重试；
+#      实在失败的块跳过 (不写缓存)，不拖垮整批
+#   4. 结果是“无”的块直接丢掉，重复的结果也只留一份，Reduce 的 Prompt 变小
+#   5. 树形 Reduce (RAG_REDUCE_MODE=tree，默认)：真实财报的 Map 结果全拼起来会撑爆上下文，
+#      而且那一次调用最慢。按 token 预算把结果分组，各组 *并发* 先合并一次，
+#      合并结果再分组、再合并……直到一组装得下，最后一次调用出最终结果。
+#      耗时 ≈ 层数 × 单次调用，层数随文档大小对数增长
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+from langchain_core.output_parsers import StrOutputParser
+
+from rag_answer_cache import estimate_tokens
+from rag_cache import chunk_hash
+from rag_structured import stream_json
+
+
+MAP_CACHE_DIR = os.getenv("RAG_MAP_CACHE_DIR", ".rag_cache/map")
+MAP_CONCURRENCY = int(os.getenv("RAG_MAP_CONCURRENCY", "4"))
+MAP_MAX_RETRIES = int(os.getenv("RAG_MAP_MAX_RETRIES", "3"))
+# tree：按 token 预算分组、并发逐层合并；single：全部拼起来一次 Reduce
+REDUCE_MODE = os.getenv("RAG_REDUCE_MODE", "tree")
+# 每次 Reduce 调用里 Map 结果部分最多多少 token (要给 Prompt 本身和输出留余量)
+REDUCE_TOKEN_BUDGET = int(os.getenv("RAG_REDUCE_TOKEN_BUDGET", "3000"))
+REDUCE_MAX_LEVELS = 8
+# Map 结果是这些 (去掉标点空格之后)，说明这一块没有关键信息
+EMPTY_MARKERS = ("无", "none", "n/a")
+
+_EDGE_PUNCT = re.compile(r"^[\s\"'“”‘’。.,，:：]+|[\s\"'“”‘’。.,，:：]+$")
+
+
+def is_empty_result(result, markers=EMPTY_MARKERS):
+    return _EDGE_PUNCT.sub("", result or "").lower() in markers
+
+
+def group_by_budget(texts, budget):
+    """
+    按顺序贪心分组，每组 token 数不超过 budget
+    单条就超预算的也得放进某一组：每组至少 2 条，保证每一层都在变少
+    """
+    groups, current, used = [], [], 0
+    for text in texts:
+        tokens = estimate_tokens(text) + 1
+        if current and used + tokens > budget and len(current) >= 2:
+            groups.append(current)
+            current, used = [], 0
+        current.append(text)
+        used += tokens
+    if current:
+        if len(current) == 1 and groups:
+            groups[-1].append(current[0])
+        else:
+            groups.append(current)
+    return groups
+
+
+def model_name(llm):
+    return getattr(llm, "model_name", None) or getattr(llm, "model", None) or type(llm).__name__
+
+
+class MapCache:
+    """磁盘缓存：一个 Key 一个小 JSON 文件 (和 IngestCache 一样原子写入)"""
+
+    def __init__(self, cache_dir=MAP_CACHE_DIR):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)["result"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, key, result):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"result": result}, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(key))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class MapReduceExtractor:
+    """
+    用法：
+        extractor = MapReduceExtractor(map_prompt, llm, reduce_prompt, reduce_llm)
+        map_results = extractor.map(texts)     # 和 texts 一一对应 (失败的块是 None)
+        final = extractor.reduce(map_results)  # 去掉“无”和重复结果后再 Reduce
+        # 也可以先只给 Map 的部分，Reduce 的时候再把 reduce_chain 传进来
+        final = extractor.reduce(map_results, reduce_chain)
+    结果太多装不下一次调用时 (tree 模式) 自动分组并发、逐层合并
+    传了 schema 的话，最后那次 Reduce 走流式 JSON 解析 + 校验，返回 dict (见 rag_structured)
+        extractor.stats                        # 块数 / 去重后 / 命中缓存 / 实际调用 LLM 次数 ...
+    两个 Prompt 的输入变量都叫 {text}
+    """
+
+    def __init__(self, map_prompt, llm, reduce_prompt=None, reduce_llm=None, max_concurrency=MAP_CONCURRENCY,
+                 max_retries=MAP_MAX_RETRIES, cache=None, reduce_mode=REDUCE_MODE,
+                 reduce_token_budget=REDUCE_TOKEN_BUDGET):
+        self.map_chain = (map_prompt | llm | StrOutputParser()).with_retry(
+            stop_after_attempt=max_retries + 1,
+            wait_exponential_jitter=True,
+        )
+        self.reduce_chain = None
+        if reduce_prompt is not None:
+            self.reduce_chain = reduce_prompt | (reduce_llm or llm) | StrOutputParser()
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.reduce_mode = reduce_mode
+        self.reduce_token_budget = reduce_token_budget
+        self.cache = cache if cache is not None else MapCache()
+        # Prompt 或者模型变了，缓存 Key 就变了
+        self.prompt_key = hashlib.sha256(f"{map_prompt.template}\x00{model_name(llm)}".encode("utf-8")).hexdigest()
+        self.stats = {}
+
+    def _cache_key(self, text):
+        return hashlib.sha256(f"{self.prompt_key}|{chunk_hash(text)}".encode("utf-8")).hexdigest()
+
+    def map(self, texts):
+        unique = list(dict.fromkeys(texts))
+        results = {}
+        for text in unique:
+            cached = self.cache.get(self._cache_key(text))
+            if cached is not None:
+                results[text] = cached
+        misses = [text for text in unique if text not in results]
+
+        failed = 0
+        if misses:
+            outputs = self.map_chain.batch(
+                [{"text": text} for text in misses],
+                config={"max_concurrency": self.max_concurrency},
+                return_exceptions=True,
+            )
+            for text, output in zip(misses, outputs):
+                if isinstance(output, Exception):
+                    failed += 1
+                    print(f"⚠️ Map 失败 (已重试)，跳过这一块: {output}")
+                    continue
+                results[text] = output
+                self.cache.put(self._cache_key(text), output)
+
+        self.stats = {
+            "chunks": len(texts),
+            "unique_chunks": len(unique),
+            "cache_hits": len(unique) - len(misses),
+            "llm_calls": len(misses),
+            "failed": failed,
+        }
+        return [results.get(text) for text in texts]
+
+    def reduce_input(self, map_results):
+        """Reduce 之前：去掉失败的、“无”的，重复的结果只留一份"""
+        kept = [r.strip() for r in map_results if r is not None and not is_empty_result(r)]
+        kept = list(dict.fromkeys(kept))
+        self.stats.update(dropped=len(map_results) - len(kept), reduce_inputs=len(kept))
+        return kept
+
+    def reduce(self, map_results, reduce_chain=None, schema=None, on_partial=None):
+        reduce_chain = reduce_chain or self.reduce_chain
+        if reduce_chain is None:
+            raise ValueError("没有 Reduce 流水线：构造时传 reduce_prompt，或者 reduce(map_results, reduce_chain)")
+        kept = self.reduce_input(map_results)
+        self.stats["reduce_chars"] = len("\n".join(kept))
+        if self.reduce_mode == "tree":
+            kept = self._collapse(kept, reduce_chain)
+        else:
+            self.stats.update(reduce_levels=0, reduce_calls=1)
+        if schema is None:
+            return reduce_chain.invoke({"text": "\n".join(kept)})
+        result, stream_stats = stream_json(reduce_chain, {"text": "\n".join(kept)}, schema, on_partial)
+        self.stats["reduce_stopped_early"] = stream_stats["stopped_early"]
+        return result
+
+    def _collapse(self, texts, reduce_chain):
+        """
+        树形合并：超预算就分组并发合并一层，直到剩下的一次装得下 (最后那次调用在 reduce 里)
+        中间层用的也是 reduce_chain，所以它的输出要能再喂回给自己 (比如 JSON 片段再去重合并)
+        """
+        chain = reduce_chain.with_retry(stop_after_attempt=self.max_retries + 1, wait_exponential_jitter=True)
+        levels, calls = 0, 1
+        while (len(texts) > 1 and sum(estimate_tokens(t) + 1 for t in texts) > self.reduce_token_budget
+               and levels < REDUCE_MAX_LEVELS):
+            groups = group_by_budget(texts, self.reduce_token_budget)
+            outputs = chain.batch(
+                [{"text": "\n".join(group)} for group in groups],
+                config={"max_concurrency": self.max_concurrency},
+            )
+            levels += 1
+            calls += len(groups)
+            print(f"🌲 Reduce 第 {levels} 层: {len(texts)} 条 -> {len(groups)} 组并发合并")
+            texts = [output.strip() for output in outputs if output and not is_empty_result(output)]
+        self.stats.update(reduce_levels=levels, reduce_calls=calls)
+        return texts
+
+    def run(self, texts):
+        return self.reduce(self.map(texts))
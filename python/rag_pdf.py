@@ -0,0 +1,142 @@
+# 流式 + 多进程 PDF 解析
+# 痛点: PyPDFLoader(path).load() 是单线程一页一页解析，整本解析完才返回一个列表，
+#       切分和 Embedding 只能干等着。500 页的年报，光解析就要好久。
+# 思路:
+#   1. 把页码切成若干段，丢进进程池，每个进程自己打开 PDF 解析自己那一段 (解析是纯 CPU 活，多线程有 GIL 没用)
+#   2. 按页码顺序一页一页 yield 出去：下游拿到第 1 段就能开始切分、Embedding，不用等整本解析完
+#   3. 产出的 Document 和 PyPDFLoader 一样是“一页一个”，page 从 0 开始，下游代码不用改
+#   4. 入参可以是 路径 / bytes / memoryview (Streamlit 的 getbuffer()) / 文件对象：页数少的内存文件直接解析，不用先写临时文件
+#      页数够多 (>= MIN_PAGES_FOR_PROCESSES) 的 bytes 先写一次临时文件，子进程按路径打开并行解析
+#      (不把 bytes 传给每个子任务：每段都 pickle 一份整本 PDF，反而更慢更占内存)
+
+import io
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from langchain_core.documents import Document
+from pypdf import PdfReader
+
+
+PARSE_WORKERS = int(os.getenv("RAG_PARSE_WORKERS", str(min(4, os.cpu_count() or 1))))
+PAGES_PER_TASK = int(os.getenv("RAG_PARSE_PAGES_PER_TASK", "8"))
+# 页数太少就不开进程了，启动进程池的开销比解析本身还大
+MIN_PAGES_FOR_PROCESSES = 16
+
+
+class _BufferStream(io.RawIOBase):
+    """
+    只读地包一层内存缓冲区 (比如 Streamlit 的 uploaded_file.getbuffer())，不拷贝：
+    io.BytesIO(memoryview) 会把整个文件复制一份
+    """
+
+    def __init__(self, buffer):
+        self._view = memoryview(buffer).cast("B")
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = max(0, min(len(b), len(self._view) - self._pos))
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._view)}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        # 释放对缓冲区的引用，调用方的 getbuffer() 才能正常关掉
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+
+def _open_stream(source):
+    # bytes 直接 BytesIO (不拷贝)；bytearray / memoryview 用 _BufferStream 包一层；路径和文件对象 PdfReader 自己认
+    if isinstance(source, bytes):
+        return io.BytesIO(source)
+    if isinstance(source, (bytearray, memoryview)):
+        return _BufferStream(source)
+    return None
+
+
+def _extract_pages(path, start, end):
+    """子进程里跑：解析 [start, end) 这几页，返回纯文本 (能 pickle)"""
+    reader = PdfReader(path)
+    return [reader.pages[i].extract_text() for i in range(start, end)]
+
+
+def _page_document(name, page, total_pages, text):
+    return Document(page_content=text, metadata={"source": name, "page": page, "total_pages": total_pages})
+
+
+def iter_pdf_pages(source, workers=PARSE_WORKERS, pages_per_task=PAGES_PER_TASK, name=None):
+    """
+    按页码顺序逐页 yield Document；页数多的时候多进程并行解析
+    source: 路径 / bytes / memoryview / 文件对象；name: 写进 metadata["source"] 的名字 (默认是路径)
+    """
+    path = source if isinstance(source, (str, os.PathLike)) else None
+    name = name or (str(path) if path else "upload.pdf")
+    stream = _open_stream(source)
+    try:
+        yield from _iter_pages(source, stream, path, name, workers, pages_per_task)
+    finally:
+        if stream is not None:
+            stream.close()
+
+
+def _iter_pages(source, stream, path, name, workers, pages_per_task):
+    reader = PdfReader(stream if stream is not None else source)
+    total_pages = len(reader.pages)
+    ranges = [(start, min(start + pages_per_task, total_pages)) for start in range(0, total_pages, pages_per_task)]
+
+    parallel = workers > 1 and total_pages >= MIN_PAGES_FOR_PROCESSES
+    if path is None and parallel and isinstance(source, (bytes, bytearray, memoryview)):
+        # 上传的文件大多 < 16MB，还在内存里；页数多就落一次盘，照样走多进程
+        path = _spool_to_temp(source)
+        spooled = True
+    else:
+        spooled = False
+
+    if path is None or not parallel:
+        # 同一个 reader 一路解析下去，不重复打开
+        for page in range(total_pages):
+            yield _page_document(name, page, total_pages, reader.pages[page].extract_text())
+        return
+    del reader
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # 一次性把所有段提交出去并行解析，再按顺序取结果：第 1 段好了就先 yield 第 1 段
+            futures = [pool.submit(_extract_pages, path, start, end) for start, end in ranges]
+            try:
+                for (start, _), future in zip(ranges, futures):
+                    for offset, text in enumerate(future.result()):
+                        yield _page_document(name, start + offset, total_pages, text)
+            finally:
+                for future in futures:
+                    future.cancel()
+    finally:
+        if spooled:
+            os.remove(path)
+
+
+def _spool_to_temp(data):
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as f:
+        f.write(data)
+        return f.name
+
+
+def load_pdf_pages(source, workers=PARSE_WORKERS, name=None):
+    """一次性拿到所有页 (替代 PyPDFLoader(path).load()，但是并行解析)"""
+    return list(iter_pdf_pages(source, workers, name=name))
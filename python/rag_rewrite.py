@@ -0,0 +1,211 @@
+# 问题改写服务 (中->英翻译 + 结合上下文改写，给检索用)
+# 痛点: 22.py / 2-21-UI.py 的 translate_to_english 每问一句都 new 一个 ChatTongyi，
+#       检索前先同步等一次 LLM 翻译，然后 history_aware_retriever 还要再串行等一次改写，每轮白白多几百毫秒。
+# 思路:
+#   1. 全进程共用一个 LLM 客户端 (Streamlit 每次交互都会重跑脚本，但模块只导入一次)
+#   2. “规范化后的问题 -> 译文” 放进 LRU 缓存，并且落盘 (重启后还在)；大家反复问的那几个问题直接命中
+#   3. 问题本来就基本是英文 (ASCII 字母占大头)，直接跳过翻译
+#   4. 翻译和“结合历史改写”互不依赖，两个一起并发跑，总耗时 = 慢的那一个，而不是两个相加
+#   5. 每一步花了多少毫秒、走的是哪条路 (ascii / cache / llm)，都返回给界面显示
+#   6. combined 模式：有历史时“结合上下文改写 + 翻译”合成一次调用，直接产出独立的英文检索词 (JSON 结构化输出)；
+#      第一轮没有历史，根本不用改写，只走上面那条带缓存的翻译 (英文问题连翻译都省了)
+
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+
+from rag_answer_cache import normalize_query
+from rag_llm import get_llm
+
+
+REWRITE_CACHE_PATH = os.getenv("RAG_REWRITE_CACHE", ".rag_cache/translations.json")
+REWRITE_CACHE_SIZE = int(os.getenv("RAG_REWRITE_CACHE_SIZE", "2000"))
+# 字母里 ASCII 占比达到这个数，就认为已经是英文了
+ASCII_RATIO = float(os.getenv("RAG_REWRITE_ASCII_RATIO", "0.9"))
+# combined (默认)：有历史时 改写+翻译 一次调用；parallel：改写和翻译两次调用并发跑
+REWRITE_MODE = os.getenv("RAG_REWRITE_MODE", "combined")
+
+TRANSLATE_PROMPT = "Translate the following Chinese text to English. Only output the translation, do not add any explanation: {text}"
+
+COMBINED_SYSTEM_PROMPT = """
+Given a chat history and the latest user question which might reference context in the chat history,
+formulate a standalone question which can be understood without the chat history,
+and translate that standalone question into an English search query.
+Do NOT answer the question.
+Output only a JSON object: {{"standalone": "<standalone question in the user's language>", "english": "<English search query>"}}
+"""
+COMBINED_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", COMBINED_SYSTEM_PROMPT),
+    MessagesPlaceholder("chat_history"),
+    ("human", "{input}"),
+])
+_JSON_OBJECT = re.compile(r"\{.*\}", re.S)
+
+Translation = namedtuple("Translation", ["text", "source", "ms"])
+Rewrite = namedtuple("Rewrite", ["standalone", "english", "translate_source", "translate_ms", "contextualize_ms", "total_ms"])
+
+
+def is_mostly_english(text, ratio=ASCII_RATIO):
+    """数字、标点、空格不算；剩下的字符里 ASCII 字母够多就算英文"""
+    letters = [c for c in text if c.isalpha()]
+    if not letters:
+        return True
+    return sum(c.isascii() for c in letters) / len(letters) >= ratio
+
+
+def parse_combined(raw, question):
+    """解析 {"standalone": ..., "english": ...}；模型没按格式来，就把整段输出当成英文检索词"""
+    match = _JSON_OBJECT.search(raw)
+    if match:
+        try:
+            data = json.loads(match.group(0))
+            english = str(data.get("english") or "").strip()
+            standalone = str(data.get("standalone") or "").strip() or question
+            if english:
+                return standalone, english
+        except ValueError:
+            pass
+    return question, raw.strip() or question
+
+
+class TranslationCache:
+    """规范化问题 -> 译文 的 LRU，写一次就原子地落一次盘 (条目很小，整份重写也就几百 KB)"""
+
+    def __init__(self, path=REWRITE_CACHE_PATH, max_entries=REWRITE_CACHE_SIZE):
+        self.path = path
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self._entries.update(json.load(f))
+            except (OSError, ValueError) as e:
+                print(f"⚠️ 翻译缓存读取失败，重新开始: {e}")
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            snapshot = dict(self._entries)
+        self._save(snapshot)
+
+    def _save(self, snapshot):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class QueryRewriter:
+    """
+    用法：
+        rewriter = get_query_rewriter()
+        rewriter.translate("特斯拉毛利率多少")          # -> Translation(text, source, ms)
+        rewriter.rewrite(question, contextualize=fn)   # 翻译和 fn(question) 并发跑 -> Rewrite
+        rewriter.contextualize_and_translate(question, chat_history)  # 改写+翻译一次调用 -> Rewrite
+    """
+
+    def __init__(self, llm=None, cache=None):
+        self.llm = llm or get_llm("qwen-turbo")
+        self.cache = cache if cache is not None else TranslationCache()
+        self._pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="rewrite")
+
+    def translate(self, text):
+        start = time.perf_counter()
+        if is_mostly_english(text):
+            return Translation(text, "ascii", 0.0)
+        key = normalize_query(text)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return Translation(cached, "cache", (time.perf_counter() - start) * 1000)
+        english = self.llm.invoke(TRANSLATE_PROMPT.format(text=text)).content.strip()
+        self.cache.put(key, english)
+        return Translation(english, "llm", (time.perf_counter() - start) * 1000)
+
+    def rewrite(self, question, contextualize=None):
+        """
+        contextualize(question) -> 独立问题 (结合历史改写)；不传就原样返回
+        翻译的是用户原话，和改写同时进行
+        """
+        start = time.perf_counter()
+        translating = self._pool.submit(self.translate, question)
+        contextualize_ms = 0.0
+        standalone = question
+        if contextualize is not None:
+            standalone = contextualize(question)
+            contextualize_ms = (time.perf_counter() - start) * 1000
+        translation = translating.result()
+        return Rewrite(
+            standalone=standalone,
+            english=translation.text,
+            translate_source=translation.source,
+            translate_ms=translation.ms,
+            contextualize_ms=contextualize_ms,
+            total_ms=(time.perf_counter() - start) * 1000,
+        )
+
+    def contextualize_and_translate(self, question, chat_history):
+        """
+        combined 模式：一次调用同时完成 结合历史改写 + 翻译
+        没有历史 (第一轮) 直接跳过改写，只做 (带缓存的) 翻译
+        """
+        if not chat_history:
+            translation = self.translate(question)
+            return Rewrite(question, translation.text, translation.source, translation.ms, 0.0, translation.ms)
+
+        start = time.perf_counter()
+        raw = self.llm.invoke(COMBINED_PROMPT.format_messages(input=question, chat_history=chat_history)).content
+        standalone, english = parse_combined(raw, question)
+        elapsed = (time.perf_counter() - start) * 1000
+        return Rewrite(standalone, english, "combined", elapsed, elapsed, elapsed)
+
+    def stats(self):
+        lookups = self.cache.hits + self.cache.misses
+        return {
+            "entries": len(self.cache._entries),
+            "hits": self.cache.hits,
+            "misses": self.cache.misses,
+            "hit_rate": round(self.cache.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+_REWRITER = None
+_REWRITER_LOCK = threading.Lock()
+
+
+def get_query_rewriter():
+    """全进程共用一个 (共用 LLM 客户端 + 翻译缓存)"""
+    global _REWRITER
+    with _REWRITER_LOCK:
+        if _REWRITER is None:
+            _REWRITER = QueryRewriter()
+        return _REWRITER
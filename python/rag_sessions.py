@@ -0,0 +1,202 @@
+# Session 仓库 (带内存预算的 LRU + 闲置过期)
+# 痛点: RAG_CHAINS = {} 只进不出，每个 session 的 Chroma 索引、检索器、LLM 客户端、链全都常驻内存，
+#       几千个 session 之后 Pod 直接 OOM。
+# 思路: 给仓库一个“内存预算”：
+#       1. 闲置太久 (idle TTL) 的 session 先清掉
+#       2. 超预算了，就把最久没人用的 (LRU) 踢出去
+#       3. 被踢掉的 session 再来提问时，如果磁盘上有持久化的索引，就用 loader 重新捞回来
+#       4. 正在用某个 session 的请求 / 入库任务先“借”一下 (lease)：借着的时候被踢出去，
+#          只是从仓库里摘掉，底层资源 (关库 / 删 collection) 等最后一个借的人还回来再释放
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+# 估算用的常数 (不追求精确，只要量级对，能防 OOM 就行)
+BYTES_PER_FLOAT = 4            # Chroma / HNSW 里向量按 float32 存
+INDEX_OVERHEAD = 1.5           # HNSW 图结构 + id 映射，大概是向量本身的 0.5 倍
+BYTES_PER_CHAR = 2             # 原文 (中英文混合) 平均每个字符占用
+SESSION_BASE_BYTES = 256 * 1024  # 每个 session 固定开销：LLM 客户端、链对象、检索器
+
+
+def estimate_session_bytes(num_chunks, total_chars, vector_dim):
+    """根据块数、原文字数、向量维度，估算一个 session 大概吃多少内存"""
+    vector_bytes = num_chunks * vector_dim * BYTES_PER_FLOAT * INDEX_OVERHEAD
+    text_bytes = total_chars * BYTES_PER_CHAR
+    return int(SESSION_BASE_BYTES + vector_bytes + text_bytes)
+
+
+class SessionStore:
+    """
+    用法和以前的 dict 差不多：
+        store.put(session_id, chain, size_bytes)
+        chain = store.get(session_id)   # 没有就返回 None (有 loader 的话会先尝试从磁盘恢复)
+        with store.lease(session_id):   # 用着 session 底层的库的时候，先借着
+            ...
+    """
+
+    def __init__(self, max_bytes, idle_ttl=None, loader=None, on_evict=None):
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl        # 秒；None 表示不按闲置时间清理
+        self.loader = loader            # loader(session_id) -> (chain, size_bytes) 或 None
+        self.on_evict = on_evict        # on_evict(session_id)：被淘汰时释放底层资源 (比如内存里的 collection)
+        self._entries = OrderedDict()   # session_id -> [chain, size_bytes, last_used]
+        self._total_bytes = 0
+        self._users = {}                # session_id -> [正在借着它的请求 / 任务数, 写锁]
+        self._deferred = set()          # 被踢出去时还有人借着，等还完了再 on_evict 的 session
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rehydrations = 0
+
+    def __contains__(self, session_id):
+        with self._lock:
+            return session_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, session_id):
+        with self._lock:
+            self._expire_idle()
+            entry = self._entries.get(session_id)
+            if entry is not None:
+                entry[2] = time.monotonic()
+                self._entries.move_to_end(session_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        # 没命中：在锁外面去磁盘捞 (重建链比较慢，不能卡住其他 session)
+        if self.loader is None:
+            return None
+        loaded = self.loader(session_id)
+        if loaded is None:
+            return None
+        chain, size_bytes = loaded
+        self.rehydrations += 1
+        self.put(session_id, chain, size_bytes)
+        return chain
+
+    def put(self, session_id, chain, size_bytes):
+        with self._lock:
+            # 又放回来了：底层资源还要接着用，之前推迟的释放作废
+            self._deferred.discard(session_id)
+            self._remove(session_id)
+            self._entries[session_id] = [chain, size_bytes, time.monotonic()]
+            self._total_bytes += size_bytes
+            self._evict_over_budget(keep=session_id)
+
+    def pop(self, session_id):
+        with self._lock:
+            entry = self._remove(session_id)
+            return entry[0] if entry else None
+
+    def acquire(self, session_id):
+        """借用一个 session (请求 / 入库任务开始用它底层的库)，用完必须 release"""
+        with self._lock:
+            user = self._users.setdefault(session_id, [0, None])
+            user[0] += 1
+
+    def release(self, session_id):
+        """还回去；最后一个还的人，顺手把借用期间被踢出去的 session 释放掉"""
+        with self._lock:
+            user = self._users[session_id]
+            user[0] -= 1
+            if user[0]:
+                return
+            # 没人借了，写锁也跟着扔掉 (锁只有借着的人会拿，这时候肯定没人拿着)
+            del self._users[session_id]
+            if session_id in self._deferred:
+                self._deferred.discard(session_id)
+                self._release(session_id)
+
+    def write_lock(self, session_id):
+        """
+        同一个 session 的写操作 (整库替换 / 增量更新 / 删除) 排队用的锁，必须先借着这个 session 才能拿；
+        挂在借用记录上，最后一个人还回来就扔掉，不会像 defaultdict(Lock) 那样每个 session 留一把
+        """
+        with self._lock:
+            user = self._users[session_id]
+            if user[1] is None:
+                user[1] = threading.Lock()
+            return user[1]
+
+    @contextmanager
+    def lease(self, session_id):
+        self.acquire(session_id)
+        try:
+            yield
+        finally:
+            self.release(session_id)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "sessions": len(self._entries),
+                "used_bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "rehydrations": self.rehydrations,
+                "leased": len(self._users),
+                "deferred_releases": len(self._deferred),
+            }
+
+    # --- 下面是内部工具，调用前必须已经拿到锁 ---
+    def _remove(self, session_id):
+        entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            self._total_bytes -= entry[1]
+        return entry
+
+    def _evict(self, session_id):
+        self._remove(session_id)
+        self.evictions += 1
+        if session_id in self._users:
+            # 还有人借着 (正在回答 / 正在入库)：现在关库会把它们搞挂，等最后一个人还回来再释放
+            self._deferred.add(session_id)
+            return
+        self._release(session_id)
+
+    def _release(self, session_id):
+        if self.on_evict is not None:
+            try:
+                self.on_evict(session_id)
+            except Exception as e:
+                print(f"⚠️ 释放 session {session_id} 失败: {e}")
+
+    def _expire_idle(self):
+        if not self.idle_ttl:
+            return
+        deadline = time.monotonic() - self.idle_ttl
+        # OrderedDict 按最近使用排序，最前面的最久没用，遇到一个没过期的就可以停了
+        while self._entries:
+            session_id, entry = next(iter(self._entries.items()))
+            if entry[2] > deadline:
+                break
+            self._evict(session_id)
+            print(f"🧹 session {session_id} 闲置超时，已释放")
+
+    def _evict_over_budget(self, keep):
+        self._expire_idle()
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            session_id = next(iter(self._entries))
+            if session_id == keep:
+                break
+            self._evict(session_id)
+            print(f"🧹 内存超预算，踢出最久没用的 session {session_id}")
+
+
+def session_store_from_env(loader=None, on_evict=None):
+    """从环境变量读配置：RAG_SESSION_BUDGET_MB (默认 512)，RAG_SESSION_IDLE_TTL 秒 (默认 3600，0 表示不过期)"""
+    budget_mb = float(os.getenv("RAG_SESSION_BUDGET_MB", "512"))
+    idle_ttl = float(os.getenv("RAG_SESSION_IDLE_TTL", "3600")) or None
+    return SessionStore(int(budget_mb * 1024 * 1024), idle_ttl=idle_ttl, loader=loader, on_evict=on_evict)
@@ -0,0 +1,166 @@
+# 跨会话共享的文档索引 (给 Streamlit 的 22.py / 2-21-UI.py 用)
+# 痛点: @st.cache_resource 的 Key 是 UploadedFile 对象，同一份财报换个浏览器会话、或者重新上传一次，
+#       Key 就变了，又要整本 解析 + Embedding 一遍；而且 Chroma 全用默认 collection，不同文档会混在一起。
+# 思路:
+#   1. Key = 文件内容的 SHA-256：同样的字节 = 同一个知识库，谁先上传谁来建，后来的人直接用
+#   2. 放在模块级的仓库里 (Streamlit 每次交互都重跑脚本，但模块只导入一次) -> 整个 Streamlit 进程的所有会话共享
+#   3. 仓库就是 rag_sessions.SessionStore：有内存预算 (LRU) + 闲置过期，踢出去时顺手删掉 Chroma collection
+#   4. 同一份文件几个人同时上传，只建一次 (按 Key 加锁，后到的等先到的建完直接拿)
+#   5. 也可以手动 evict (界面上的“释放知识库”按钮)
+#   6. 一份索引可能同时被好几个会话用着：谁 get_or_build 了就记一个“租约” (holder)，
+#      踢出仓库时还有别的会话持有租约，就先只从仓库摘掉，collection 留着，等最后一个租约释放 / 过期才真正删；
+#      这期间再有人来要，直接把原来的放回仓库，不重建 (重建会删掉别人正在查的 collection)
+
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from rag_cache import sha256_bytes
+from rag_sessions import SessionStore
+from rag_store import release_session_store
+
+
+SHARED_INDEX_BUDGET_MB = float(os.getenv("RAG_SHARED_INDEX_BUDGET_MB", "1024"))
+SHARED_INDEX_IDLE_TTL = float(os.getenv("RAG_SHARED_INDEX_IDLE_TTL", "7200"))
+# 租约多久没续就算过期 (秒)：Streamlit 每次交互都会重新 get_or_build 续一次，只要比一次提问长就够
+SHARED_INDEX_LEASE_TTL = float(os.getenv("RAG_SHARED_INDEX_LEASE_TTL", "600"))
+
+
+def document_key(uploaded_file):
+    """上传文件的内容指纹 (直接在 Streamlit 的内存缓冲区上算，不拷贝)"""
+    with uploaded_file.getbuffer() as view:
+        return f"doc:{sha256_bytes(view)}"
+
+
+def session_holder(session_state):
+    """当前 Streamlit 会话的租约 id：第一次调用时生成，存进 st.session_state"""
+    if "index_holder" not in session_state:
+        session_state["index_holder"] = uuid.uuid4().hex
+    return session_state["index_holder"]
+
+
+class SharedIndexes:
+    """
+    用法：
+        value, built = indexes.get_or_build(key, build, holder)  # build() -> (value, size_bytes)，只有没命中才调用
+        indexes.evict(key, holder)
+    holder 是调用方会话的 id (比如存在 st.session_state 里的 uuid)，用来给这份索引记租约
+    """
+
+    def __init__(self, max_bytes, idle_ttl=None, lease_ttl=SHARED_INDEX_LEASE_TTL):
+        # 被 LRU / 闲置过期踢掉时，没人持有的才删 Chroma collection (持久化模式下留在磁盘上)
+        self._store = SessionStore(max_bytes, idle_ttl, on_evict=self._on_evict)
+        self._locks = defaultdict(threading.Lock)
+        self.lease_ttl = lease_ttl
+        self._lock = threading.Lock()   # 护着下面两张表 (不要拿着它去调 _store，_store 会反过来回调 _on_evict)
+        self._holders = {}              # holder -> [key, 最近一次续约时间]
+        self._entries = {}              # key -> (value, size_bytes)：仓库里的 + 踢出去但还有人持有的
+        self.builds = 0
+        self.deferred = 0
+
+    def __contains__(self, key):
+        return key in self._store
+
+    def get_or_build(self, key, build, holder=None):
+        self._expire_leases()
+        value = self._store.get(key)
+        if value is not None:
+            self._hold(holder, key)
+            return value, False
+        with self._locks[key]:
+            # 等锁的时候别人可能已经建好了
+            value = self._store.get(key)
+            if value is not None:
+                self._hold(holder, key)
+                return value, False
+            with self._lock:
+                entry = self._entries.get(key)
+            built = entry is None
+            if built:
+                entry = build()
+                with self._lock:
+                    self._entries[key] = entry
+                self.builds += 1
+            # 先记租约再放进仓库：放进去的瞬间就可能被 LRU 踢掉，有租约才不会被删
+            self._hold(holder, key)
+            self._store.put(key, *entry)
+            return entry[0], built
+
+    def evict(self, key, holder=None):
+        """手动释放：从仓库摘掉；别的会话还持有的话 collection 等它们用完再删"""
+        found = self._store.pop(key) is not None
+        if holder is not None:
+            with self._lock:
+                held = self._holders.get(holder)
+                if held is not None and held[0] == key:
+                    del self._holders[holder]
+        self._finalize(key)
+        return found
+
+    def stats(self):
+        with self._lock:
+            detached = len(self._entries) - len(self._store)
+            return {**self._store.stats(), "builds": self.builds, "holders": len(self._holders),
+                    "detached": max(0, detached), "deferred_releases": self.deferred}
+
+    # --- 内部实现 ---
+    def _hold(self, holder, key):
+        if holder is None:
+            return
+        with self._lock:
+            previous = self._holders.get(holder)
+            self._holders[holder] = [key, time.monotonic()]
+        if previous is not None and previous[0] != key:
+            # 这个会话换了一份文档：旧的那份如果已经被踢出去、又没别人用，就可以删了
+            self._finalize(previous[0])
+
+    def _held_locked(self, key):
+        return any(held_key == key for held_key, _ in self._holders.values())
+
+    def _expire_leases(self):
+        if not self.lease_ttl:
+            return
+        deadline = time.monotonic() - self.lease_ttl
+        with self._lock:
+            expired = [holder for holder, (_, seen) in self._holders.items() if seen < deadline]
+            keys = {self._holders.pop(holder)[0] for holder in expired}
+        for key in keys:
+            self._finalize(key)
+
+    def _on_evict(self, key):
+        # SessionStore 踢人时调用 (它自己的锁还拿着)：有人持有就先不删
+        with self._lock:
+            if self._held_locked(key):
+                self.deferred += 1
+                print(f"⏳ 知识库 {key[:16]}… 还有会话在用，先只从仓库摘掉")
+                return
+            if self._entries.pop(key, None) is None:
+                return
+        release_session_store(key)
+
+    def _finalize(self, key):
+        """key 已经不在仓库里、也没人持有了 -> 真正删掉 collection"""
+        with self._locks[key]:
+            if key in self._store:
+                return
+            with self._lock:
+                if self._held_locked(key) or self._entries.pop(key, None) is None:
+                    return
+            try:
+                release_session_store(key)
+            except Exception as e:
+                print(f"⚠️ 释放知识库 {key} 失败: {e}")
+
+
+def shared_indexes_from_env():
+    return SharedIndexes(
+        max_bytes=int(SHARED_INDEX_BUDGET_MB * 1024 * 1024),
+        idle_ttl=SHARED_INDEX_IDLE_TTL if SHARED_INDEX_IDLE_TTL > 0 else None,
+        lease_ttl=SHARED_INDEX_LEASE_TTL if SHARED_INDEX_LEASE_TTL > 0 else None,
+    )
+
+
+# 模块级单例：同一个 Streamlit 进程里的所有会话共用
+SHARED_INDEXES = shared_indexes_from_env()
@@ -0,0 +1,166 @@
+# 请求合并 (single-flight)：同一时刻的同一个问题，只跑一次检索 + 生成
+# 痛点: 热门财报刚发布，几十个人几秒内问了一模一样的问题 (“毛利率是多少”)。
+#       答案缓存要等第一个人 *生成完* 才有，在那之前每个请求都各自 检索 (各算一次问题向量) + 调一次 LLM，
+#       一波“惊群”就是几十倍的费用和排队。
+# 思路:
+#   1. Key = (文档分区, 规范化后的问题)：同一份文档 (哪怕是不同 session 上传的) 的同一个问题
+#   2. /chat：第一个请求 (leader) 真正去跑，后到的 (follower) 直接等它的结果，异常也一起收到
+#   3. /chat/stream：leader 的 token 流在后台任务里跑，每个 token 追加进共享缓冲区，
+#      所有订阅者从缓冲区里读：后来的人先一口气补上已经生成的部分，然后跟着实时往下走
+#   4. 某个订阅者断开不影响别人；所有订阅者都走了才取消生成 (不再为没人看的 token 付钱)
+#   5. 跑完就从表里摘掉：之后再来的同一个问题，交给答案缓存
+
+import asyncio
+import threading
+from concurrent.futures import Future
+from contextlib import aclosing, nullcontext
+
+
+class SingleFlight:
+    """
+    同步版 (在线程池里跑的接口用)：
+        result, shared = flights.do(key, fn)   # shared=True 表示搭了别人的车
+    leader 在真正干活之前还要先做点别的 (比如排队等准入) 的话，拆成两步用：
+        future, leader = flights.join(key)     # 谁是 leader 在锁里一次定下来，不会两个人都当 leader
+        if leader: ...干活... flights.finish(key, future, result=... / error=...)
+        else:      等 future 的结果
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._calls
+
+    def join(self, key):
+        """-> (future, leader)；leader 必须调用 finish，否则跟着它的人会一直等"""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is None:
+                future = self._calls[key] = Future()
+                self.leaders += 1
+                return future, True
+            self.followers += 1
+            return future, False
+
+    def finish(self, key, future, result=None, error=None):
+        """leader 收尾：把结果 (或异常) 交给所有 follower，并从表里摘掉"""
+        if isinstance(error, asyncio.CancelledError):
+            # leader 自己被取消 (客户端断开) 不该连累 follower 也被“取消”
+            error = ConnectionAbortedError("生成已取消")
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+    def do(self, key, fn):
+        future, leader = self.join(key)
+        if not leader:
+            return future.result(), True
+        try:
+            result = fn()
+        except BaseException as e:
+            self.finish(key, future, error=e)
+            raise
+        self.finish(key, future, result)
+        return result, False
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._calls), "leaders": self.leaders, "followers": self.followers}
+
+
+class _Broadcast:
+    """一次正在进行的流式生成：token 缓冲区 + 订阅者计数 (只在事件循环线程里访问，不用加锁)"""
+
+    def __init__(self):
+        self.tokens = []
+        self.meta = {}
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self, meta=None, is_disconnected=None):
+        self.subscribers += 1
+        n = 0
+        try:
+            while True:
+                while n < len(self.tokens):
+                    if is_disconnected is not None and await is_disconnected():
+                        return
+                    yield self.tokens[n]
+                    n += 1
+                if self.done:
+                    break
+                await self._changed.wait()
+            if self.error is not None:
+                raise self.error
+            if meta is not None:
+                meta.update(self.meta)
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done and self.task is not None:
+                print("🔌 所有订阅者都断开了，停止生成")
+                self.task.cancel()
+
+
+class StreamFlights:
+    """
+    异步版 (流式接口用，必须在事件循环里调用)：
+        tokens, shared = flights.subscribe(key, start, meta, is_disconnected)
+    start(meta) -> 异步 token 迭代器，只有 leader 才会调用；它往 meta 里写的东西 (参考来源)
+    在流结束时会合并进每个订阅者自己的 meta
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def __contains__(self, key):
+        return key in self._flights
+
+    def subscribe(self, key, start, meta=None, is_disconnected=None):
+        flight = self._flights.get(key)
+        shared = flight is not None
+        if shared:
+            self.followers += 1
+        else:
+            flight = self._flights[key] = _Broadcast()
+            flight.task = asyncio.create_task(self._run(key, flight, start(flight.meta)))
+            self.leaders += 1
+        return flight.subscribe(meta, is_disconnected), shared
+
+    async def _run(self, key, flight, tokens):
+        try:
+            # 被取消时顺手关掉底层的 token 流 (连带 LLM 请求)
+            async with aclosing(tokens) if hasattr(tokens, "aclose") else nullcontext(tokens) as stream:
+                async for token in stream:
+                    flight.tokens.append(token)
+                    flight.notify()
+        except asyncio.CancelledError:
+            flight.error = ConnectionAbortedError("生成已取消")
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.notify()
+
+    def stats(self):
+        return {"in_flight": len(self._flights), "leaders": self.leaders, "followers": self.followers}
+
@@ -0,0 +1,110 @@
+# SSE 编码器 (Server-Sent Events + 攒批)
+# 痛点: /chat/stream 声明了 text/event-stream，但吐出去的是裸的 token 碎片，没有 "data:" 帧，
+#       前端只能硬拼字节；而且每个小 token 都是一次单独的 write / 系统调用，前端也跟着每次重排版。
+# 思路:
+#   1. 标准 SSE 帧：每帧 "data: <JSON>\n\n"，JSON 里是 {"text": ...}，换行符也不会把帧打乱
+#   2. 攒批：token 先攒着，满 max_bytes 字节或者过了 window_ms 毫秒，才合成一帧发出去
+#   3. 结束时发一个 event: done，带上参考来源和耗时统计
+#   4. 长时间没东西发 (比如检索很慢)，发一行 ": ping" 注释保活，防止代理把连接掐掉
+
+import asyncio
+import json
+import os
+import time
+
+
+SSE_WINDOW_MS = float(os.getenv("RAG_SSE_WINDOW_MS", "30"))
+SSE_MAX_BYTES = int(os.getenv("RAG_SSE_MAX_BYTES", "64"))
+SSE_KEEPALIVE_S = float(os.getenv("RAG_SSE_KEEPALIVE_S", "15"))
+
+_DONE = object()
+
+
+def sse_event(data, event=None):
+    """编码一帧 SSE；data 统一转成一行 JSON"""
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def sse_comment(text="ping"):
+    return f": {text}\n\n"
+
+
+async def sse_stream(tokens, meta=None, window_ms=SSE_WINDOW_MS, max_bytes=SSE_MAX_BYTES, keepalive_s=SSE_KEEPALIVE_S):
+    """
+    tokens: 异步迭代器，一个个吐 token 文本
+    meta:   dict，token 生成器跑完之前往里面写 sources 等信息，最后随 done 事件一起发出
+    """
+    queue = asyncio.Queue()
+    start = time.perf_counter()
+    first_token_at = None
+    token_count = 0
+    frame_count = 0
+
+    async def produce():
+        try:
+            async for token in tokens:
+                await queue.put(token)
+            await queue.put(_DONE)
+        except Exception as e:
+            await queue.put(e)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            # 1. 等第一个 token (等太久就发保活注释)
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout=keepalive_s)
+            except asyncio.TimeoutError:
+                yield sse_comment()
+                continue
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                yield sse_event({"message": str(item)}, event="error")
+                return
+
+            # 2. 攒批：在时间窗口内尽量多收几个 token，攒够字节数就提前发
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            buffer = [item]
+            size = len(item.encode("utf-8"))
+            deadline = time.perf_counter() + window_ms / 1000
+            finished = False
+            while size < max_bytes:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+                if item is _DONE or isinstance(item, Exception):
+                    finished = item
+                    break
+                buffer.append(item)
+                size += len(item.encode("utf-8"))
+
+            token_count += len(buffer)
+            frame_count += 1
+            yield sse_event({"text": "".join(buffer)})
+            if finished is _DONE:
+                break
+            if isinstance(finished, Exception):
+                yield sse_event({"message": str(finished)}, event="error")
+                return
+
+        # 3. 收尾：来源 + 耗时
+        now = time.perf_counter()
+        yield sse_event({
+            **(meta or {}),
+            "timing": {
+                "ttft_ms": round((first_token_at - start) * 1000, 1) if first_token_at else None,
+                "total_ms": round((now - start) * 1000, 1),
+                "tokens": token_count,
+                "frames": frame_count,
+            },
+        }, event="done")
+    finally:
+        # 客户端断开时这里会被取消：顺手把上游的生成也停掉
+        producer.cancel()
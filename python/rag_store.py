@@ -0,0 +1,299 @@
+# 向量库持久化 (Persistent Vector Store)
+# 痛点: RAG_CHAINS 里的 Chroma 全在内存里，一重启/一崩溃，所有人的索引全没了，只能重新上传、重新 Embedding。
+# 思路: 每个 session 在数据目录下有自己的一个 Chroma collection (落盘)。
+#       服务重启后不全量加载，谁来提问，就只把谁的库从磁盘“捞”回来 (懒加载)。
+
+import hashlib
+import os
+
+import chromadb
+from langchain_community.vectorstores import Chroma
+
+from rag_cache import chunk_hash
+
+
+# 数据目录：设置了 RAG_PERSIST_DIR 才开启持久化，不设置就和以前一样纯内存
+PERSIST_DIR = os.getenv("RAG_PERSIST_DIR")
+
+
+def session_collection_name(session_id):
+    """
+    Chroma 对 collection 名字有要求 (3~63 位，只能是字母数字和 ._-)
+    session_id 是前端传进来的，什么字符都可能有，所以统一做个哈希
+    """
+    digest = hashlib.sha256(session_id.encode("utf-8")).hexdigest()[:24]
+    return f"session_{digest}"
+
+
+def session_persist_path(session_id, persist_dir=PERSIST_DIR):
+    if not persist_dir:
+        return None
+    return os.path.join(persist_dir, session_collection_name(session_id))
+
+
+def has_persisted_session(session_id, persist_dir=PERSIST_DIR):
+    """磁盘上有没有这个 session 的库"""
+    path = session_persist_path(session_id, persist_dir)
+    return bool(path) and os.path.isdir(path)
+
+
+def create_session_store(session_id, texts, metadatas, embedding, persist_dir=PERSIST_DIR, doc_id="default"):
+    """
+    给 session 建一个新库 (重新上传 = 整库替换)，库里只有 doc_id 这一份文档
+    - 持久化模式：写到 数据目录/<collection 名>/ 下
+    - 内存模式：也用独立的 collection 名，防止不同 session 的数据串到同一个默认 collection 里
+    """
+    collection_name = session_collection_name(session_id)
+    path = session_persist_path(session_id, persist_dir)
+
+    if path is None or os.path.isdir(path):
+        # 先把旧 collection 删掉，不直接删文件夹 (Chroma 客户端可能还开着这个目录)
+        # 内存模式也要删：内存客户端是全局共享的，不删的话新旧两份 PDF 会混在一个库里
+        Chroma(
+            collection_name=collection_name,
+            persist_directory=path,
+            embedding_function=embedding,
+        ).delete_collection()
+
+    ids, metadatas = tag_chunks(doc_id, texts, metadatas)
+    return Chroma.from_texts(
+        texts=texts,
+        embedding=embedding,
+        metadatas=metadatas,
+        ids=ids,
+        collection_name=collection_name,
+        persist_directory=path,
+    )
+
+
+def open_session_store(session_id, embedding, persist_dir=PERSIST_DIR):
+    """从磁盘打开一个已有的库；没开持久化或者磁盘上没有，返回 None"""
+    if not has_persisted_session(session_id, persist_dir):
+        return None
+    return Chroma(
+        collection_name=session_collection_name(session_id),
+        persist_directory=session_persist_path(session_id, persist_dir),
+        embedding_function=embedding,
+    )
+
+
+def release_session_store(session_id, persist_dir=PERSIST_DIR):
+    """
+    Session 被踢出内存、而且已经没有请求 / 入库任务借着它的时候调用 (借用计数见 SessionStore.lease)：
+    - 持久化模式：数据在磁盘上，下次还能捞回来；但每个 session 目录对应 chromadb 里一个独立的 System
+      (SQLite 连接 + HNSW 段)，chromadb 会把它一直缓存到进程退出，所以要手动停掉、从缓存里摘掉
+    - 内存模式：Chroma 的内存客户端是全局共享的，不手动删 collection，内存根本不会释放
+    """
+    if has_persisted_session(session_id, persist_dir):
+        close_persistent_system(session_persist_path(session_id, persist_dir))
+        return
+    Chroma(collection_name=session_collection_name(session_id)).delete_collection()
+
+
+def close_persistent_system(path):
+    """
+    停掉某个持久化目录的 chromadb System 并移出它的进程级缓存 (用的是 chromadb 的内部结构，版本对不上就什么都不做)
+    之后再用这个目录建 Chroma，会重新打开一个新的 System
+    chromadb 自己的引用计数每建一个 Chroma 就 +1、没人 close 就永远不归零，指望不上；
+    所以只能在确认没人用这个目录的时候调 (release_session_store 由 SessionStore 在最后一个借用者还回来之后才调)
+    """
+    try:
+        from chromadb.api.shared_system_client import SharedSystemClient
+        systems = SharedSystemClient._identifier_to_system
+        refcounts = SharedSystemClient._identifier_to_refcount
+        lock = SharedSystemClient._refcount_lock
+    except (ImportError, AttributeError):
+        return False
+    with lock:
+        system = systems.pop(path, None)
+        refcounts.pop(path, None)
+    if system is None:
+        return False
+    system.stop()
+    return True
+
+
+# --- 增量更新：一个 session 里放多份文档，单独 追加 / 替换 / 删除 某一份 ---
+# 每个块在 collection 里的 id = 文档 id + 块指纹 + 序号，metadata 里带上 doc_id 和 chunk_hash：
+#   - 替换文档时，新旧两版里没变的块 id 一样，原地保留，不删不加
+#   - 整个 session 里已经有的块指纹，新文档里再出现就直接复用向量，不再调 Embedding
+
+def chunk_id(doc_id, digest, occurrence):
+    return f"{doc_id}:{digest}:{occurrence}"
+
+
+def tag_chunks(doc_id, texts, metadatas):
+    """给一份文档的块打上 doc_id / chunk_hash，返回 (ids, metadatas)"""
+    ids = []
+    tagged = []
+    seen = {}
+    for text, metadata in zip(texts, metadatas):
+        digest = chunk_hash(text)
+        occurrence = seen.get(digest, 0)
+        seen[digest] = occurrence + 1
+        ids.append(chunk_id(doc_id, digest, occurrence))
+        tagged.append({**metadata, "doc_id": doc_id, "chunk_hash": digest})
+    return ids, tagged
+
+
+def find_session_store(session_id, embedding, persist_dir=PERSIST_DIR):
+    """只读地打开 session 的库：不存在就返回 None，不建目录、不建 collection (查询类接口用)"""
+    if persist_dir:
+        return open_session_store(session_id, embedding, persist_dir)
+    try:
+        # 内存模式：和 Chroma(...) 用的是同一个全局内存客户端，只查不建
+        chromadb.Client().get_collection(session_collection_name(session_id))
+    except Exception:  # 不存在时 chromadb 各版本抛的异常不一样 (ValueError / NotFoundError)
+        return None
+    return get_session_store(session_id, embedding, persist_dir)
+
+
+def get_session_store(session_id, embedding, persist_dir=PERSIST_DIR):
+    """打开 session 的库，没有就建一个空的 (内存模式下拿到的是同一个全局客户端里的同一个 collection)"""
+    return Chroma(
+        collection_name=session_collection_name(session_id),
+        persist_directory=session_persist_path(session_id, persist_dir),
+        embedding_function=embedding,
+    )
+
+
+def session_chunk_hashes(vectorstore):
+    """库里已有的全部块指纹 (给入库流水线，命中的块跳过 Embedding)"""
+    records = vectorstore._collection.get(include=["metadatas"])
+    return {m["chunk_hash"] for m in records["metadatas"] if m and "chunk_hash" in m}
+
+
+def session_chunks(vectorstore):
+    """库里全部块的 (ids, texts, metadatas)，从磁盘恢复时重建 BM25 索引用"""
+    records = vectorstore._collection.get(include=["documents", "metadatas"])
+    return records["ids"], records["documents"], [m or {} for m in records["metadatas"]]
+
+
+def lookup_chunk_vectors(vectorstore, digests):
+    """按块指纹从库里取回已经算好的向量：{chunk_hash: vector}"""
+    if not digests:
+        return {}
+    records = vectorstore._collection.get(
+        where={"chunk_hash": {"$in": sorted(digests)}},
+        include=["metadatas", "embeddings"],
+    )
+    return {m["chunk_hash"]: list(v) for m, v in zip(records["metadatas"], records["embeddings"])}
+
+
+def list_session_documents(vectorstore):
+    """库里有哪些文档：[{doc_id, source, chunks}]"""
+    records = vectorstore._collection.get(include=["metadatas"])
+    documents = {}
+    for metadata in records["metadatas"]:
+        doc_id = (metadata or {}).get("doc_id")
+        if doc_id is None:
+            continue
+        entry = documents.setdefault(doc_id, {"doc_id": doc_id, "source": metadata.get("source"), "chunks": 0})
+        entry["chunks"] += 1
+    return list(documents.values())
+
+
+class DocumentWriter:
+    """
+    边 Embedding 边写库：当作 ingest_pdf 的 sink，每算完一批向量就把这一批写进 session 的 collection
+    (写进去马上能被向量检索搜到，不用等整本算完；整本的向量也不用攒在内存里)
+    块 id 和 tag_chunks 一样按文档顺序编号，最后 upsert_document(..., written=writer.created) 收尾时
+    认得出哪些块这次已经写过了，不会再写一遍；任务半路失败就 rollback()，把这次新建的块删掉
+      written: 这次写过的块 id；created: 其中写之前库里还没有的 (回滚只删这些，原来就有的不动)
+    """
+
+    def __init__(self, vectorstore, doc_id):
+        self.vectorstore = vectorstore
+        self.doc_id = doc_id
+        self.written = set()
+        self.created = set()
+        self._ids = []
+        self._seen = {}
+
+    def _number(self, texts, upto):
+        # 按文档顺序给块编号 (同一份文档里重复的块靠出现次数区分)；前面的块一定已经切出来了
+        while len(self._ids) < upto:
+            digest = chunk_hash(texts[len(self._ids)])
+            occurrence = self._seen.get(digest, 0)
+            self._seen[digest] = occurrence + 1
+            self._ids.append(chunk_id(self.doc_id, digest, occurrence))
+
+    def __call__(self, texts, metadatas, positions, vectors):
+        if not positions:
+            return
+        self._number(texts, max(positions) + 1)
+        ids = [self._ids[n] for n in positions]
+        collection = self.vectorstore._collection
+        existing = set(collection.get(ids=ids, include=[])["ids"])
+        collection.upsert(
+            ids=ids,
+            embeddings=[list(v) for v in vectors],
+            documents=[texts[n] for n in positions],
+            metadatas=[{**metadatas[n], "doc_id": self.doc_id, "chunk_hash": chunk_hash(texts[n])} for n in positions],
+        )
+        self.written.update(ids)
+        self.created.update(i for i in ids if i not in existing)
+
+    def rollback(self):
+        """任务没做完：把这次新建的块删掉，库回到开始前的样子"""
+        if self.created:
+            self.vectorstore._collection.delete(ids=list(self.created))
+            self.created.clear()
+
+
+def upsert_document(vectorstore, doc_id, texts, metadatas, vectors, written=()):
+    """
+    把一份文档写进库 (没有就追加，有就替换)，只动有变化的块
+    written: 这次已经由 DocumentWriter 边算边写进去的块 id (它们算新增，不用再写，对应的向量可以是 None)
+    返回 (delta, changes)：
+      delta   = {"added", "removed", "kept"} 块数
+      changes = {"added": [(id, text, metadata)], "updated": [(id, metadata)], "removed": [id]}
+                给内存里的 BM25 索引按同样的增量更新用，不用整个重建
+    """
+    collection = vectorstore._collection
+    ids, tagged = tag_chunks(doc_id, texts, metadatas)
+    written = set(written)
+    old_ids = set(collection.get(where={"doc_id": doc_id}, include=[])["ids"]) - written
+    new_ids = set(ids)
+
+    stale = [i for i in old_ids if i not in new_ids]
+    if stale:
+        collection.delete(ids=stale)
+    new = [n for n, i in enumerate(ids) if i not in old_ids]
+    unwritten = [n for n in new if ids[n] not in written]
+    if unwritten:
+        collection.add(
+            ids=[ids[n] for n in unwritten],
+            embeddings=[vectors[n] for n in unwritten],
+            documents=[texts[n] for n in unwritten],
+            metadatas=[tagged[n] for n in unwritten],
+        )
+    kept = [n for n, i in enumerate(ids) if i in old_ids]
+    if kept:
+        # 内容没变，但页码之类的元数据可能变了，顺手更新 (不碰向量)
+        collection.update(ids=[ids[n] for n in kept], metadatas=[tagged[n] for n in kept])
+    changes = {
+        "added": [(ids[n], texts[n], tagged[n]) for n in new],
+        "updated": [(ids[n], tagged[n]) for n in kept],
+        "removed": stale,
+    }
+    return {"added": len(new), "removed": len(stale), "kept": len(kept)}, changes
+
+
+def keep_only(vectorstore, ids):
+    """整库替换的收尾：库里不在 ids 里的块全部删掉 (旧文档、老版本没有 doc_id 的块)，返回删掉的 id"""
+    keep = set(ids)
+    collection = vectorstore._collection
+    stale = [i for i in collection.get(include=[])["ids"] if i not in keep]
+    if stale:
+        collection.delete(ids=stale)
+    return stale
+
+
+def delete_document(vectorstore, doc_id):
+    """从库里删掉一份文档，返回删掉的块 id"""
+    collection = vectorstore._collection
+    ids = collection.get(where={"doc_id": doc_id}, include=[])["ids"]
+    if ids:
+        collection.delete(ids=ids)
+    return ids
@@ -0,0 +1,191 @@
+# 流式结构化输出 (边生成边解析 JSON + Schema 校验 + 提前结束)
+# 痛点: 2-14.py 的 prompt | llm | JsonOutputParser()、2-12.py 的 Reduce “只输出纯 JSON”，
+#       都是等模型整段吐完才开始解析：
+#       - 模型包了一层 ```json ... ```，或者前面先客套一句，最后才发现解析失败
+#       - JSON 的 } 早就出来了，模型还在后面啰嗦 (解释、再来一个代码块结尾)，这些 token 照样花钱、照样要等
+#       - 字段名写错 (比如 "replay")、类型不对，也是全部生成完才知道
+# 思路:
+#   1. 用 stream() 一段一段地收，边收边扫括号深度 (会跳过字符串里的括号和转义)
+#   2. 开头的 ```json / 客套话直接跳过，从第一个 { 开始算；跳过太多字还没见到 { 就判定失败
+#   3. 每收到一段就用 parse_partial_json 补全成“半成品”对象，交给 on_partial 回调 (界面可以实时显示)
+#   4. 半成品也做校验：出现 Schema 里没有的字段、字段类型不对 -> 立刻中止生成
+#   5. 最外层的 } 一出现就停止读流 (关闭流 = 断开 HTTP 连接，后面的 token 不再生成)，做完整校验后返回
+
+import os
+
+from langchain_core.utils.json import parse_partial_json
+
+
+# 第一个 { 之前最多容忍多少字的废话 (```json、“好的，这是您要的结果：”)
+MAX_PREAMBLE_CHARS = int(os.getenv("RAG_JSON_MAX_PREAMBLE", "200"))
+
+# Schema: 字段 -> 允许的类型；字段都是必填的，多出来的字段不允许
+PRODUCT_SCHEMA = {
+    "product_name": (str,),
+    "price": (str, int, float, type(None)),
+    "launch_date": (str, type(None)),
+    "stock_status": (str, type(None)),
+}
+COPY_SCHEMA = {
+    "reply": (str,),
+    "tag": (list,),
+}
+
+
+class StructuredOutputError(ValueError):
+    def __init__(self, message, text=""):
+        super().__init__(message)
+        self.text = text
+
+
+def validate(obj, schema, partial=False):
+    """返回错误列表 (空列表 = 通过)；partial=True 时是半成品，还没出现的字段不算缺"""
+    if not isinstance(obj, dict):
+        return [f"应该是 JSON 对象，实际是 {type(obj).__name__}"]
+    errors = []
+    for key, value in obj.items():
+        if key not in schema:
+            errors.append(f"多余的字段: {key}")
+        elif not isinstance(value, schema[key]):
+            # 半成品里还没写完的值会被补成 None，先放过
+            if not (partial and value is None):
+                errors.append(f"字段 {key} 类型不对: {type(value).__name__}")
+    if not partial:
+        errors.extend(f"缺少字段: {key}" for key in schema if key not in obj)
+    return errors
+
+
+class IncrementalJSONParser:
+    """
+    用法：
+        parser = IncrementalJSONParser(schema)
+        for chunk in stream:
+            partial = parser.feed(chunk)   # 半成品 dict (还没见到 { 时是 None)
+            if parser.done:
+                break
+        result = parser.result()           # 完整校验，失败抛 StructuredOutputError
+    """
+
+    def __init__(self, schema=None, max_preamble=MAX_PREAMBLE_CHARS):
+        self.schema = schema
+        self.max_preamble = max_preamble
+        self.text = ""
+        self.start = None       # 第一个 { 的位置
+        self.end = None         # 和它配对的 } 后面的位置
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._partial = None
+
+    @property
+    def done(self):
+        return self.end is not None
+
+    def feed(self, chunk):
+        if self.done:
+            return self._partial
+        self.text += chunk
+        self._scan()
+        if self.start is None:
+            if len(self.text.strip()) > self.max_preamble:
+                raise StructuredOutputError(f"前 {self.max_preamble} 个字里没有 JSON 对象", self.text)
+            return None
+        body = self.text[self.start:self.end]
+        partial = parse_partial_json(body)
+        if partial is not None:
+            self._partial = partial
+            # 写完了的交给 result() 做完整校验；没写完的只要已经错了就没必要再等
+            if self.schema is not None and not self.done:
+                errors = validate(partial, self.schema, partial=True)
+                if errors:
+                    raise StructuredOutputError("；".join(errors), self.text)
+        return self._partial
+
+    def result(self):
+        if not self.done:
+            raise StructuredOutputError("JSON 没有写完就结束了", self.text)
+        obj = parse_partial_json(self.text[self.start:self.end], strict=False)
+        if obj is None:
+            raise StructuredOutputError("JSON 解析失败", self.text)
+        if self.schema is not None:
+            errors = validate(obj, self.schema)
+            if errors:
+                raise StructuredOutputError("；".join(errors), self.text)
+        return obj
+
+    # --- 内部实现 ---
+    def _scan(self):
+        """只扫新来的字符：记录字符串 / 转义状态和括号深度，找到最外层对象的起止"""
+        text = self.text
+        for i in range(self._pos, len(text)):
+            c = text[i]
+            if self.start is None:
+                if c == "{":
+                    self.start = i
+                    self._depth = 1
+                continue
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+            elif c == '"':
+                self._in_string = True
+            elif c in "{[":
+                self._depth += 1
+            elif c in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self.end = i + 1
+                    self._pos = self.end
+                    return
+        self._pos = len(text)
+
+
+def _chunk_text(chunk):
+    """chain.stream() 可能吐字符串 (接了 StrOutputParser)，也可能吐 AIMessageChunk"""
+    return chunk if isinstance(chunk, str) else getattr(chunk, "content", "") or ""
+
+
+def stream_json(runnable, inputs, schema=None, on_partial=None, drain=False):
+    """
+    边生成边解析，返回 (校验通过的 dict, 统计)
+    runnable 是 prompt | llm (后面别再接 JsonOutputParser)；on_partial(dict) 在半成品有变化时回调
+    对象一闭合就关掉流，不等模型把后面的废话说完
+    drain=True (批量记账用)：对象闭合后不再解析，但把流读完 ——
+    token 用量 (stream_usage) 在最后一个 chunk 里，提前关流就拿不到，只能估算
+    """
+    parser = IncrementalJSONParser(schema)
+    stream = runnable.stream(inputs)
+    last = None
+    chunks = 0
+    stopped_early = False
+    drained = 0
+    try:
+        for chunk in stream:
+            chunks += 1
+            if parser.done:
+                # 只有 drain 模式会走到这里：后面的内容不要，只等用量
+                drained += 1
+                continue
+            partial = parser.feed(_chunk_text(chunk))
+            if on_partial is not None and partial is not None and partial != last:
+                on_partial(partial)
+                last = partial
+            if parser.done and not drain:
+                stopped_early = True
+                break
+    finally:
+        # 提前 break 时关掉生成器 -> 底层 HTTP 流跟着关闭，模型不再继续生成
+        stream.close()
+    result = parser.result()
+    stats = {
+        "chunks": chunks,
+        "chars": len(parser.text),
+        "stopped_early": stopped_early,
+        "drained_chunks": drained,
+    }
+    return result, stats
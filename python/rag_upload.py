@@ -0,0 +1,80 @@
+# 上传文件“一遍过”：边收边算指纹，小文件留在内存，大文件才落盘
+# 痛点: /upload 先 copyfileobj 到临时文件，解析时再从磁盘读一遍，算指纹时又 f.read() 整个读进内存一遍；
+#       22.py 更夸张，uploaded_file.getvalue() 拷一份再写盘。大文件 = 好几份拷贝 + 好几次磁盘 IO。
+# 思路:
+#   1. 按 1MB 一块地读上传流，同一遍里顺手更新 SHA-256 (入库缓存 / 去重要用的指纹)
+#   2. 总大小没超过 RAG_UPLOAD_SPOOL_MB：直接留在内存里 (bytes)，解析器直接吃 bytes，完全不碰磁盘
+#   3. 超过了才写到临时文件 (后面多进程解析要按路径打开)，已经收到的部分只写一次
+#   4. 下游拿 upload.source (bytes 或 路径) + upload.sha256，不用再读一遍文件算指纹
+
+import hashlib
+import os
+import tempfile
+
+
+UPLOAD_SPOOL_MB = float(os.getenv("RAG_UPLOAD_SPOOL_MB", "16"))
+COPY_CHUNK_BYTES = 1024 * 1024
+
+
+class SpooledUpload:
+    """一次上传的结果：data (内存里的 bytes) 和 path (磁盘上的临时文件) 二选一"""
+
+    def __init__(self, sha256, size, data=None, path=None):
+        self.sha256 = sha256
+        self.size = size
+        self.data = data
+        self.path = path
+
+    @property
+    def source(self):
+        # rag_pdf / ingest_pdf 两种都认
+        return self.data if self.data is not None else self.path
+
+    @property
+    def in_memory(self):
+        return self.data is not None
+
+    def close(self):
+        # 内存里的直接丢掉引用；落过盘的把临时文件删了
+        self.data = None
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+        self.path = None
+
+
+def spool_upload(fileobj, max_memory_mb=UPLOAD_SPOOL_MB, suffix=".pdf"):
+    """把上传流读一遍：同时算 SHA-256，小的留内存，大的落盘；返回 SpooledUpload"""
+    max_memory = int(max_memory_mb * 1024 * 1024)
+    hasher = hashlib.sha256()
+    chunks = []
+    size = 0
+    tmp_file = None
+    try:
+        while True:
+            chunk = fileobj.read(COPY_CHUNK_BYTES)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            size += len(chunk)
+            if tmp_file is None and size > max_memory:
+                # 超过内存上限：把已经收到的部分写下去，之后边收边写
+                tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
+                for buffered in chunks:
+                    tmp_file.write(buffered)
+                chunks = []
+            if tmp_file is None:
+                chunks.append(chunk)
+            else:
+                tmp_file.write(chunk)
+    except BaseException:
+        if tmp_file is not None:
+            tmp_file.close()
+            os.remove(tmp_file.name)
+        raise
+
+    if tmp_file is not None:
+        tmp_file.close()
+        return SpooledUpload(hasher.hexdigest(), size, path=tmp_file.name)
+    # 只有一块时 join 不会再拷贝一份
+    data = chunks[0] if len(chunks) == 1 else b"".join(chunks)
+    return SpooledUpload(hasher.hexdigest(), size, data=bytes(data))